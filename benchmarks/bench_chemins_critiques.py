@@ -0,0 +1,197 @@
+"""
+Microbenchmarks des fonctions pures du chemin critique (aucun appel réseau).
+
+Usage (depuis la racine du dépôt) :
+    python benchmarks/bench_chemins_critiques.py              # compare aux références
+    python benchmarks/bench_chemins_critiques.py --enregistrer  # met à jour les références
+    python benchmarks/bench_chemins_critiques.py --seuil 1.3    # tolérance (défaut 1.5x)
+
+Chaque échantillon répète le scénario pendant au moins --duree-min secondes (0.1),
+et le meilleur des --repetitions échantillons est comparé: une mesure de quelques
+millisecondes isolée varie trop d'une exécution à l'autre pour servir de seuil.
+Les échantillons des scénarios sont entrelacés, pour que chacun profite des
+périodes où la machine est la moins chargée.
+
+Les références (benchmarks/references.json) dépendent de la machine: les
+régénérer avec --enregistrer sur la machine qui sert de point de comparaison.
+Le script sort avec le code 1 si une mesure dépasse référence x seuil.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+from datetime import date, timedelta
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RACINE)
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import main  # noqa: E402
+
+FICHIER_REFERENCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "references.json")
+ALEA = random.Random(42)
+
+
+# ============== JEUX DE DONNÉES SYNTHÉTIQUES ==============
+
+def generer_telephones(n: int) -> list:
+    formats = ["06{}", "+33 6 {}", "0033 6{}", "07.{}", "06-{}"]
+    telephones = []
+    for _ in range(n):
+        chiffres = "".join(str(ALEA.randint(0, 9)) for _ in range(8))
+        telephones.append(ALEA.choice(formats).format(chiffres))
+    return telephones
+
+
+def generer_dates(n: int) -> list:
+    dates = []
+    for _ in range(n):
+        d = date(2025, 1, 1) + timedelta(days=ALEA.randint(0, 700))
+        dates.append(ALEA.choice([d.strftime("%d/%m/%Y"), d.isoformat(), d.strftime("%d-%m-%Y")]))
+    return dates
+
+
+MOTS_TYPES = ["CONSULTATION", "URGENCE", "BILAN ORTHO", "DETARTRAGE ET MAINTENANCE", "COLLAGE FACETTE",
+              "EMPREINTE OPTIQUE", "POSE IMPLANT", "CHIRURGIE", "ESSAYAGE PROTHESE", "ÉCLAIRCISSEMENT",
+              "SOINS CONSERVATEURS", "CONTROLE", "RADIO PANORAMIQUE", "SEANCE DE PROPHYLAXIE"]
+
+
+def generer_noms_types(n: int) -> list:
+    return [f"{ALEA.choice(MOTS_TYPES)} {ALEA.choice(['', 'adulte', 'enfant', '1h', '30 min'])} {i}".strip()
+            for i in range(n)]
+
+
+def generer_creneaux(n: int) -> list:
+    debut = date(2099, 1, 5)
+    slots = []
+    for i in range(n):
+        jour = debut + timedelta(days=i // 40)
+        minutes = 8 * 60 + (i % 40) * 15
+        slots.append({"start": f"{jour.isoformat()}T{minutes // 60:02d}:{minutes % 60:02d}:00+01:00"})
+    return slots
+
+
+def generer_schedules(n_types: int) -> dict:
+    extensions = []
+    for i, nom in enumerate(generer_noms_types(n_types)):
+        extensions.append({
+            "url": main.URL_EXT_SERVICE_TYPE_DURATION,
+            "extension": [
+                {"url": "serviceType", "valueCodeableConcept": {"coding": [{
+                    "code": str(100 + i), "display": nom,
+                    "eligibility": [{"code": "newPatients", "value": i % 7 == 0}],
+                }]}},
+                {"url": "duration", "valueDuration": {"time": {"value": ALEA.choice([15, 30, 45, 60])}}},
+            ],
+        })
+    return {"Schedules": [{"id": "praticien", "extension": extensions}]}
+
+
+# ============== MESURES ==============
+
+def calibrer(chrono: timeit.Timer, duree_min: float) -> int:
+    """Nombre d'exécutions pour qu'un échantillon dure au moins duree_min secondes (sert aussi d'échauffement)"""
+    nombre = 1
+    while True:
+        duree = chrono.timeit(nombre)
+        if duree >= duree_min:
+            return nombre
+        nombre = max(nombre * 2, int(nombre * duree_min * 1.2 / max(duree, 1e-6)))
+
+
+def mesurer(fonctions: dict, repetitions: int = 10, duree_min: float = 0.1) -> dict:
+    """
+    Durée (en millisecondes) d'une exécution de chaque fonction: meilleur de `repetitions`
+    échantillons d'au moins duree_min secondes, pris à tour de rôle entre les fonctions
+    """
+    chronos = {nom: timeit.Timer(fonction) for nom, fonction in fonctions.items()}
+    nombres = {nom: calibrer(chrono, duree_min) for nom, chrono in chronos.items()}
+    meilleures = {nom: float("inf") for nom in fonctions}
+    for _ in range(repetitions):
+        for nom, chrono in chronos.items():
+            meilleures[nom] = min(meilleures[nom], chrono.timeit(nombres[nom]) / nombres[nom] * 1000)
+    return meilleures
+
+
+def scenarios() -> dict:
+    telephones = generer_telephones(5000)
+    dates = generer_dates(5000)
+    noms_types = generer_noms_types(300)
+    creneaux = generer_creneaux(5000)
+    schedules = generer_schedules(300)
+    demandes = [(ALEA.choice(noms_types), s["start"][:10], s["start"][11:16].replace(":", ""))
+                for s in creneaux[:3000]]
+
+    def vider_caches():
+        main.CONFIG_DEFAUT.categorie_par_nom.cache_clear()
+
+    def bench_categorie():
+        vider_caches()
+        for nom in noms_types:
+            main.trouver_categorie_rdv(nom)
+
+    def bench_filtrage():
+        compteurs = {"filtres": 0}
+        for _ in main.parcourir_creneaux(creneaux, "CONSULTATION_URGENCE_BILAN", compteurs):
+            pass
+
+    def bench_types_rdv():
+        vider_caches()
+        main.parser_types_rdv(schedules)
+
+    return {
+        "normaliser_telephone (5000)": lambda: [main.normaliser_telephone(t) for t in telephones],
+        "convertir_date (5000)": lambda: [main.convertir_date(d) for d in dates],
+        "trouver_categorie_rdv (300 noms, cache vide)": bench_categorie,
+        "est_creneau_autorise (3000)": lambda: [main.est_creneau_autorise(*d) for d in demandes],
+        "filtrage des créneaux (5000)": bench_filtrage,
+        "parsing FHIR des types de RDV (300)": bench_types_rdv,
+    }
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--enregistrer", action="store_true", help="Enregistrer les mesures comme références")
+    parser.add_argument("--seuil", type=float, default=float(os.getenv("BENCH_SEUIL", "1.5")),
+                        help="Régression tolérée (multiple de la référence)")
+    parser.add_argument("--repetitions", type=int, default=10, help="Échantillons par scénario (le meilleur est retenu)")
+    parser.add_argument("--duree-min", type=float, default=0.1, help="Durée minimale d'un échantillon (secondes)")
+    args = parser.parse_args()
+
+    references = {}
+    if os.path.exists(FICHIER_REFERENCES):
+        with open(FICHIER_REFERENCES, "r", encoding="utf-8") as f:
+            references = json.load(f)
+
+    resultats = {}
+    regressions = []
+    for nom, duree in mesurer(scenarios(), args.repetitions, args.duree_min).items():
+        resultats[nom] = round(duree, 3)
+        reference = references.get(nom)
+        if reference:
+            ratio = duree / reference
+            etat = "RÉGRESSION" if ratio > args.seuil else "ok"
+            if ratio > args.seuil:
+                regressions.append(nom)
+            print(f"{nom:<48} {duree:9.3f} ms  (réf. {reference:.3f} ms, x{ratio:.2f}) {etat}")
+        else:
+            print(f"{nom:<48} {duree:9.3f} ms  (pas de référence)")
+
+    if args.enregistrer:
+        with open(FICHIER_REFERENCES, "w", encoding="utf-8") as f:
+            json.dump(resultats, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        print(f"\nRéférences enregistrées dans {FICHIER_REFERENCES}")
+        return 0
+
+    if regressions:
+        print(f"\n{len(regressions)} régression(s) au-delà de x{args.seuil}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
@@ -0,0 +1,60 @@
+"""
+Compare les chemins JSON: json standard vs orjson (si installé), et l'encodage
+FastAPI par défaut (jsonable_encoder + JSONResponse) vs ReponseJsonRapide.
+
+Usage (depuis la racine du dépôt) :
+    python benchmarks/bench_json.py
+"""
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+from bench_chemins_critiques import generer_creneaux, generer_schedules, main, mesurer  # noqa: E402
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def charges() -> dict:
+    creneaux = generer_creneaux(5000)
+    reponse_disponibilites = {
+        "success": True,
+        "creneaux": [{"date": s["start"][:10], "heure": s["start"][11:16].replace(":", ""),
+                      "heure_affichage": s["start"][11:16].replace(":", "h")} for s in creneaux],
+        "message": "5000 créneaux disponibles",
+    }
+    return {
+        "/schedules (300 types)": generer_schedules(300),
+        "créneaux amont (5000)": {"AvailableSlots": creneaux},
+        "réponse /disponibilites (5000)": reponse_disponibilites,
+    }
+
+
+def main_bench():
+    print(f"Backend actif dans main.py: {main.JSON_BACKEND}\n")
+    print(f"{'':<34}{'taille':>9}{'json loads':>12}{'orjson loads':>14}{'défaut FastAPI':>16}{'rapide':>10}")
+    for nom, data in charges().items():
+        brut = json.dumps(data).encode("utf-8")
+        fonctions = {
+            "json": lambda: json.loads(brut),
+            "defaut": lambda: JSONResponse(jsonable_encoder(data)).body,
+            "rapide": lambda: main.ReponseJsonRapide(data).body,
+        }
+        if orjson:
+            fonctions["orjson"] = lambda: orjson.loads(brut)
+        durees = mesurer(fonctions)
+        print(f"{nom:<34}{len(brut) // 1024:>7}ko{durees['json']:>10.2f}ms{durees.get('orjson', float('nan')):>12.2f}ms"
+              f"{durees['defaut']:>14.2f}ms{durees['rapide']:>8.2f}ms")
+
+
+if __name__ == "__main__":
+    main_bench()
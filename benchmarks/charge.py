@@ -0,0 +1,160 @@
+"""
+Générateur de charge: rejoue des conversations Synthflow types contre le serveur.
+
+Prérequis: le simulateur (benchmarks/faux_rdvdentiste.py) et le serveur lancé avec
+RDVDENTISTE_BASE_URL pointant dessus, par exemple :
+    uvicorn benchmarks.faux_rdvdentiste:app --port 9000
+    RDVDENTISTE_BASE_URL=http://127.0.0.1:9000/api uvicorn main:app --port 8000
+    python benchmarks/charge.py --qps 5 --duree 60
+
+Chaque conversation démarre à intervalle régulier (charge ouverte, --qps conversations
+par seconde) et enchaîne ses actions séquentiellement, comme l'agent vocal.
+Le rapport donne p50/p95/p99 par action et par conversation, et le nombre
+d'appels reçus par le simulateur rapporté au nombre de conversations.
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+
+import httpx
+
+# Mélange de conversations: (poids, actions enchaînées)
+CONVERSATIONS = {
+    "voir": (30, ["voir_rdv"]),
+    "voir_annuler": (20, ["voir_rdv", "annuler_rdv"]),
+    "reserver": (30, ["disponibilites", "creer_rdv"]),
+    "deplacer": (20, ["voir_rdv", "annuler_rdv", "disponibilites", "creer_rdv"]),
+}
+TYPES_RDV = [("27", "CONSULTATION"), ("84", "URGENCE"), ("45", "DETARTRAGE ET MAINTENANCE")]
+
+
+def centile(valeurs: list, p: float) -> float:
+    if not valeurs:
+        return 0.0
+    valeurs = sorted(valeurs)
+    return valeurs[min(len(valeurs) - 1, int(round(p / 100 * (len(valeurs) - 1))))]
+
+
+class Conversation:
+    def __init__(self, client: httpx.AsyncClient, alea: random.Random, nb_patients: int, mesures: dict):
+        self.client = client
+        self.alea = alea
+        self.mesures = mesures
+        self.telephone = f"06{alea.randrange(nb_patients):08d}"
+        self.type_rdv, self.type_rdv_nom = alea.choice(TYPES_RDV)
+        self.creneaux = []
+
+    async def _post(self, action: str, chemin: str, corps: dict) -> dict:
+        debut = time.perf_counter()
+        try:
+            reponse = await self.client.post(chemin, json=corps)
+            resultat = reponse.json() if reponse.status_code == 200 else {}
+            ok = reponse.status_code == 200
+        except httpx.HTTPError:
+            resultat, ok = {}, False
+        self.mesures[action].append(time.perf_counter() - debut)
+        if not ok:
+            self.mesures["_erreurs"].append(action)
+        return resultat
+
+    async def voir_rdv(self):
+        await self._post("voir_rdv", "/voir_rdv", {"telephone": self.telephone})
+
+    async def annuler_rdv(self):
+        await self._post("annuler_rdv", "/annuler_rdv", {"telephone": self.telephone})
+
+    async def disponibilites(self):
+        debut = date.today() + timedelta(days=self.alea.randint(1, 14))
+        resultat = await self._post("disponibilites", "/disponibilites", {
+            "type_rdv": self.type_rdv,
+            "type_rdv_nom": self.type_rdv_nom,
+            "date_debut": debut.isoformat(),
+            "date_fin": (debut + timedelta(days=7)).isoformat(),
+        })
+        self.creneaux = resultat.get("creneaux", [])
+
+    async def creer_rdv(self):
+        if not self.creneaux:
+            return
+        creneau = self.alea.choice(self.creneaux)
+        await self._post("creer_rdv", "/creer_rdv", {
+            "type_rdv": self.type_rdv,
+            "type_rdv_nom": self.type_rdv_nom,
+            "date": creneau["date"],
+            "heure": creneau["heure"],
+            "nom": "CHARGE",
+            "prenom": "Test",
+            "telephone": self.telephone,
+            "nouveau_patient": False,
+        })
+
+    async def jouer(self, actions: list, nom: str):
+        debut = time.perf_counter()
+        for action in actions:
+            await getattr(self, action)()
+        self.mesures[f"conversation {nom}"].append(time.perf_counter() - debut)
+
+
+async def lancer(args) -> int:
+    alea = random.Random(args.graine)
+    noms = list(CONVERSATIONS)
+    poids = [CONVERSATIONS[n][0] for n in noms]
+    mesures = defaultdict(list)
+
+    async with httpx.AsyncClient(base_url=args.serveur, timeout=args.timeout) as client, \
+            httpx.AsyncClient(base_url=args.simulateur, timeout=10) as simulateur:
+        await simulateur.post("/_stats/reset")
+
+        taches = []
+        intervalle = 1 / args.qps
+        debut = time.perf_counter()
+        for i in range(int(args.qps * args.duree)):
+            attente = debut + i * intervalle - time.perf_counter()
+            if attente > 0:
+                await asyncio.sleep(attente)
+            nom = alea.choices(noms, poids)[0]
+            conversation = Conversation(client, random.Random(alea.random()), args.patients, mesures)
+            taches.append(asyncio.create_task(conversation.jouer(CONVERSATIONS[nom][1], nom)))
+        await asyncio.gather(*taches)
+        duree_totale = time.perf_counter() - debut
+
+        stats_amont = (await simulateur.get("/_stats")).json()
+
+    erreurs = mesures.pop("_erreurs", [])
+    nb_conversations = len(taches)
+    print(f"{nb_conversations} conversations en {duree_totale:.1f} s ({nb_conversations / duree_totale:.2f}/s), "
+          f"{len(erreurs)} erreur(s)\n")
+    print(f"{'':<32}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'moy. ms':>10}")
+    for nom in sorted(mesures):
+        valeurs = [v * 1000 for v in mesures[nom]]
+        print(f"{nom:<32}{len(valeurs):>6}{centile(valeurs, 50):>10.1f}{centile(valeurs, 95):>10.1f}"
+              f"{centile(valeurs, 99):>10.1f}{statistics.mean(valeurs):>10.1f}")
+
+    print(f"\nAppels amont: {stats_amont['total']} ({stats_amont['total'] / max(1, nb_conversations):.2f} par conversation)")
+    for route, nombre in sorted(stats_amont["par_route"].items(), key=lambda x: -x[1]):
+        print(f"  {route:<56}{nombre:>6}")
+    return 1 if erreurs and len(erreurs) / nb_conversations > args.taux_erreur_max else 0
+
+
+def main_charge():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--serveur", default="http://127.0.0.1:8000")
+    parser.add_argument("--simulateur", default="http://127.0.0.1:9000")
+    parser.add_argument("--qps", type=float, default=5, help="Conversations démarrées par seconde")
+    parser.add_argument("--duree", type=float, default=30, help="Durée d'injection en secondes")
+    parser.add_argument("--patients", type=int, default=1000, help="Doit correspondre à FAUX_PATIENTS")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--graine", type=int, default=1)
+    parser.add_argument("--taux-erreur-max", type=float, default=0.01)
+    args = parser.parse_args()
+    return asyncio.run(lancer(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main_charge())
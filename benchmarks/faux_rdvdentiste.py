@@ -0,0 +1,170 @@
+"""
+Simulateur local de l'API rdvdentiste.net, pour les tests de charge.
+
+Lancement (depuis la racine du dépôt) :
+    uvicorn benchmarks.faux_rdvdentiste:app --port 9000
+
+puis démarrer le serveur avec RDVDENTISTE_BASE_URL=http://127.0.0.1:9000/api.
+
+Réglages (variables d'environnement) :
+    FAUX_LATENCE_MS          latence moyenne par appel (40)
+    FAUX_LATENCE_ECART_MS    variation aléatoire autour de la moyenne (20)
+    FAUX_TAUX_ERREUR         proportion d'appels en erreur 503 (0.0)
+    FAUX_TAUX_LENT           proportion d'appels très lents (0.0)
+    FAUX_LATENCE_LENTE_MS    latence de ces appels lents (3000)
+    FAUX_PATIENTS            nombre de patients (1000), téléphones 0600000000 + n
+    FAUX_RDVS_PAR_PATIENT    RDV à venir par patient (2)
+    FAUX_CRENEAUX_PAR_JOUR   créneaux libres par jour et par type (24)
+    FAUX_TYPES_RDV           types de RDV dans le catalogue /schedules (40)
+
+GET /_stats renvoie le nombre d'appels reçus par route (POST /_stats/reset pour remettre à zéro).
+"""
+
+import asyncio
+import os
+import random
+from collections import Counter
+from datetime import date, timedelta
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+LATENCE_MS = float(os.getenv("FAUX_LATENCE_MS", "40"))
+LATENCE_ECART_MS = float(os.getenv("FAUX_LATENCE_ECART_MS", "20"))
+TAUX_ERREUR = float(os.getenv("FAUX_TAUX_ERREUR", "0"))
+TAUX_LENT = float(os.getenv("FAUX_TAUX_LENT", "0"))
+LATENCE_LENTE_MS = float(os.getenv("FAUX_LATENCE_LENTE_MS", "3000"))
+NB_PATIENTS = int(os.getenv("FAUX_PATIENTS", "1000"))
+RDVS_PAR_PATIENT = int(os.getenv("FAUX_RDVS_PAR_PATIENT", "2"))
+CRENEAUX_PAR_JOUR = int(os.getenv("FAUX_CRENEAUX_PAR_JOUR", "24"))
+NB_TYPES_RDV = int(os.getenv("FAUX_TYPES_RDV", "40"))
+
+URL_EXT_SERVICE_TYPE_DURATION = "http://interopsante.org/fhir/structuredefinition/schedule/fr-service-type-duration"
+
+# Types réels du cabinet (codes connus de CODE_TO_CATEGORIE), complétés par des types fictifs
+TYPES_CONNUS = [("84", "URGENCE"), ("27", "CONSULTATION"), ("37", "BILAN CDC/ESTHETIQUE/ORTHO/PARO"),
+                ("45", "DETARTRAGE ET MAINTENANCE"), ("75", "SEANCE DE PROPHYLAXIE"), ("20", "COLLAGE FACETTE")]
+
+app = FastAPI(title="Faux rdvdentiste.net")
+appels: Counter = Counter()
+rdvs: dict = {}  # rdv_id -> RDV (modifié par PUT / DELETE)
+rdvs_par_patient: dict = {}
+_prochain_id = [100000]
+
+
+def _initialiser():
+    aujourd_hui = date.today()
+    alea = random.Random(1)
+    for n in range(NB_PATIENTS):
+        patient_id = f"P{n}"
+        rdvs_par_patient[patient_id] = []
+        for i in range(RDVS_PAR_PATIENT):
+            code, nom = alea.choice(TYPES_CONNUS)
+            rdv_id = f"R{n}-{i}"
+            rdvs[rdv_id] = {
+                "rdvId": rdv_id,
+                "date": (aujourd_hui + timedelta(days=alea.randint(1, 60))).isoformat(),
+                "start": f"{alea.randint(9, 18):02d}{alea.choice(['00', '30'])}",
+                "duration": 30,
+                "status": "active",
+                "service_type": {"code": code, "display": nom},
+            }
+            rdvs_par_patient[patient_id].append(rdv_id)
+
+
+_initialiser()
+
+
+@app.middleware("http")
+async def simuler_reseau(request: Request, call_next):
+    if request.url.path.startswith("/_stats"):
+        return await call_next(request)
+    appels[f"{request.method} {route_appel(request.url.path)}"] += 1
+    if TAUX_LENT and random.random() < TAUX_LENT:
+        await asyncio.sleep(LATENCE_LENTE_MS / 1000)
+    else:
+        await asyncio.sleep(max(0.0, random.gauss(LATENCE_MS, LATENCE_ECART_MS / 2)) / 1000)
+    if TAUX_ERREUR and random.random() < TAUX_ERREUR:
+        return JSONResponse({"Error": {"code": "unavailable", "text": "Service unavailable"}}, status_code=503)
+    return await call_next(request)
+
+
+def route_appel(chemin: str) -> str:
+    morceaux = chemin.replace("/api", "", 1).strip("/").split("/")
+    if morceaux[0] == "patients" and len(morceaux) == 3:
+        return "/patients/{id}/appointments"
+    if morceaux[0] == "schedules" and len(morceaux) > 1:
+        return f"/schedules/{{praticien}}/{morceaux[2]}/" + ("{...}" if len(morceaux) > 3 else "")
+    return "/" + "/".join(morceaux)
+
+
+@app.get("/_stats")
+async def stats():
+    return {"total": sum(appels.values()), "par_route": dict(appels)}
+
+
+@app.post("/_stats/reset")
+async def reset_stats():
+    appels.clear()
+    return {"ok": True}
+
+
+@app.get("/api/patients/find")
+async def trouver_patient(mobile: str = ""):
+    if not mobile.startswith("06") or not mobile[2:].isdigit() or int(mobile[2:]) >= NB_PATIENTS:
+        return JSONResponse({"Error": {"code": "notFound", "text": "Not found"}}, status_code=404)
+    n = int(mobile[2:])
+    return {"People": [{"identifier": f"P{n}", "lastName": f"NOM{n}", "firstName": f"Prenom{n}", "mobile": mobile}]}
+
+
+@app.get("/api/patients/{patient_id}/appointments")
+async def rdvs_patient(patient_id: str):
+    return [rdvs[rdv_id] for rdv_id in rdvs_par_patient.get(patient_id, [])]
+
+
+@app.get("/api/schedules")
+async def catalogue():
+    types = TYPES_CONNUS + [(str(200 + i), f"TYPE FICTIF {i}") for i in range(max(0, NB_TYPES_RDV - len(TYPES_CONNUS)))]
+    extensions = [{
+        "url": URL_EXT_SERVICE_TYPE_DURATION,
+        "extension": [
+            {"url": "serviceType", "valueCodeableConcept": {"coding": [{"code": code, "display": nom}]}},
+            {"url": "duration", "valueDuration": {"time": {"value": 30}}},
+        ],
+    } for code, nom in types]
+    return {"Schedules": [{"id": "praticien", "extension": extensions}]}
+
+
+@app.get("/api/schedules/{praticien}/slots/{type_rdv}/")
+async def creneaux(praticien: str, type_rdv: str, start: str, end: str):
+    jour, fin = date.fromisoformat(start), date.fromisoformat(end)
+    pas = max(1, (11 * 60) // max(1, CRENEAUX_PAR_JOUR))
+    slots = []
+    while jour <= fin:
+        if jour.weekday() != 6:
+            for i in range(CRENEAUX_PAR_JOUR):
+                minutes = 8 * 60 + i * pas
+                slots.append({"start": f"{jour.isoformat()}T{minutes // 60:02d}:{minutes % 60:02d}:00+01:00"})
+        jour += timedelta(days=1)
+    return {"AvailableSlots": slots}
+
+
+@app.put("/api/schedules/{praticien}/slots/{type_rdv}/{date_rdv}/{heure}/")
+async def reserver(praticien: str, type_rdv: str, date_rdv: str, heure: str):
+    _prochain_id[0] += 1
+    rdv_id = f"N{_prochain_id[0]}"
+    rdvs[rdv_id] = {"rdvId": rdv_id, "date": date_rdv, "start": heure, "duration": 30, "status": "active",
+                    "service_type": {"code": type_rdv, "display": type_rdv}}
+    return {"done": True, "rdvId": rdv_id}
+
+
+@app.delete("/api/schedules/{praticien}/appointment-requests/{rdv_id}/")
+@app.delete("/api/schedules/{praticien}/appointments/{rdv_id}/")
+async def annuler(praticien: str, rdv_id: str):
+    rdv = rdvs.get(rdv_id)
+    if rdv is None:
+        return JSONResponse({"Error": {"code": "notFound", "text": "Appointment not found"}}, status_code=400)
+    if rdv["status"] != "active":
+        return JSONResponse({"Error": {"code": "invalid", "text": "Appointment already cancelled"}}, status_code=400)
+    rdv["status"] = "cancelled"
+    return {}
@@ -6,59 +6,1104 @@ Version: 2.0.0
 """
 
 from fastapi import FastAPI, HTTPException, Header
-from pydantic import BaseModel, Field
-from typing import Optional, List
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
+from fastapi.routing import APIRoute
+from pydantic import BaseModel, Field, ValidationError
+from typing import Optional, List, Callable, Any
+from contextlib import asynccontextmanager
+from collections import OrderedDict, deque
+from functools import lru_cache
+import functools
+from bisect import bisect_left, bisect_right
 import httpx
 import asyncio
 import json
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date as date_cls
 import re
 import os
+import time
+import unicodedata
+import logging
+import logging.handlers
+import queue
+import random
+import sqlite3
+import sys
+import threading
 
 # ============== CONFIGURATION ==============
 
+RDVDENTISTE_BASE_URL = os.getenv("RDVDENTISTE_BASE_URL", "https://www.rdvdentiste.net/api").rstrip("/")
+DEFAULT_OFFICE_CODE = os.getenv("RDVDENTISTE_OFFICE_CODE", "0501463005IMZDB742BK")
+DEFAULT_API_KEY = os.getenv("RDVDENTISTE_API_KEY", "DYND-457AD3+21ZDZX-sdm3ISX")
+DEFAULT_PRATICIEN_ID = "MC"
+
+# Pool de connexions HTTP vers rdvdentiste.net (réutilisé entre les appels)
+HTTP_TIMEOUT = float(os.getenv("RDVDENTISTE_TIMEOUT", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("RDVDENTISTE_CONNECT_TIMEOUT", "5"))
+HTTP_MAX_CONNEXIONS = int(os.getenv("RDVDENTISTE_MAX_CONNEXIONS", "50"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("RDVDENTISTE_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("RDVDENTISTE_KEEPALIVE_EXPIRY", "60"))
+HTTP_HTTP2 = os.getenv("RDVDENTISTE_HTTP2", "0") == "1"
+HTTP_CLIENT_PAR_CABINET = os.getenv("RDVDENTISTE_CLIENT_PAR_CABINET", "0") == "1"
+
+# Délai maximal par classe d'endpoint (secondes), surchargeable par RDVDENTISTE_DELAI_<CLASSE>
+DELAIS_PAR_CLASSE = {
+    classe: float(os.getenv(f"RDVDENTISTE_DELAI_{classe.upper()}", str(defaut)))
+    for classe, defaut in {
+        "patients": 5, "rdvs_patient": 6, "catalogue": 10, "creneaux": 8,
+        "reservation": 15, "annulation": 10, "autre": 10
+    }.items()
+}
+# Nouvelles tentatives sur les GET (timeouts, 5xx): au plus N par appel, et globalement
+# pas plus d'une tentative supplémentaire pour 1/RETRY_BUDGET_RATIO appels
+RETRY_MAX = int(os.getenv("RETRY_MAX", "2"))
+RETRY_DELAI_BASE = float(os.getenv("RETRY_DELAI_BASE", "0.1"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))
+RETRY_BUDGET_MAX = float(os.getenv("RETRY_BUDGET_MAX", "10"))
+# Requêtes "hedgées": un second GET identique est lancé si le premier dépasse le p95 observé
+HEDGE_ACTIF = os.getenv("HEDGE_ACTIF", "0") == "1"
+HEDGE_DELAI_MIN = float(os.getenv("HEDGE_DELAI_MIN", "0.05"))
+# Limitation des appels amont par cabinet: débit (jetons/seconde), rafale et appels
+# simultanés. LIMITES_CABINETS permet des valeurs par Office Code (JSON), ex:
+# {"0501463005IMZDB742BK": {"rps": 5, "rafale": 10, "concurrence": 4}}
+# Débit par défaut dimensionné pour CONVERSATIONS_PAR_SECONDE conversations simultanées par
+# cabinet: une conversation fait 3 à 3.7 appels rdvdentiste (benchmarks/charge.py), plus 50 %
+# de marge. Un débit plus bas protège davantage l'API mais ajoute des secondes d'attente dès
+# que la charge le dépasse (10 appels/s à 5 conversations/s: p50 de 1.6 à 4 s par action).
+APPELS_AMONT_PAR_CONVERSATION = 3.7
+CONVERSATIONS_PAR_SECONDE = float(os.getenv("CONVERSATIONS_PAR_SECONDE", "5"))
+LIMITE_RPS = float(os.getenv("LIMITE_RPS", str(round(CONVERSATIONS_PAR_SECONDE * APPELS_AMONT_PAR_CONVERSATION * 1.5))))
+LIMITE_RAFALE = float(os.getenv("LIMITE_RAFALE", str(2 * LIMITE_RPS)))
+LIMITE_CONCURRENCE = int(os.getenv("LIMITE_CONCURRENCE", "8"))
+LIMITES_CABINETS = json.loads(os.getenv("LIMITES_CABINETS", "{}"))
+LIMITE_ATTENTE_LOG = float(os.getenv("LIMITE_ATTENTE_LOG", "0.5"))
+# Disjoncteur par cabinet: ouvert après N échecs consécutifs, pendant X secondes
+DISJONCTEUR_SEUIL = int(os.getenv("DISJONCTEUR_SEUIL", "5"))
+DISJONCTEUR_DUREE = float(os.getenv("DISJONCTEUR_DUREE", "30"))
+
+# Cache du catalogue (/schedules): durée de fraîcheur, puis période où la valeur
+# périmée est servie pendant qu'un rafraîchissement tourne en arrière-plan
+SCHEDULES_CACHE_TTL = float(os.getenv("SCHEDULES_CACHE_TTL", "21600"))
+SCHEDULES_CACHE_STALE = float(os.getenv("SCHEDULES_CACHE_STALE", "86400"))
+
+# Cache des créneaux (/disponibilites): courte durée, invalidé par /creer_rdv et /annuler_rdv
+DISPONIBILITES_CACHE_TTL = float(os.getenv("DISPONIBILITES_CACHE_TTL", "60"))
+DISPONIBILITES_CACHE_TAILLE = int(os.getenv("DISPONIBILITES_CACHE_TAILLE", "500"))
+
+# Cache téléphone -> patients (/patients/find); les numéros inconnus sont gardés moins longtemps
+PATIENTS_CACHE_TTL = float(os.getenv("PATIENTS_CACHE_TTL", "300"))
+PATIENTS_CACHE_TTL_NEGATIF = float(os.getenv("PATIENTS_CACHE_TTL_NEGATIF", "30"))
+PATIENTS_CACHE_TAILLE = int(os.getenv("PATIENTS_CACHE_TAILLE", "2000"))
+
+# Vérification des annulations en arrière-plan: nombre de vérifications par endpoint,
+# délai initial/maximal entre deux vérifications, historique conservé, workers
+ANNULATION_VERIF_ESSAIS = int(os.getenv("ANNULATION_VERIF_ESSAIS", "3"))
+ANNULATION_VERIF_DELAI_MIN = float(os.getenv("ANNULATION_VERIF_DELAI_MIN", "0.5"))
+ANNULATION_VERIF_DELAI_MAX = float(os.getenv("ANNULATION_VERIF_DELAI_MAX", "30"))
+ANNULATION_HISTORIQUE_TAILLE = int(os.getenv("ANNULATION_HISTORIQUE_TAILLE", "500"))
+ANNULATION_WORKERS = int(os.getenv("ANNULATION_WORKERS", "2"))
+
+# Les longues périodes de /disponibilites sont découpées en tranches de N jours
+# récupérées en parallèle (au plus M appels simultanés par requête)
+DISPONIBILITES_TRANCHE_JOURS = int(os.getenv("DISPONIBILITES_TRANCHE_JOURS", "7"))
+DISPONIBILITES_MAX_CONCURRENCE = int(os.getenv("DISPONIBILITES_MAX_CONCURRENCE", "4"))
+
+# Recherche des prochains créneaux: fenêtres successives (en jours) explorées jusqu'à
+# trouver assez de créneaux, et limite matin / après-midi (en minutes depuis minuit)
+PROCHAINS_CRENEAUX_FENETRES = [int(j) for j in os.getenv("PROCHAINS_CRENEAUX_FENETRES", "2,7,30").split(",")]
+HEURE_MIDI_MINUTES = int(os.getenv("HEURE_MIDI_MINUTES", "720"))
+
+# Préchauffage au démarrage: cabinets dont le catalogue est chargé avant d'accepter
+# les appels (liste d'Office Codes séparés par des virgules), et délai maximal
+PRECHAUFFAGE_CABINETS = [c.strip() for c in os.getenv("PRECHAUFFAGE_CABINETS", "").split(",") if c.strip()]
+PRECHAUFFAGE_TIMEOUT = float(os.getenv("PRECHAUFFAGE_TIMEOUT", "20"))
+PRECHAUFFAGE_BLOQUANT = os.getenv("PRECHAUFFAGE_BLOQUANT", "1") == "1"
+
+# Calendrier matérialisé (opt-in): créneaux des CALENDRIER_SEMAINES prochaines semaines pour
+# chaque cabinet de CALENDRIER_CABINETS et code de CALENDRIER_TYPES, tenus à jour en arrière-plan
+# (les CALENDRIER_JOURS_PROCHES premiers jours plus souvent) et servis sans appel amont
+CALENDRIER_CABINETS = [c.strip() for c in os.getenv("CALENDRIER_CABINETS", "").split(",") if c.strip()]
+CALENDRIER_TYPES = [t.strip() for t in os.getenv("CALENDRIER_TYPES", "").split(",") if t.strip()]
+CALENDRIER_NOUVEAU_PATIENT = [v.strip() for v in os.getenv("CALENDRIER_NOUVEAU_PATIENT", "0").split(",") if v.strip()]
+CALENDRIER_SEMAINES = int(os.getenv("CALENDRIER_SEMAINES", "4"))
+CALENDRIER_JOURS_PROCHES = int(os.getenv("CALENDRIER_JOURS_PROCHES", "3"))
+CALENDRIER_RAFRAICHISSEMENT_PROCHE = float(os.getenv("CALENDRIER_RAFRAICHISSEMENT_PROCHE", "60"))
+CALENDRIER_RAFRAICHISSEMENT_LOINTAIN = float(os.getenv("CALENDRIER_RAFRAICHISSEMENT_LOINTAIN", "900"))
+# Au-delà de cet âge (rafraîchissements en échec), un jour n'est plus servi depuis le calendrier
+CALENDRIER_FRAICHEUR_MAX = float(os.getenv("CALENDRIER_FRAICHEUR_MAX", "1800"))
+CALENDRIER_MAX_CONCURRENCE = int(os.getenv("CALENDRIER_MAX_CONCURRENCE", "2"))
+
+# Nombre max d'appels simultanés lors de la récupération des RDV de plusieurs patients
+FANOUT_MAX_CONCURRENCE = int(os.getenv("FANOUT_MAX_CONCURRENCE", "4"))
+
+
+# Logs: niveau (DEBUG affiche les réponses brutes de l'API), format "texte" ou "json",
+# taille max des payloads affichés et proportion des logs DEBUG conservés
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "texte")
+LOG_PAYLOAD_MAX = int(os.getenv("LOG_PAYLOAD_MAX", "2000"))
+LOG_ECHANTILLON_DEBUG = float(os.getenv("LOG_ECHANTILLON_DEBUG", "1.0"))
+
+
+# ============== JSON ==============
+
+# orjson si installé (décodage des réponses rdvdentiste et encodage de nos réponses
+# nettement plus rapides sur les gros documents /schedules et listes de créneaux),
+# sinon module json standard
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_defaut(obj):
+    """Types non natifs JSON (mêmes conversions que jsonable_encoder pour nos réponses)"""
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    return str(obj)
+
+
+if orjson is not None:
+    JSON_BACKEND = "orjson"
+
+    def json_charger(contenu: bytes):
+        return orjson.loads(contenu)
+
+    def json_encoder(data) -> bytes:
+        return orjson.dumps(data, default=_json_defaut, option=orjson.OPT_NON_STR_KEYS)
+else:
+    JSON_BACKEND = "json"
+
+    def json_charger(contenu: bytes):
+        return json.loads(contenu)
+
+    def json_encoder(data) -> bytes:
+        return json.dumps(data, default=_json_defaut, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class ReponseJsonRapide(JSONResponse):
+    """Réponse JSON encodée avec json_encoder (orjson si disponible)"""
+
+    def render(self, content) -> bytes:
+        return json_encoder(content)
+
+
+class RouteJsonRapide(APIRoute):
+    """
+    Route dont les résultats dict / list sont renvoyés directement en ReponseJsonRapide,
+    sans passer par jsonable_encoder (qui reparcourt tout le résultat récursivement).
+    """
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        if asyncio.iscoroutinefunction(endpoint):
+            endpoint_original = endpoint
+
+            @functools.wraps(endpoint_original)
+            async def endpoint(*args, **kw):
+                resultat = await endpoint_original(*args, **kw)
+                if type(resultat) in (dict, list):
+                    return ReponseJsonRapide(resultat)
+                return resultat
+
+        super().__init__(path, endpoint, **kwargs)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Démarrage / arrêt de l'application"""
+    demarrer_logs()
+    await rdv_annules.demarrer()
+    await synchro_partage.demarrer()
+    reconciliation_annulations.demarrer()
+    cabinets.demarrer()
+    if PRECHAUFFAGE_BLOQUANT:
+        await prechauffer(PRECHAUFFAGE_CABINETS)
+    else:
+        asyncio.create_task(prechauffer(PRECHAUFFAGE_CABINETS))
+    calendrier.demarrer()
+    yield
+    await calendrier.arreter()
+    await cabinets.arreter()
+    await reconciliation_annulations.arreter()
+    await synchro_partage.arreter()
+    await rdv_annules.arreter()
+    await fermer_clients_http()
+    arreter_logs()
+
+
 app = FastAPI(
     title="Secrétaire IA Dentiste",
     description="Middleware pour connecter Synthflow à l'API rdvdentiste.net",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan,
+    default_response_class=ReponseJsonRapide
 )
+app.router.route_class = RouteJsonRapide
+
+# ============== LOGS ==============
+
+class apercu:
+    """
+    Représentation tronquée d'un payload, calculée seulement si le log est émis.
+
+    logger.debug("Réponse: %s", apercu(result)) ne construit rien quand DEBUG est désactivé.
+    """
+
+    __slots__ = ("valeur", "taille_max")
+
+    def __init__(self, valeur, taille_max: Optional[int] = None):
+        self.valeur = valeur
+        self.taille_max = LOG_PAYLOAD_MAX if taille_max is None else taille_max
+
+    def __str__(self) -> str:
+        texte = str(self.valeur)
+        if len(texte) > self.taille_max:
+            return f"{texte[:self.taille_max]}… (+{len(texte) - self.taille_max} caractères)"
+        return texte
+
+    __repr__ = __str__
+
+
+class FiltreEchantillonnage(logging.Filter):
+    """Ne conserve qu'une proportion des logs DEBUG (les autres niveaux passent tous)"""
+
+    def __init__(self, proportion: float):
+        super().__init__()
+        self.proportion = proportion
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.proportion >= 1.0:
+            return True
+        return random.random() < self.proportion
+
+
+class FormatJson(logging.Formatter):
+    """Une ligne JSON par log: horodatage, niveau, tag ([TAG] en début de message), message"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        tag = None
+        if message.startswith("[") and "] " in message:
+            tag, message = message[1:].split("] ", 1)
+        return json.dumps({
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "niveau": record.levelname,
+            "tag": tag,
+            "message": message
+        }, ensure_ascii=False, default=str)
+
+
+logger = logging.getLogger("secretaire")
+logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+logger.propagate = False
+
+# Les logs sont mis en file par la requête (QueueHandler) et écrits par un thread
+# dédié (QueueListener): l'écriture sur stdout ne bloque jamais la boucle d'événements
+_file_logs: queue.SimpleQueue = queue.SimpleQueue()
+_handler_file = logging.handlers.QueueHandler(_file_logs)
+_handler_file.addFilter(FiltreEchantillonnage(LOG_ECHANTILLON_DEBUG))
+logger.addHandler(_handler_file)
+
+_handler_sortie = logging.StreamHandler(sys.stdout)
+_handler_sortie.setFormatter(
+    FormatJson() if LOG_FORMAT == "json" else logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+)
+_ecouteur_logs: Optional[logging.handlers.QueueListener] = None
+
+
+def demarrer_logs():
+    """Démarre le thread d'écriture des logs (sans effet s'il tourne déjà)"""
+    global _ecouteur_logs
+    if _ecouteur_logs is None:
+        _ecouteur_logs = logging.handlers.QueueListener(_file_logs, _handler_sortie)
+        _ecouteur_logs.start()
+
+
+def arreter_logs():
+    """Vide la file de logs et arrête le thread d'écriture"""
+    global _ecouteur_logs
+    if _ecouteur_logs is not None:
+        _ecouteur_logs.stop()
+        _ecouteur_logs = None
+
+
+demarrer_logs()
+
+
+# ============== MÉTRIQUES (format texte Prometheus) ==============
+
+BUCKETS_LATENCE = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _labels(noms: tuple, valeurs: tuple) -> str:
+    if not noms:
+        return ""
+    paires = ",".join(
+        f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for n, v in zip(noms, valeurs)
+    )
+    return "{" + paires + "}"
+
+
+class Compteur:
+    def __init__(self, nom: str, aide: str, labels: tuple = (), type_: str = "counter"):
+        self.nom, self.aide, self.labels, self.type_ = nom, aide, labels, type_
+        self.valeurs: dict = {}
+
+    def inc(self, *valeurs_labels, valeur: float = 1):
+        self.valeurs[valeurs_labels] = self.valeurs.get(valeurs_labels, 0) + valeur
+
+    def dec(self, *valeurs_labels):
+        self.inc(*valeurs_labels, valeur=-1)
+
+    def exporter(self) -> List[str]:
+        lignes = [f"# HELP {self.nom} {self.aide}", f"# TYPE {self.nom} {self.type_}"]
+        for valeurs_labels, valeur in self.valeurs.items():
+            lignes.append(f"{self.nom}{_labels(self.labels, valeurs_labels)} {valeur}")
+        return lignes
+
+
+class Histogramme:
+    def __init__(self, nom: str, aide: str, labels: tuple = (), buckets: tuple = BUCKETS_LATENCE):
+        self.nom, self.aide, self.labels, self.buckets = nom, aide, labels, buckets
+        self.series: dict = {}  # labels -> [compte par bucket..., dépassement, somme, total]
+
+    def observer(self, valeur: float, *valeurs_labels):
+        serie = self.series.get(valeurs_labels)
+        if serie is None:
+            serie = self.series[valeurs_labels] = [0] * (len(self.buckets) + 3)
+        serie[bisect_left(self.buckets, valeur)] += 1
+        serie[-2] += valeur
+        serie[-1] += 1
+
+    def exporter(self) -> List[str]:
+        lignes = [f"# HELP {self.nom} {self.aide}", f"# TYPE {self.nom} histogram"]
+        noms_le = self.labels + ("le",)
+        for valeurs_labels, serie in self.series.items():
+            cumul = 0
+            for borne, compte in zip(self.buckets, serie):
+                cumul += compte
+                lignes.append(f"{self.nom}_bucket{_labels(noms_le, valeurs_labels + (borne,))} {cumul}")
+            lignes.append(f"{self.nom}_bucket{_labels(noms_le, valeurs_labels + ('+Inf',))} {serie[-1]}")
+            lignes.append(f"{self.nom}_sum{_labels(self.labels, valeurs_labels)} {round(serie[-2], 6)}")
+            lignes.append(f"{self.nom}_count{_labels(self.labels, valeurs_labels)} {serie[-1]}")
+        return lignes
+
+
+METRIQUE_REQUETES = Histogramme(
+    "secretaire_requete_duree_secondes", "Durée des requêtes HTTP par route", ("route", "methode", "statut")
+)
+METRIQUE_REQUETES_EN_COURS = Compteur(
+    "secretaire_requetes_en_cours", "Requêtes HTTP en cours de traitement", type_="gauge"
+)
+METRIQUE_AMONT = Histogramme(
+    "secretaire_amont_duree_secondes", "Durée des appels à rdvdentiste.net par endpoint", ("endpoint", "methode")
+)
+METRIQUE_AMONT_STATUTS = Compteur(
+    "secretaire_amont_reponses_total", "Réponses de rdvdentiste.net par endpoint et statut", ("endpoint", "methode", "statut")
+)
+METRIQUE_AMONT_EN_COURS = Compteur(
+    "secretaire_amont_en_cours", "Appels à rdvdentiste.net en cours", type_="gauge"
+)
+METRIQUE_CRENEAUX_FILTRES = Compteur(
+    "secretaire_creneaux_filtres_total", "Créneaux écartés car hors plages horaires", ("categorie",)
+)
+
+_RE_SEGMENTS_ENDPOINT = [
+    (re.compile(r"^/patients/[^/]+/appointments"), "/patients/{patient}/appointments"),
+    (re.compile(r"^/schedules/[^/]+/slots/[^/]+/[^/]+/[^/]+/?$"), "/schedules/{praticien}/slots/{type}/{date}/{heure}/"),
+    (re.compile(r"^/schedules/[^/]+/slots/[^/]+/?$"), "/schedules/{praticien}/slots/{type}/"),
+    (re.compile(r"^/schedules/[^/]+/appointment-requests/[^/]+/?$"), "/schedules/{praticien}/appointment-requests/{rdv}/"),
+    (re.compile(r"^/schedules/[^/]+/appointments/[^/]+/?$"), "/schedules/{praticien}/appointments/{rdv}/"),
+    (re.compile(r"^/appointment-requests/[^/]+/?$"), "/appointment-requests/{rdv}/"),
+    (re.compile(r"^/appointments/[^/]+/?$"), "/appointments/{rdv}/"),
+]
+
+
+def modele_endpoint(endpoint: str) -> str:
+    """Remplace les identifiants d'un endpoint rdvdentiste par des variables (cardinalité bornée)"""
+    for motif, modele in _RE_SEGMENTS_ENDPOINT:
+        if motif.match(endpoint):
+            return modele
+    return endpoint
+
+
+class MiddlewareMetriques:
+    """Middleware ASGI: durée, statut et nombre de requêtes en cours par route"""
+
+    def __init__(self, app):
+        self.app = app
+        self._routes: dict = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        statut = {"code": 500}
+
+        async def send_avec_statut(message):
+            if message["type"] == "http.response.start":
+                statut["code"] = message["status"]
+            await send(message)
+
+        debut = time.monotonic()
+        METRIQUE_REQUETES_EN_COURS.inc()
+        try:
+            await self.app(scope, receive, send_avec_statut)
+        finally:
+            METRIQUE_REQUETES_EN_COURS.dec()
+            METRIQUE_REQUETES.observer(
+                time.monotonic() - debut, self._route(scope), scope["method"], statut["code"]
+            )
+
+    def _route(self, scope) -> str:
+        # Le routeur ajoute "endpoint" au scope: on retrouve le chemin déclaré (/annulations/{rdv_id})
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "inconnue"
+        route = self._routes.get(endpoint)
+        if route is None:
+            route = next((r.path for r in app.routes if getattr(r, "endpoint", None) is endpoint), "inconnue")
+            self._routes[endpoint] = route
+        return route
+
+
+# ============== ÉTAT PARTAGÉ ENTRE WORKERS ==============
+
+# Base SQLite (mode WAL) partagée par les workers uvicorn (--workers N) : RDV annulés,
+# catalogues /schedules, enregistrements d'idempotence, invalidations des caches et
+# calendrier des disponibilités. Vide = état propre au processus.
+ETAT_PARTAGE_DB = os.getenv("ETAT_PARTAGE_DB", "")
+# Période (secondes) de lecture, en arrière-plan, de ce que les autres workers ont écrit
+ETAT_PARTAGE_SYNCHRO = float(os.getenv("ETAT_PARTAGE_SYNCHRO", "0.5"))
+# Identifie ce worker dans l'état partagé (invalidations publiées, baux)
+IDENTIFIANT_WORKER = f"{os.getpid()}-{os.urandom(3).hex()}"
+
+
+class EtatPartage:
+    """
+    État commun à plusieurs processus, dans une base SQLite en mode WAL.
+
+    Une connexion par thread (les appels passent parfois par asyncio.to_thread),
+    en autocommit: chaque écriture est une transaction courte, les lectures ne
+    bloquent jamais les écritures des autres workers.
+    """
+
+    def __init__(self, chemin: str):
+        self.chemin = chemin
+        self._local = threading.local()
+
+    @property
+    def actif(self) -> bool:
+        return bool(self.chemin)
+
+    def _connexion(self) -> sqlite3.Connection:
+        connexion = getattr(self._local, "connexion", None)
+        if connexion is None:
+            connexion = sqlite3.connect(self.chemin, timeout=5, isolation_level=None, check_same_thread=False)
+            connexion.execute("PRAGMA journal_mode=WAL")
+            connexion.execute("PRAGMA synchronous=NORMAL")
+            connexion.executescript("""
+                CREATE TABLE IF NOT EXISTS rdv_annules (rdv_id TEXT PRIMARY KEY, date TEXT, ajoute TEXT);
+                CREATE TABLE IF NOT EXISTS catalogues (office_code TEXT PRIMARY KEY, data BLOB, charge_le REAL);
+                CREATE TABLE IF NOT EXISTS idempotence (cle TEXT PRIMARY KEY, reponse BLOB, cree_le REAL);
+                CREATE TABLE IF NOT EXISTS invalidations (id INTEGER PRIMARY KEY AUTOINCREMENT, cache TEXT,
+                    office_code TEXT, valeur TEXT, origine TEXT, cree_le REAL);
+                CREATE TABLE IF NOT EXISTS baux (nom TEXT PRIMARY KEY, detenteur TEXT, expire_le REAL);
+                CREATE TABLE IF NOT EXISTS calendrier (office_code TEXT, type_rdv TEXT, new_patient TEXT, date TEXT,
+                    slots BLOB, rafraichi_le REAL, maj_le REAL, PRIMARY KEY (office_code, type_rdv, new_patient, date));
+                CREATE INDEX IF NOT EXISTS calendrier_maj ON calendrier (maj_le);
+            """)
+            self._local.connexion = connexion
+        return connexion
+
+    # --- RDV annulés ---
+
+    def annulations_parmi(self, rdv_ids: List[str]) -> set:
+        marques = ",".join("?" * len(rdv_ids))
+        return {ligne[0] for ligne in self._connexion().execute(
+            f"SELECT rdv_id FROM rdv_annules WHERE rdv_id IN ({marques})", rdv_ids
+        )}
+
+    def annulation_ajouter(self, rdv_id: str, date_rdv: Optional[str], ajoute: str):
+        self._connexion().execute("INSERT OR REPLACE INTO rdv_annules VALUES (?, ?, ?)", (rdv_id, date_rdv, ajoute))
+
+    def annulations_importer(self, index: dict):
+        self._connexion().executemany(
+            "INSERT OR IGNORE INTO rdv_annules VALUES (?, ?, ?)",
+            [(rdv_id, meta.get("date"), meta.get("ajoute")) for rdv_id, meta in index.items()]
+        )
+
+    def annulations_purger(self, limite_date: str, limite_ajout: str) -> int:
+        return self._connexion().execute(
+            "DELETE FROM rdv_annules WHERE (date IS NOT NULL AND date < ?) OR (date IS NULL AND ajoute < ?)",
+            (limite_date, limite_ajout)
+        ).rowcount
+
+    # --- Catalogues (/schedules) ---
+
+    def catalogue_versions(self) -> dict:
+        """office_code -> horodatage (time.time) du dernier chargement ou de la dernière invalidation"""
+        return dict(self._connexion().execute("SELECT office_code, charge_le FROM catalogues"))
+
+    def catalogue_lire(self, office_code: str) -> Optional[tuple]:
+        """(réponse /schedules brute ou None si invalidé, horodatage)"""
+        ligne = self._connexion().execute(
+            "SELECT data, charge_le FROM catalogues WHERE office_code = ?", (office_code,)
+        ).fetchone()
+        if ligne is None:
+            return None
+        return (json_charger(ligne[0]) if ligne[0] is not None else None), ligne[1]
+
+    def catalogue_ecrire(self, office_code: str, raw, charge_le: float):
+        self._connexion().execute(
+            "INSERT OR REPLACE INTO catalogues VALUES (?, ?, ?)", (office_code, json_encoder(raw) if raw is not None else None, charge_le)
+        )
+
+    def catalogue_invalider(self, office_code: Optional[str]):
+        # Marqueur sans données: les autres workers abandonnent leur copie plus ancienne
+        if office_code is None:
+            self._connexion().execute("UPDATE catalogues SET data = NULL, charge_le = ?", (time.time(),))
+        else:
+            self.catalogue_ecrire(office_code, None, time.time())
+
+    # --- Idempotence ---
+
+    def idempotence_reserver(self, cle: str, intervalle: tuple, expire_avant: float, en_cours_avant: float) -> tuple:
+        """
+        (True, None) si la clé est réservée pour nous, sinon (False, réponse ou None si en cours).
+        Purge d'abord, dans l'intervalle de clés du registre, les réponses enregistrées avant
+        expire_avant et les réservations restées en cours depuis en_cours_avant.
+        """
+        connexion = self._connexion()
+        connexion.execute(
+            "DELETE FROM idempotence WHERE cle >= ? AND cle < ? AND ((reponse IS NOT NULL AND cree_le < ?) OR cree_le < ?)",
+            (*intervalle, expire_avant, en_cours_avant)
+        )
+        if connexion.execute("INSERT OR IGNORE INTO idempotence VALUES (?, NULL, ?)", (cle, time.time())).rowcount:
+            return True, None
+        ligne = connexion.execute("SELECT reponse FROM idempotence WHERE cle = ?", (cle,)).fetchone()
+        return False, (json_charger(ligne[0]) if ligne and ligne[0] is not None else None)
+
+    def idempotence_enregistrer(self, cle: str, reponse: dict):
+        self._connexion().execute(
+            "UPDATE idempotence SET reponse = ?, cree_le = ? WHERE cle = ?", (json_encoder(reponse), time.time(), cle)
+        )
+
+    def idempotence_liberer(self, cle: str):
+        self._connexion().execute("DELETE FROM idempotence WHERE cle = ? AND reponse IS NULL", (cle,))
+
+    def idempotence_oublier(self, intervalle: tuple):
+        self._connexion().execute("DELETE FROM idempotence WHERE cle >= ? AND cle < ?", intervalle)
+
+    # --- Invalidations des caches locaux (disponibilités, patients) ---
+
+    def invalidations_dernier_id(self) -> int:
+        return self._connexion().execute("SELECT COALESCE(MAX(id), 0) FROM invalidations").fetchone()[0]
+
+    def synchroniser(self, a_publier: list, origine: str, dernier_id: int) -> tuple:
+        """
+        Publie nos invalidations [(cache, office_code, valeur, horodatage)], puis retourne
+        (invalidations des autres workers depuis dernier_id, nouveau dernier id, versions des catalogues)
+        """
+        connexion = self._connexion()
+        if a_publier:
+            connexion.executemany(
+                "INSERT INTO invalidations (cache, office_code, valeur, origine, cree_le) VALUES (?, ?, ?, ?, ?)",
+                [(cache, office_code, valeur, origine, quand) for cache, office_code, valeur, quand in a_publier]
+            )
+            connexion.execute("DELETE FROM invalidations WHERE cree_le < ?", (time.time() - 3600,))
+        lignes = connexion.execute(
+            "SELECT id, cache, office_code, valeur, origine, cree_le FROM invalidations WHERE id > ? ORDER BY id", (dernier_id,)
+        ).fetchall()
+        if lignes:
+            dernier_id = lignes[-1][0]
+        invalidations = [(cache, office_code, valeur, quand) for _, cache, office_code, valeur, auteur, quand in lignes if auteur != origine]
+        return invalidations, dernier_id, self.catalogue_versions()
+
+    # --- Baux: une tâche de fond assurée par un seul worker ---
+
+    def bail_prendre(self, nom: str, detenteur: str, duree: float) -> bool:
+        """Prend ou prolonge le bail (libre, expiré ou déjà à nous). True si nous le détenons"""
+        connexion = self._connexion()
+        maintenant = time.time()
+        if connexion.execute(
+            "UPDATE baux SET detenteur = ?, expire_le = ? WHERE nom = ? AND (detenteur = ? OR expire_le < ?)",
+            (detenteur, maintenant + duree, nom, detenteur, maintenant)
+        ).rowcount:
+            return True
+        return bool(connexion.execute("INSERT OR IGNORE INTO baux VALUES (?, ?, ?)", (nom, detenteur, maintenant + duree)).rowcount)
+
+    def bail_liberer(self, nom: str, detenteur: str):
+        self._connexion().execute("DELETE FROM baux WHERE nom = ? AND detenteur = ?", (nom, detenteur))
+
+    # --- Calendrier des disponibilités ---
+
+    def calendrier_ecrire(self, cle: tuple, jours: dict):
+        """jours: date ISO -> (créneaux bruts, rafraîchi le) pour la clé (office_code, type_rdv, new_patient)"""
+        connexion = self._connexion()
+        maintenant = time.time()
+        connexion.executemany(
+            "INSERT OR REPLACE INTO calendrier VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(*cle, jour, json_encoder(slots), rafraichi, maintenant) for jour, (slots, rafraichi) in jours.items()]
+        )
+        connexion.execute("DELETE FROM calendrier WHERE date < ?", (date_cls.today().isoformat(),))
+
+    def calendrier_depuis(self, maj_depuis: float) -> list:
+        """[(office_code, type_rdv, new_patient, date, créneaux, rafraîchi le, écrit le)] écrits depuis maj_depuis"""
+        return [
+            (office_code, type_rdv, new_patient, jour, json_charger(slots), rafraichi, maj)
+            for office_code, type_rdv, new_patient, jour, slots, rafraichi, maj in self._connexion().execute(
+                "SELECT * FROM calendrier WHERE maj_le >= ? ORDER BY maj_le", (maj_depuis,)
+            )
+        ]
+
+
+etat_partage = EtatPartage(ETAT_PARTAGE_DB)
+
+
+class SynchroPartage:
+    """
+    Échange périodique (hors boucle d'événements) avec les autres workers via l'état
+    partagé, pour que le chemin critique ne lise que la mémoire :
+    - invalidations des caches locaux (créneaux réservés / libérés, nouveaux patients):
+      publiées par le worker qui les fait, appliquées par les autres à la période suivante
+    - versions des catalogues: un catalogue plus récent n'est relu qu'à la demande
+    """
+
+    def __init__(self, partage: EtatPartage):
+        self.partage = partage
+        self.versions_catalogue: dict = {}  # office_code -> horodatage de la version partagée
+        self._a_publier: list = []  # [(cache, office_code, valeur, horodatage)]
+        self._dernier_id = 0
+        self._evenement: Optional[asyncio.Event] = None
+        self._tache: Optional[asyncio.Task] = None
+
+    def publier(self, cache: str, office_code: str, valeur: Optional[str]):
+        """Transmet une invalidation locale aux autres workers (envoyée par la tâche de fond, sans attendre)"""
+        if not self.partage.actif:
+            return
+        self._a_publier.append((cache, office_code, valeur, time.time()))
+        if self._evenement is not None:
+            self._evenement.set()
+
+    async def synchroniser(self):
+        a_publier, self._a_publier = self._a_publier, []
+        try:
+            invalidations, self._dernier_id, self.versions_catalogue = await asyncio.to_thread(
+                self.partage.synchroniser, a_publier, IDENTIFIANT_WORKER, self._dernier_id
+            )
+        except sqlite3.Error:
+            self._a_publier = a_publier + self._a_publier  # Nouvel essai à la période suivante
+            raise
+        for cache, office_code, valeur, quand in invalidations:
+            if cache == "disponibilites":
+                invalider_disponibilites(office_code, valeur, propager=False, quand=quand)
+            elif cache == "patients":
+                invalider_patients(office_code, valeur, propager=False)
+
+    async def _boucle(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._evenement.wait(), timeout=ETAT_PARTAGE_SYNCHRO)
+            except asyncio.TimeoutError:
+                pass
+            self._evenement.clear()
+            try:
+                await self.synchroniser()
+            except sqlite3.Error as e:
+                logger.warning("[ETAT_PARTAGE] Erreur de synchronisation: %s", e)
+
+    async def demarrer(self):
+        if not self.partage.actif:
+            if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+                logger.warning("[ETAT_PARTAGE] WEB_CONCURRENCY > 1 sans ETAT_PARTAGE_DB: caches et annulations propres à chaque worker")
+            return
+        self._evenement = asyncio.Event()
+        try:
+            # Les invalidations antérieures au démarrage ne concernent pas nos caches (vides)
+            self._dernier_id = await asyncio.to_thread(self.partage.invalidations_dernier_id)
+            await self.synchroniser()
+        except sqlite3.Error as e:
+            logger.warning("[ETAT_PARTAGE] Erreur de synchronisation: %s", e)
+        self._tache = asyncio.create_task(self._boucle())
+
+    async def arreter(self):
+        if self._tache is not None:
+            self._tache.cancel()
+            try:
+                await self._tache
+            except asyncio.CancelledError:
+                pass
+            self._tache = None
+            if self._a_publier:
+                try:
+                    await self.synchroniser()
+                except sqlite3.Error as e:
+                    logger.warning("[ETAT_PARTAGE] Erreur de synchronisation: %s", e)
+
+
+synchro_partage = SynchroPartage(etat_partage)
+
+
+# Idempotence de /creer_rdv: une réponse réussie est rejouée pendant IDEMPOTENCE_TTL secondes
+# pour la même en-tête Idempotency-Key. Sans en-tête, la clé patient + créneau ne couvre que
+# les doublons rapprochés (IDEMPOTENCE_TTL_SANS_CLE) et est oubliée dès l'annulation du RDV.
+# Un doublon reçu pendant le traitement attend la réponse de la première requête jusqu'à IDEMPOTENCE_ATTENTE.
+IDEMPOTENCE_TTL = float(os.getenv("IDEMPOTENCE_TTL", "600"))
+IDEMPOTENCE_TTL_SANS_CLE = float(os.getenv("IDEMPOTENCE_TTL_SANS_CLE", "10"))
+IDEMPOTENCE_ATTENTE = float(os.getenv("IDEMPOTENCE_ATTENTE", "15"))
+
+
+class RegistreIdempotence:
+    """
+    Réponses déjà envoyées par clé d'idempotence (état partagé si configuré, sinon en mémoire).
+
+    Les clés sont préfixées par le nom du registre: chaque registre purge les siennes avec
+    son propre ttl (compté depuis la réponse). Une réservation restée en cours (arrêt brutal)
+    est abandonnée après IDEMPOTENCE_TTL, quel que soit le registre.
+    """
+
+    def __init__(self, nom: str, partage: EtatPartage, ttl: float):
+        self.nom = nom
+        self.partage = partage
+        self.ttl = ttl
+        self._memoire: dict = {}  # clé -> (réponse ou None si en cours, horodatage)
+
+    def _cle(self, cle: str) -> str:
+        return f"{self.nom}:{cle}"
+
+    @staticmethod
+    def _intervalle(prefixe: str) -> tuple:
+        """Bornes [début, fin[ des clés commençant par prefixe (terminé par ':')"""
+        return prefixe, prefixe[:-1] + ";"
+
+    def _reserver_memoire(self, cle: str, expire_avant: float, en_cours_avant: float) -> tuple:
+        for c in [c for c, (reponse, horodatage) in self._memoire.items()
+                  if horodatage < (expire_avant if reponse is not None else en_cours_avant)]:
+            del self._memoire[c]
+        if cle not in self._memoire:
+            self._memoire[cle] = (None, time.time())
+            return True, None
+        return False, self._memoire[cle][0]
+
+    async def reserver(self, cle: str) -> tuple:
+        """
+        (True, None): la requête doit être traitée (clé réservée).
+        (False, réponse): réponse déjà envoyée pour cette clé.
+        (False, None): une requête identique est toujours en cours après IDEMPOTENCE_ATTENTE.
+        """
+        cle = self._cle(cle)
+        limite = time.monotonic() + IDEMPOTENCE_ATTENTE
+        while True:
+            expire_avant = time.time() - self.ttl
+            en_cours_avant = time.time() - max(self.ttl, IDEMPOTENCE_TTL)
+            if self.partage.actif:
+                reservee, reponse = await asyncio.to_thread(
+                    self.partage.idempotence_reserver, cle, self._intervalle(self._cle("")), expire_avant, en_cours_avant
+                )
+            else:
+                reservee, reponse = self._reserver_memoire(cle, expire_avant, en_cours_avant)
+            if reservee or reponse is not None or time.monotonic() >= limite:
+                return reservee, reponse
+            await asyncio.sleep(0.1)
+
+    async def enregistrer(self, cle: str, reponse: dict):
+        cle = self._cle(cle)
+        if self.partage.actif:
+            await asyncio.to_thread(self.partage.idempotence_enregistrer, cle, reponse)
+        else:
+            self._memoire[cle] = (reponse, time.time())
+
+    async def liberer(self, cle: str):
+        """La requête a échoué: un nouvel essai avec la même clé sera traité"""
+        cle = self._cle(cle)
+        if self.partage.actif:
+            await asyncio.to_thread(self.partage.idempotence_liberer, cle)
+        elif cle in self._memoire and self._memoire[cle][0] is None:
+            del self._memoire[cle]
+
+    async def oublier(self, prefixe: str):
+        """Oublie les clés commençant par prefixe (terminé par ':'), réponses enregistrées comprises"""
+        prefixe = self._cle(prefixe)
+        if self.partage.actif:
+            await asyncio.to_thread(self.partage.idempotence_oublier, self._intervalle(prefixe))
+        else:
+            for c in [c for c in self._memoire if c.startswith(prefixe)]:
+                del self._memoire[c]
+
+
+# En-tête Idempotency-Key / patient + créneau (sans en-tête)
+idempotence = RegistreIdempotence("cle", etat_partage, IDEMPOTENCE_TTL)
+idempotence_creneau = RegistreIdempotence("creneau", etat_partage, IDEMPOTENCE_TTL_SANS_CLE)
+
+
+def prefixe_creneau(office_code: str, date_rdv: Optional[str], heure: Optional[str]) -> str:
+    """Début de la clé d'idempotence sans en-tête: cabinet + créneau (heure normalisée en minutes)"""
+    minutes = heure_en_minutes(heure or "")
+    return f"{office_code}:{date_rdv}:{minutes if minutes is not None else heure}:"
 
-RDVDENTISTE_BASE_URL = "https://www.rdvdentiste.net/api"
-DEFAULT_OFFICE_CODE = os.getenv("RDVDENTISTE_OFFICE_CODE", "0501463005IMZDB742BK")
-DEFAULT_API_KEY = os.getenv("RDVDENTISTE_API_KEY", "DYND-457AD3+21ZDZX-sdm3ISX")
-DEFAULT_PRATICIEN_ID = "MC"
 
 # Fichier pour stocker les RDV annulés (car l'API rdvdentiste.net ne met pas à jour le statut)
 RDV_ANNULES_FILE = "/tmp/rdv_annules.json"
+# Journal append-only des annulations récentes, compacté périodiquement dans RDV_ANNULES_FILE
+RDV_ANNULES_JOURNAL = os.getenv("RDV_ANNULES_JOURNAL", RDV_ANNULES_FILE + ".journal")
+RDV_ANNULES_COMPACTION_SECONDES = float(os.getenv("RDV_ANNULES_COMPACTION_SECONDES", "3600"))
+RDV_ANNULES_COMPACTION_LIGNES = int(os.getenv("RDV_ANNULES_COMPACTION_LIGNES", "500"))
+# Un RDV passé depuis plus de N jours n'a plus besoin d'être masqué
+RDV_ANNULES_RETENTION_JOURS = int(os.getenv("RDV_ANNULES_RETENTION_JOURS", "7"))
+# Entrées sans date connue (ancien format du fichier): conservées N jours après leur ajout
+RDV_ANNULES_RETENTION_SANS_DATE_JOURS = int(os.getenv("RDV_ANNULES_RETENTION_SANS_DATE_JOURS", "365"))
 
 
-def charger_rdv_annules() -> set:
-    """Charge la liste des IDs de RDV annulés depuis le fichier"""
-    try:
-        if os.path.exists(RDV_ANNULES_FILE):
-            with open(RDV_ANNULES_FILE, "r") as f:
-                data = json.load(f)
-                return set(data.get("ids", []))
-    except Exception as e:
-        print(f"[RDV_ANNULES] Erreur lecture fichier: {e}")
-    return set()
+class StoreRdvAnnules:
+    """
+    Liste des RDV annulés localement, indexée en mémoire.
 
+    - Chargée une seule fois (instantané + rejeu du journal), lookup O(1)
+    - Les ajouts sont immédiatement visibles en mémoire puis écrits dans un
+      journal append-only par une tâche de fond (hors boucle d'événements)
+    - Compaction périodique: réécriture de l'instantané sans les RDV passés
+      et remise à zéro du journal
 
-def sauvegarder_rdv_annule(rdv_id: str):
-    """Ajoute un ID de RDV à la liste des annulés"""
-    try:
-        ids = charger_rdv_annules()
-        ids.add(rdv_id)
-        with open(RDV_ANNULES_FILE, "w") as f:
-            json.dump({"ids": list(ids), "updated": datetime.now().isoformat()}, f)
-        print(f"[RDV_ANNULES] RDV {rdv_id} ajouté à la liste des annulés")
-    except Exception as e:
-        print(f"[RDV_ANNULES] Erreur sauvegarde: {e}")
+    Avec un état partagé (ETAT_PARTAGE_DB), la liste vit dans SQLite pour que tous
+    les workers la voient: le fichier existant y est importé au démarrage et la
+    compaction se réduit à la purge des RDV passés.
+    """
+
+    def __init__(self, fichier: str, journal: str, partage: Optional[EtatPartage] = None):
+        self.fichier = fichier
+        self.journal = journal
+        self.partage = partage if partage is not None and partage.actif else None
+        self._index: dict = {}  # rdv_id -> {"date": "YYYY-MM-DD" | None, "ajoute": iso}
+        self._charge = False
+        self._en_attente: list = []
+        self._lignes_journal = 0
+        self._derniere_compaction = datetime.now()
+        self._evenement: Optional[asyncio.Event] = None
+        self._tache: Optional[asyncio.Task] = None
+
+    # --- Lecture ---
+
+    def charger(self):
+        """Charge l'instantané puis rejoue le journal (appelé une seule fois)"""
+        index = {}
+        try:
+            if os.path.exists(self.fichier):
+                with open(self.fichier, "r") as f:
+                    data = json.load(f)
+                maintenant = data.get("updated") or datetime.now().isoformat()
+                for rdv_id in data.get("ids", []):
+                    index[rdv_id] = {"date": None, "ajoute": maintenant}
+                index.update(data.get("rdvs", {}))
+        except Exception as e:
+            logger.warning("[RDV_ANNULES] Erreur lecture fichier: %s", e)
 
+        lignes = 0
+        try:
+            if os.path.exists(self.journal):
+                with open(self.journal, "r") as f:
+                    for ligne in f:
+                        try:
+                            entree = json.loads(ligne)
+                        except ValueError:
+                            continue  # Ligne tronquée (arrêt brutal pendant l'écriture)
+                        index[entree["id"]] = {"date": entree.get("date"), "ajoute": entree.get("ajoute")}
+                        lignes += 1
+        except Exception as e:
+            logger.warning("[RDV_ANNULES] Erreur lecture journal: %s", e)
+
+        self._index = index
+        self._lignes_journal = lignes
+        self._charge = True
+        logger.info("[RDV_ANNULES] %s RDV annulés chargés (%s entrées de journal)", len(index), lignes)
+
+    async def annules_parmi(self, rdv_ids: List[str]) -> set:
+        """RDV annulés parmi rdv_ids (une requête hors boucle avec l'état partagé)"""
+        rdv_ids = [rdv_id for rdv_id in rdv_ids if rdv_id]
+        if self.partage:
+            return await asyncio.to_thread(self.partage.annulations_parmi, rdv_ids) if rdv_ids else set()
+        if not self._charge:
+            self.charger()
+        return {rdv_id for rdv_id in rdv_ids if rdv_id in self._index}
+
+    # --- Écriture ---
+
+    async def enregistrer(self, rdv_id: str, date_rdv: Optional[str] = None):
+        """ajouter() depuis la boucle d'événements: l'écriture dans l'état partagé se fait hors boucle"""
+        if self.partage:
+            await asyncio.to_thread(self.ajouter, rdv_id, date_rdv)
+        else:
+            self.ajouter(rdv_id, date_rdv)
+
+    def ajouter(self, rdv_id: str, date_rdv: Optional[str] = None):
+        """Ajoute un RDV annulé: visible immédiatement, persisté en arrière-plan"""
+        if self.partage:
+            self.partage.annulation_ajouter(rdv_id, date_rdv, datetime.now().isoformat())
+            logger.info("[RDV_ANNULES] RDV %s ajouté à la liste des annulés (état partagé)", rdv_id)
+            return
+        if not self._charge:
+            self.charger()
+        entree = {"id": rdv_id, "date": date_rdv, "ajoute": datetime.now().isoformat()}
+        self._index[rdv_id] = {"date": date_rdv, "ajoute": entree["ajoute"]}
+        self._en_attente.append(json.dumps(entree) + "\n")
+        if not self._demarrer_ecriture():
+            # Pas de boucle d'événements (script, shell): écriture directe
+            self._ecrire_journal(self._prendre_en_attente())
+        logger.info("[RDV_ANNULES] RDV %s ajouté à la liste des annulés", rdv_id)
+
+    def _prendre_en_attente(self) -> list:
+        lignes, self._en_attente = self._en_attente, []
+        return lignes
+
+    def _ecrire_journal(self, lignes: list):
+        if not lignes:
+            return
+        try:
+            with open(self.journal, "a") as f:
+                f.writelines(lignes)
+                f.flush()
+            self._lignes_journal += len(lignes)
+        except Exception as e:
+            logger.warning("[RDV_ANNULES] Erreur écriture journal: %s", e)
+
+    @staticmethod
+    def _limites_retention() -> tuple:
+        limite_date = (datetime.now() - timedelta(days=RDV_ANNULES_RETENTION_JOURS)).strftime("%Y-%m-%d")
+        limite_ajout = (datetime.now() - timedelta(days=RDV_ANNULES_RETENTION_SANS_DATE_JOURS)).isoformat()
+        return limite_date, limite_ajout
+
+    def _purger(self):
+        """Retire les RDV dont la date est passée depuis plus que la rétention"""
+        limite_date, limite_ajout = self._limites_retention()
+
+        def a_conserver(meta: dict) -> bool:
+            if meta.get("date"):
+                return meta["date"] >= limite_date
+            return (meta.get("ajoute") or "9999") >= limite_ajout
+
+        avant = len(self._index)
+        self._index = {rdv_id: meta for rdv_id, meta in self._index.items() if a_conserver(meta)}
+        if avant != len(self._index):
+            logger.info("[RDV_ANNULES] %s RDV passés purgés", avant - len(self._index))
+
+    def _ecrire_instantane(self, index: dict) -> bool:
+        """Réécrit l'instantané de façon atomique et vide le journal (index = copie, appelé hors boucle)"""
+        data = {
+            "ids": list(index),
+            "rdvs": index,
+            "updated": datetime.now().isoformat()
+        }
+        try:
+            tmp = self.fichier + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.fichier)
+            open(self.journal, "w").close()
+            return True
+        except Exception as e:
+            logger.warning("[RDV_ANNULES] Erreur compaction: %s", e)
+            return False
+
+    async def _compacter(self):
+        """Purge sur la boucle (l'index n'est modifié que là), puis écriture d'une copie dans un thread"""
+        self._purger()
+        if await asyncio.to_thread(self._ecrire_instantane, dict(self._index)):
+            self._lignes_journal = 0
+        self._derniere_compaction = datetime.now()
+
+    def _compaction_due(self) -> bool:
+        if self._lignes_journal >= RDV_ANNULES_COMPACTION_LIGNES:
+            return True
+        return (datetime.now() - self._derniere_compaction).total_seconds() >= RDV_ANNULES_COMPACTION_SECONDES
 
-def est_rdv_annule(rdv_id: str) -> bool:
-    """Vérifie si un RDV est dans la liste des annulés"""
-    return rdv_id in charger_rdv_annules()
+    # --- Tâche de fond ---
+
+    def _demarrer_ecriture(self) -> bool:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        if self._evenement is None or self._tache is None or self._tache.done():
+            self._evenement = asyncio.Event()
+            self._tache = loop.create_task(self._boucle_ecriture())
+        self._evenement.set()
+        return True
+
+    def _importer_dans_partage(self):
+        """Importe l'instantané et le journal locaux (passage à l'état partagé)"""
+        self.charger()
+        if self._index:
+            self.partage.annulations_importer(self._index)
+            logger.info("[RDV_ANNULES] %s RDV importés dans l'état partagé", len(self._index))
+        self._index = {}
+
+    def _purger_partage(self):
+        nb = self.partage.annulations_purger(*self._limites_retention())
+        if nb:
+            logger.info("[RDV_ANNULES] %s RDV passés purgés (état partagé)", nb)
+
+    async def _boucle_purge_partage(self):
+        while True:
+            await asyncio.sleep(RDV_ANNULES_COMPACTION_SECONDES)
+            try:
+                await asyncio.to_thread(self._purger_partage)
+            except Exception as e:
+                logger.warning("[RDV_ANNULES] Erreur purge état partagé: %s", e)
+
+    async def _boucle_ecriture(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._evenement.wait(), timeout=RDV_ANNULES_COMPACTION_SECONDES)
+            except asyncio.TimeoutError:
+                pass
+            self._evenement.clear()
+            lignes = self._prendre_en_attente()
+            if lignes:
+                await asyncio.to_thread(self._ecrire_journal, lignes)
+            if self._compaction_due():
+                await self._compacter()
+
+    async def demarrer(self):
+        """Chargement au démarrage de l'application"""
+        if self.partage:
+            await asyncio.to_thread(self._importer_dans_partage)
+            self._tache = asyncio.create_task(self._boucle_purge_partage())
+            return
+        await asyncio.to_thread(self.charger)
+        self._demarrer_ecriture()
+
+    async def arreter(self):
+        """Écrit les annulations en attente et compacte avant l'arrêt"""
+        if self._tache is not None:
+            self._tache.cancel()
+            try:
+                await self._tache
+            except asyncio.CancelledError:
+                pass
+            self._tache = None
+        if self._charge and not self.partage:
+            await asyncio.to_thread(self._ecrire_journal, self._prendre_en_attente())
+            await self._compacter()
+
+
+rdv_annules = StoreRdvAnnules(RDV_ANNULES_FILE, RDV_ANNULES_JOURNAL, etat_partage)
+
+
+async def marquer_rdv_annule(rdv: dict, office_code: str):
+    """
+    Enregistre l'annulation localement, libère le créneau dans le cache des disponibilités
+    et oublie la réservation de ce créneau (une nouvelle demande sera vraiment réservée)
+    """
+    await rdv_annules.enregistrer(rdv["id"], rdv.get("date"))
+    invalider_disponibilites(office_code, rdv.get("date"))
+    await idempotence_creneau.oublier(prefixe_creneau(office_code, rdv.get("date"), rdv.get("heure")))
 
 
 # ============== PLAGES HORAIRES PAR TYPE DE RDV ==============
@@ -155,67 +1200,327 @@ PLAGES_HORAIRES = {
 }
 
 
-def trouver_categorie_rdv(type_rdv_nom: str) -> str:
-    """Trouve la catégorie d'un type de RDV basé sur son nom"""
+def normaliser_nom_type(nom: str) -> str:
+    """Majuscules sans accents ("Détartrage" -> "DETARTRAGE")"""
+    decompose = unicodedata.normalize("NFKD", nom)
+    return "".join(c for c in decompose if not unicodedata.combining(c)).upper()
+
+
+def compiler_mots_cles(plages_horaires: dict):
+    """
+    Compile tous les mots-clés en une seule expression régulière.
+
+    Les alternatives sont rangées par ordre de priorité (ordre des catégories puis
+    des mots-clés) et le lookahead permet de trouver des correspondances qui se
+    chevauchent: à chaque position, la première alternative qui correspond est la
+    plus prioritaire.
+    """
+    mots_cles = []
+    categorie_par_mot = {}
+    for categorie, config in plages_horaires.items():
+        for mot_cle in config["mots_cles"]:
+            mot = normaliser_nom_type(mot_cle)
+            if mot not in categorie_par_mot:
+                categorie_par_mot[mot] = (len(mots_cles), categorie)
+                mots_cles.append(mot)
+    motif = re.compile("(?=(" + "|".join(re.escape(m) for m in mots_cles) + "))")
+    return motif, categorie_par_mot
+
+
+CATEGORIE_CACHE_TAILLE = int(os.getenv("CATEGORIE_CACHE_TAILLE", "2048"))
+
+
+# Plages compilées: catégorie -> 7 jours -> (débuts, fins) en minutes depuis minuit, triés et fusionnés.
+# Un créneau est vérifié par une recherche dichotomique + une comparaison d'entiers.
+
+
+def heure_en_minutes(heure: str) -> Optional[int]:
+    """Convertit "HH:MM", "HHMM" ou "HHhMM" (heure sur 1 ou 2 chiffres) en minutes depuis minuit (None si invalide)"""
+    if not heure:
+        return None
+    h = heure.replace(":", "").replace("h", "")
+    if not h.isdigit() or not 3 <= len(h) <= 4:
+        return None
+    heures, minutes = divmod(int(h), 100)  # "930" / "9h30" -> 9h30
+    if heures > 23 or minutes > 59:
+        return None
+    return heures * 60 + minutes
+
+
+def normaliser_heure(heure: str) -> Optional[str]:
+    """Heure acceptée par heure_en_minutes -> "HHMM" attendu par l'API (None si invalide)"""
+    minutes = heure_en_minutes(heure)
+    if minutes is None:
+        return None
+    return "%02d%02d" % divmod(minutes, 60)
+
+
+def compiler_plages(plages_horaires: dict) -> dict:
+    """Compile des plages horaires (format PLAGES_HORAIRES) en tables d'intervalles [début, fin] (bornes incluses) par jour"""
+    compilees = {}
+    for categorie, config in plages_horaires.items():
+        jours = []
+        for jour in range(7):
+            intervalles = sorted(
+                (heure_en_minutes(debut), heure_en_minutes(fin))
+                for debut, fin in config["plages"].get(jour, [])
+            )
+            # Fusionner les plages qui se chevauchent ou se touchent
+            fusion = []
+            for debut, fin in intervalles:
+                if fusion and debut <= fusion[-1][1]:
+                    fusion[-1][1] = max(fusion[-1][1], fin)
+                else:
+                    fusion.append([debut, fin])
+            jours.append(([d for d, _ in fusion], [f for _, f in fusion]))
+        compilees[categorie] = tuple(jours)
+    return compilees
+
+
+class ConfigCabinet:
+    """
+    Règles d'un cabinet compilées une seule fois: praticien, code -> catégorie,
+    expression régulière des mots-clés et tables d'intervalles par jour, et clé
+    d'API propre au cabinet (None: RDVDENTISTE_API_KEY).
+
+    Immuable: un rechargement de la configuration construit de nouvelles instances.
+    """
+
+    def __init__(self, praticien: str, code_to_categorie: dict, plages_horaires: dict, api_key: Optional[str] = None):
+        self.praticien = praticien
+        self.api_key = api_key
+        self.code_to_categorie = code_to_categorie
+        self.plages_horaires = plages_horaires
+        self.motif_mots_cles, self.categorie_par_mot_cle = compiler_mots_cles(plages_horaires)
+        self.plages_compilees = compiler_plages(plages_horaires)
+        self.categorie_par_nom = lru_cache(maxsize=CATEGORIE_CACHE_TAILLE)(self._categorie_par_nom)
+
+    def _categorie_par_nom(self, type_rdv_nom: str) -> Optional[str]:
+        if not self.categorie_par_mot_cle:
+            return None
+        meilleure = None
+        for correspondance in self.motif_mots_cles.finditer(normaliser_nom_type(type_rdv_nom)):
+            priorite, categorie = self.categorie_par_mot_cle[correspondance.group(1)]
+            if meilleure is None or priorite < meilleure[0]:
+                meilleure = (priorite, categorie)
+                if priorite == 0:
+                    break
+        return meilleure[1] if meilleure else None
+
+    def est_dans_plages(self, categorie: str, jour: int, minutes: int) -> bool:
+        debuts, fins = self.plages_compilees[categorie][jour]
+        i = bisect_right(debuts, minutes) - 1
+        return i >= 0 and minutes <= fins[i]
+
+
+# Règles des cabinets sans configuration propre (voir CABINETS_CONFIG_FILE)
+CONFIG_DEFAUT = ConfigCabinet(DEFAULT_PRATICIEN_ID, CODE_TO_CATEGORIE, PLAGES_HORAIRES)
+
+
+def trouver_categorie_rdv(type_rdv_nom: str, config: Optional[ConfigCabinet] = None) -> str:
+    """Trouve la catégorie d'un type de RDV basé sur son nom (règles du cabinet, sinon par défaut)"""
     if not type_rdv_nom:
         return None
 
-    type_upper = type_rdv_nom.upper()
+    return (config or CONFIG_DEFAUT).categorie_par_nom(type_rdv_nom)  # None si type non trouvé dans le mapping
 
-    for categorie, config in PLAGES_HORAIRES.items():
-        for mot_cle in config["mots_cles"]:
-            if mot_cle in type_upper:
-                return categorie
 
-    return None  # Type non trouvé dans le mapping
+@lru_cache(maxsize=1024)
+def jour_semaine(date_str: str) -> int:
+    """Jour de la semaine d'une date YYYY-MM-DD (0=Lundi, 6=Dimanche). Lève ValueError si invalide"""
+    return date_cls.fromisoformat(date_str).weekday()
+
 
+def est_dans_plages(categorie: str, jour: int, minutes: int, config: Optional[ConfigCabinet] = None) -> bool:
+    """Vérifie si l'heure (en minutes) tombe dans une plage autorisée de la catégorie pour ce jour"""
+    return (config or CONFIG_DEFAUT).est_dans_plages(categorie, jour, minutes)
 
-def est_creneau_autorise(type_rdv_nom: str, date_str: str, heure_str: str) -> bool:
+
+def est_creneau_autorise(
+    type_rdv_nom: str, date_str: str, heure_str: str, config: Optional[ConfigCabinet] = None
+) -> bool:
     """
     Vérifie si un créneau est autorisé pour un type de RDV donné.
 
     Args:
         type_rdv_nom: Nom du type de RDV (ex: "URGENCE", "CONSULTATION")
         date_str: Date au format YYYY-MM-DD
-        heure_str: Heure au format HH:MM ou HHMM
+        heure_str: Heure au format HH:MM, HHMM ou HHhMM
+        config: Règles du cabinet (par défaut CONFIG_DEFAUT)
 
     Returns:
         True si le créneau est autorisé, False sinon
     """
-    categorie = trouver_categorie_rdv(type_rdv_nom)
+    config = config or CONFIG_DEFAUT
+    categorie = trouver_categorie_rdv(type_rdv_nom, config)
 
     if not categorie:
         # Type inconnu, on autorise par défaut
-        print(f"[PLAGES] Type '{type_rdv_nom}' non mappé, créneau autorisé par défaut")
+        logger.info("[PLAGES] Type '%s' non mappé, créneau autorisé par défaut", type_rdv_nom)
         return True
 
     # Parser la date pour obtenir le jour de la semaine
     try:
-        date_obj = datetime.strptime(date_str, "%Y-%m-%d")
-        jour_semaine = date_obj.weekday()  # 0=Lundi, 6=Dimanche
+        jour = jour_semaine(date_str)
     except ValueError:
-        print(f"[PLAGES] Date invalide: {date_str}")
+        logger.info("[PLAGES] Date invalide: %s", date_str)
         return True  # En cas d'erreur, on autorise
 
-    # Normaliser l'heure en HH:MM
-    if len(heure_str) == 4 and ":" not in heure_str:
-        heure_str = f"{heure_str[:2]}:{heure_str[2:]}"
+    minutes = heure_en_minutes(heure_str)
+    if minutes is None:
+        # Heure illisible: impossible de vérifier les plages, on refuse
+        logger.info("[PLAGES] Heure invalide: %s", heure_str)
+        return False
 
     # Vérifier si le jour est autorisé
-    plages_jour = PLAGES_HORAIRES[categorie]["plages"].get(jour_semaine)
-    if not plages_jour:
-        print(f"[PLAGES] {type_rdv_nom} -> {categorie}: jour {jour_semaine} non autorisé")
+    if not config.plages_compilees[categorie][jour][0]:
+        logger.info("[PLAGES] %s -> %s: jour %s non autorisé", type_rdv_nom, categorie, jour)
         return False
 
     # Vérifier si l'heure est dans une des plages
-    for debut, fin in plages_jour:
-        if debut <= heure_str <= fin:
-            return True
+    if config.est_dans_plages(categorie, jour, minutes):
+        return True
 
-    print(f"[PLAGES] {type_rdv_nom} -> {categorie}: heure {heure_str} hors plages {plages_jour}")
+    logger.info("[PLAGES] %s -> %s: heure %s hors plages %s", type_rdv_nom, categorie, heure_str, config.plages_horaires[categorie]['plages'].get(jour))
     return False
 
 
+# ============== CONFIGURATION PAR CABINET ==============
+
+# Fichier JSON des règles par cabinet (praticien, codes -> catégorie, plages horaires),
+# relu à chaud quand il est modifié. Format :
+#   {"defaut": {...}, "cabinets": {"<Office Code>": {"praticien": "MC",
+#     "codes": {"27": "CONSULTATION_URGENCE_BILAN"},
+#     "plages": {"CONSULTATION_URGENCE_BILAN": {"mots_cles": ["CONSULTATION"], "plages": {"0": [["09:30", "14:00"]]}},
+#     "api_key_env": "RDVDENTISTE_API_KEY_CABINET2"}}}
+# Une clé absente reprend la valeur de "defaut", elle-même complétée par les règles codées ci-dessus.
+# "api_key_env" nomme la variable d'environnement qui contient la clé d'API du cabinet (X-Api-Key),
+# utilisée quand la requête n'en fournit pas, et par le préchauffage et le calendrier.
+CABINETS_CONFIG_FILE = os.getenv("CABINETS_CONFIG_FILE", "")
+CABINETS_CONFIG_VERIFICATION = float(os.getenv("CABINETS_CONFIG_VERIFICATION", "10"))
+
+
+def _plages_depuis_json(plages: dict) -> dict:
+    """Plages au format JSON (jours "0".."6", listes) -> format PLAGES_HORAIRES, heures validées"""
+    resultat = {}
+    for categorie, conf in plages.items():
+        jours = {}
+        for jour, horaires in conf.get("plages", {}).items():
+            if not 0 <= int(jour) <= 6:
+                raise ValueError(f"{categorie}: jour {jour} invalide (0=Lundi ... 6=Dimanche)")
+            intervalles = []
+            for debut, fin in horaires:
+                if heure_en_minutes(debut) is None or heure_en_minutes(fin) is None:
+                    raise ValueError(f"{categorie}: plage {debut}-{fin} invalide")
+                intervalles.append((debut, fin))
+            jours[int(jour)] = intervalles
+        resultat[categorie] = {"mots_cles": list(conf.get("mots_cles", [])), "plages": jours}
+    return resultat
+
+
+def compiler_config_cabinet(conf: dict, base: ConfigCabinet) -> ConfigCabinet:
+    """Compile la configuration JSON d'un cabinet, les clés absentes reprenant celles de base"""
+    plages = _plages_depuis_json(conf["plages"]) if "plages" in conf else base.plages_horaires
+    codes = {str(code): cat for code, cat in conf["codes"].items()} if "codes" in conf else base.code_to_categorie
+    inconnues = set(codes.values()) - set(plages)
+    if inconnues:
+        raise ValueError(f"catégories sans plages horaires: {sorted(inconnues)}")
+    api_key = base.api_key
+    if "api_key_env" in conf:
+        api_key = os.getenv(conf["api_key_env"])
+        if not api_key:
+            raise ValueError(f"variable d'environnement {conf['api_key_env']} absente (api_key_env)")
+    return ConfigCabinet(conf.get("praticien", base.praticien), codes, plages, api_key)
+
+
+class RegistreCabinets:
+    """
+    Configuration compilée par cabinet (X-Office-Code), avec repli sur la configuration par défaut.
+
+    Le fichier est relu quand sa date de modification change: toute la table est
+    compilée puis remplace l'ancienne en une seule affectation (une requête en cours
+    garde la version qu'elle a lue). Un fichier invalide est ignoré et la version
+    précédente conservée.
+    """
+
+    def __init__(self, fichier: str, defaut: ConfigCabinet):
+        self.fichier = fichier
+        self.base = defaut
+        self._table = (defaut, {})  # (configuration par défaut, office_code -> ConfigCabinet)
+        self._mtime = None
+        self.generation = 0
+        self._tache: Optional[asyncio.Task] = None
+
+    def pour(self, office_code: Optional[str]) -> ConfigCabinet:
+        defaut, configs = self._table
+        return configs.get(office_code, defaut)
+
+    def cabinets(self) -> dict:
+        return dict(self._table[1])
+
+    def charger(self) -> bool:
+        """Relit le fichier s'il a changé. Retourne True si la configuration a été remplacée"""
+        if not self.fichier:
+            return False
+        try:
+            mtime = os.stat(self.fichier).st_mtime_ns
+        except OSError as e:
+            if self._mtime != "absent":
+                logger.warning("[CABINETS] Fichier %s illisible, configuration actuelle conservée: %s", self.fichier, e)
+                self._mtime = "absent"
+            return False
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+
+        try:
+            with open(self.fichier, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            defaut = compiler_config_cabinet(data.get("defaut", {}), self.base)
+            configs = {
+                office_code: compiler_config_cabinet(conf, defaut)
+                for office_code, conf in data.get("cabinets", {}).items()
+            }
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning("[CABINETS] Fichier %s invalide, configuration précédente conservée: %s", self.fichier, e)
+            return False
+
+        self._table = (defaut, configs)
+        self.generation += 1
+        logger.info("[CABINETS] Configuration chargée: %s cabinet(s) (génération %s)", len(configs), self.generation)
+        return True
+
+    async def _surveiller(self):
+        while True:
+            await asyncio.sleep(CABINETS_CONFIG_VERIFICATION)
+            try:
+                await asyncio.to_thread(self.charger)
+            except Exception as e:
+                logger.warning("[CABINETS] Erreur de rechargement: %r", e)
+
+    def demarrer(self):
+        if self.fichier and (self._tache is None or self._tache.done()):
+            self._tache = asyncio.create_task(self._surveiller())
+
+    async def arreter(self):
+        if self._tache is not None:
+            self._tache.cancel()
+            try:
+                await self._tache
+            except asyncio.CancelledError:
+                pass
+            self._tache = None
+
+
+cabinets = RegistreCabinets(CABINETS_CONFIG_FILE, CONFIG_DEFAUT)
+cabinets.charger()
+
+
+def cle_api_effective(office_code: str, api_key: Optional[str]) -> str:
+    """En-tête X-Api-Key de la requête, sinon clé du cabinet, sinon RDVDENTISTE_API_KEY"""
+    return api_key or cabinets.pour(office_code).api_key or DEFAULT_API_KEY
+
+
 # ============== FONCTIONS UTILITAIRES ==============
 
 def normaliser_telephone(telephone: str) -> str:
@@ -266,6 +1571,11 @@ def convertir_date(date_str: str) -> str:
     return date_str
 
 
+def est_variable_non_remplacee(valeur: Optional[str]) -> bool:
+    """Valeur vide ou variable Synthflow restée telle quelle (ex: "<date_rdv>", "{date}")"""
+    return not valeur or valeur.startswith("<") or valeur.startswith("{")
+
+
 def formater_heure(heure: str) -> str:
     """Formate une heure HHMM en HHhMM"""
     if len(heure) == 4:
@@ -273,8 +1583,456 @@ def formater_heure(heure: str) -> str:
     return heure
 
 
+# ============== CACHES EN MÉMOIRE ==============
+
+class CacheTTL:
+    """Cache clé -> valeur avec expiration, taille bornée (LRU) et compteurs hits/misses"""
+
+    def __init__(self, nom: str, ttl: float, taille_max: int = 1000):
+        self.nom = nom
+        self.ttl = ttl
+        self.taille_max = taille_max
+        self._entrees: OrderedDict = OrderedDict()  # cle -> (expire_le, valeur)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cle) -> Any:
+        entree = self._entrees.get(cle)
+        if entree is None:
+            self.misses += 1
+            return None
+        expire_le, valeur = entree
+        if time.monotonic() >= expire_le:
+            del self._entrees[cle]
+            self.misses += 1
+            return None
+        self._entrees.move_to_end(cle)
+        self.hits += 1
+        return valeur
+
+    def set(self, cle, valeur, ttl: Optional[float] = None):
+        self._entrees[cle] = (time.monotonic() + (self.ttl if ttl is None else ttl), valeur)
+        self._entrees.move_to_end(cle)
+        while len(self._entrees) > self.taille_max:
+            self._entrees.popitem(last=False)
+
+    def invalider(self, predicat: Callable[[Any], bool]) -> int:
+        """Supprime les entrées dont la clé vérifie le prédicat"""
+        cles = [cle for cle in self._entrees if predicat(cle)]
+        for cle in cles:
+            del self._entrees[cle]
+        return len(cles)
+
+    def vider(self):
+        self._entrees.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "ratio": round(self.hits / total, 3) if total else None,
+            "entrees": len(self._entrees),
+            "ttl_secondes": self.ttl
+        }
+
+
+class StatistiquesCache:
+    """Compteurs hits/misses d'un cache qui n'est pas un CacheTTL (catalogue, calendrier)"""
+
+    def __init__(self, nom: str):
+        self.nom = nom
+        self.hits = 0
+        self.misses = 0
+
+    def noter(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "ratio": round(self.hits / total, 3) if total else None}
+
+
+# (office_code, praticien, type_rdv, start, end, newPatient) -> réponse brute des créneaux
+cache_disponibilites = CacheTTL("disponibilites", DISPONIBILITES_CACHE_TTL, DISPONIBILITES_CACHE_TAILLE)
+
+
+def invalider_disponibilites(office_code: str, date: Optional[str], propager: bool = True, quand: Optional[float] = None) -> int:
+    """
+    Supprime les créneaux en cache du cabinet dont la période contient la date (toutes si date inconnue).
+    propager: transmettre aux autres workers (False pour une invalidation reçue d'eux, faite à l'instant quand)
+    """
+    nb = cache_disponibilites.invalider(
+        lambda cle: cle[0] == office_code and (not date or cle[3] <= date <= cle[4])
+    )
+    calendrier.invalider(office_code, date, quand)
+    if propager:
+        synchro_partage.publier("disponibilites", office_code, date)
+    if nb:
+        logger.info("[DISPONIBILITES] %s entrées de cache invalidées (cabinet %s, date %s)", nb, office_code, date)
+    return nb
+
+
+# (office_code, téléphone normalisé) -> liste de patients (liste vide = numéro inconnu)
+cache_patients = CacheTTL("patients", PATIENTS_CACHE_TTL, PATIENTS_CACHE_TAILLE)
+
+
+def invalider_patients(office_code: str, telephone: str, propager: bool = True) -> int:
+    """Oublie le résultat en cache pour ce numéro (ex: un nouveau patient vient d'être créé)"""
+    tel_normalise = normaliser_telephone(telephone)
+    if propager:
+        synchro_partage.publier("patients", office_code, tel_normalise)
+    return cache_patients.invalider(lambda cle: cle == (office_code, tel_normalise))
+
+
 # ============== CLIENT API RDVDENTISTE ==============
 
+# Clients HTTP partagés: un seul par process (ou un par cabinet si RDVDENTISTE_CLIENT_PAR_CABINET=1)
+_clients_http: dict = {}
+
+
+def _http2_disponible() -> bool:
+    """HTTP/2 nécessite le paquet optionnel 'h2'"""
+    if not HTTP_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        logger.warning("[HTTP] RDVDENTISTE_HTTP2=1 mais le paquet 'h2' est absent, repli sur HTTP/1.1")
+        return False
+
+
+def get_client_http(office_code: str) -> httpx.AsyncClient:
+    """Retourne le client HTTP partagé (créé à la demande, keep-alive activé)"""
+    cle = office_code if HTTP_CLIENT_PAR_CABINET else "_"
+    client = _clients_http.get(cle)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNEXIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+            ),
+            http2=_http2_disponible()
+        )
+        _clients_http[cle] = client
+    return client
+
+
+async def fermer_clients_http():
+    """Ferme proprement tous les clients HTTP partagés"""
+    clients = list(_clients_http.values())
+    _clients_http.clear()
+    for client in clients:
+        await client.aclose()
+
+
+# ----- Résilience: délais par classe, retries, hedging, disjoncteur -----
+
+MESSAGE_SERVICE_INDISPONIBLE = (
+    "Le système de rendez-vous du cabinet est momentanément indisponible. "
+    "Merci de rappeler dans quelques minutes."
+)
+
+
+class ServiceIndisponible(HTTPException):
+    """Levée sans appel amont quand le disjoncteur du cabinet est ouvert"""
+
+    def __init__(self):
+        super().__init__(status_code=503, detail=MESSAGE_SERVICE_INDISPONIBLE)
+
+
+def classe_endpoint(method: str, endpoint: str) -> str:
+    """Classe d'un endpoint rdvdentiste (délais et statistiques de latence)"""
+    if method == "DELETE":
+        return "annulation"
+    if endpoint.startswith("/patients/"):
+        return "patients" if endpoint.startswith("/patients/find") else "rdvs_patient"
+    if endpoint.rstrip("/") == "/schedules":
+        return "catalogue"
+    if "/slots/" in endpoint:
+        return "creneaux" if method == "GET" else "reservation"
+    return "autre"
+
+
+class ErreurAmontTransitoire(HTTPException):
+    """Échec de l'appel amont qui peut réussir en réessayant: 5xx de l'API, timeout, erreur réseau"""
+
+
+def est_erreur_transitoire(e: HTTPException) -> bool:
+    """Seules les erreurs de l'API ou du réseau comptent ; les 4xx et les erreurs locales (ex: JSON illisible) non"""
+    return isinstance(e, ErreurAmontTransitoire)
+
+
+class BudgetRetry:
+    """Chaque appel crédite RETRY_BUDGET_RATIO jeton, chaque nouvelle tentative en coûte un"""
+
+    def __init__(self, ratio: float, maximum: float):
+        self.ratio = ratio
+        self.maximum = maximum
+        self.jetons = maximum
+
+    def crediter(self):
+        self.jetons = min(self.maximum, self.jetons + self.ratio)
+
+    def prendre(self) -> bool:
+        if self.jetons >= 1:
+            self.jetons -= 1
+            return True
+        return False
+
+
+class Disjoncteur:
+    """
+    Disjoncteur d'un cabinet: fermé -> ouvert après DISJONCTEUR_SEUIL échecs
+    consécutifs -> semi-ouvert après DISJONCTEUR_DUREE (un seul appel d'essai).
+    """
+
+    def __init__(self):
+        self.echecs = 0
+        self.ouvert_jusqua = 0.0
+        self.essai_en_cours = False
+
+    @property
+    def etat(self) -> str:
+        if self.echecs < DISJONCTEUR_SEUIL:
+            return "ferme"
+        return "ouvert" if time.monotonic() < self.ouvert_jusqua else "semi_ouvert"
+
+    def autoriser(self) -> bool:
+        etat = self.etat
+        if etat == "ferme":
+            return True
+        if etat == "semi_ouvert" and not self.essai_en_cours:
+            self.essai_en_cours = True
+            return True
+        return False
+
+    def succes(self):
+        self.echecs = 0
+        self.essai_en_cours = False
+
+    def echec(self):
+        self.echecs += 1
+        self.essai_en_cours = False
+        if self.echecs >= DISJONCTEUR_SEUIL:
+            self.ouvert_jusqua = time.monotonic() + DISJONCTEUR_DUREE
+
+    def abandonner_essai(self):
+        """Appel d'essai interrompu (annulation, erreur locale): un autre appel pourra faire l'essai"""
+        self.essai_en_cours = False
+
+
+budget_retry = BudgetRetry(RETRY_BUDGET_RATIO, RETRY_BUDGET_MAX)
+disjoncteurs: dict = {}  # office_code -> Disjoncteur
+_latences_par_classe: dict = {}  # classe -> deque des dernières latences réussies (secondes)
+
+
+def noter_latence(classe: str, duree: float):
+    _latences_par_classe.setdefault(classe, deque(maxlen=200)).append(duree)
+
+
+def p95_latence(classe: str) -> Optional[float]:
+    """p95 des latences récentes de la classe (None tant qu'il y a trop peu de mesures)"""
+    latences = _latences_par_classe.get(classe)
+    if not latences or len(latences) < 20:
+        return None
+    return sorted(latences)[int(len(latences) * 0.95) - 1]
+
+
+class LimiteurCabinet:
+    """
+    Seau à jetons (débit + rafale) et nombre maximal d'appels simultanés pour un cabinet.
+
+    Les appels en attente sont servis dans l'ordre d'arrivée ; le temps passé en file
+    est mesuré pour repérer les cabinets qui saturent leur quota.
+    """
+
+    def __init__(self, rps: float, rafale: float, concurrence: int):
+        self.rps = rps
+        self.rafale = rafale
+        self.concurrence = concurrence
+        self.jetons = rafale
+        self._maj = time.monotonic()
+        self._verrou = asyncio.Lock()
+        self._semaphore = asyncio.Semaphore(max(1, concurrence))
+        self.en_attente = 0
+        self.appels = 0
+        self.attente_totale = 0.0
+        self.attente_max = 0.0
+
+    async def _prendre_jeton(self):
+        async with self._verrou:
+            maintenant = time.monotonic()
+            self.jetons = min(self.rafale, self.jetons + (maintenant - self._maj) * self.rps)
+            self._maj = maintenant
+            if self.jetons < 1:
+                await asyncio.sleep((1 - self.jetons) / self.rps)
+                self.jetons = 1.0
+                self._maj = time.monotonic()
+            self.jetons -= 1
+
+    @asynccontextmanager
+    async def reserver(self):
+        debut = time.monotonic()
+        self.en_attente += 1
+        try:
+            await self._semaphore.acquire()
+            try:
+                await self._prendre_jeton()
+            except BaseException:
+                self._semaphore.release()
+                raise
+        finally:
+            self.en_attente -= 1
+        attente = time.monotonic() - debut
+        self.appels += 1
+        self.attente_totale += attente
+        self.attente_max = max(self.attente_max, attente)
+        try:
+            yield attente
+        finally:
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "rps": self.rps,
+            "rafale": self.rafale,
+            "concurrence": self.concurrence,
+            "en_attente": self.en_attente,
+            "appels": self.appels,
+            "attente_moyenne_ms": round(self.attente_totale / self.appels * 1000, 1) if self.appels else 0,
+            "attente_max_ms": round(self.attente_max * 1000, 1)
+        }
+
+
+limiteurs: dict = {}  # office_code -> LimiteurCabinet
+
+
+def limiteur_cabinet(office_code: str) -> LimiteurCabinet:
+    limiteur = limiteurs.get(office_code)
+    if limiteur is None:
+        config = LIMITES_CABINETS.get(office_code, {})
+        limiteur = LimiteurCabinet(
+            float(config.get("rps", LIMITE_RPS)),
+            float(config.get("rafale", LIMITE_RAFALE)),
+            int(config.get("concurrence", LIMITE_CONCURRENCE))
+        )
+        limiteurs[office_code] = limiteur
+    return limiteur
+
+
+async def _tentative_mesuree(classe: str, *args) -> dict:
+    method, endpoint, office_code = args[:3]
+    async with limiteur_cabinet(office_code).reserver() as attente:
+        if attente >= LIMITE_ATTENTE_LOG:
+            logger.info("[LIMITES] Cabinet %s: %s %s en file d'attente %.0f ms", office_code, method, endpoint, attente * 1000)
+        debut = time.monotonic()
+        result = await _requete_rdvdentiste(*args)
+        noter_latence(classe, time.monotonic() - debut)
+        return result
+
+
+async def _get_avec_hedge(classe: str, args: tuple) -> dict:
+    """GET avec un second appel de secours si le premier dépasse le p95 de la classe"""
+    p95 = p95_latence(classe) if HEDGE_ACTIF else None
+    if p95 is None:
+        return await _tentative_mesuree(classe, *args)
+
+    taches = {asyncio.ensure_future(_tentative_mesuree(classe, *args))}
+    try:
+        termines, _ = await asyncio.wait(taches, timeout=max(p95, HEDGE_DELAI_MIN))
+        if not termines:
+            logger.info("[RESILIENCE] GET %s > p95 (%.0f ms), requête de secours", args[1], p95 * 1000)
+            taches.add(asyncio.ensure_future(_tentative_mesuree(classe, *args)))
+        erreur = None
+        while taches:
+            termines, taches = await asyncio.wait(taches, return_when=asyncio.FIRST_COMPLETED)
+            for tache in termines:
+                if tache.exception() is None:
+                    return tache.result()
+                erreur = tache.exception()
+        raise erreur
+    finally:
+        for tache in taches:
+            tache.cancel()
+
+
+async def _appel_resilient(
+    method: str,
+    endpoint: str,
+    office_code: str,
+    api_key: Optional[str],
+    params: Optional[dict],
+    json_data: Optional[dict],
+    allow_404: bool,
+    timeout: Optional[float]
+) -> dict:
+    """
+    Appel amont protégé:
+    - une seule échéance par appel (timeout imposé, sinon délai de la classe d'endpoint):
+      file d'attente du limiteur, tentatives, hedging et pauses entre tentatives compris
+    - disjoncteur par cabinet: échec immédiat (ServiceIndisponible) tant qu'il est ouvert
+    - GET uniquement: nouvelles tentatives avec jitter dans la limite du budget, hedging optionnel
+    """
+    classe = classe_endpoint(method, endpoint)
+    disjoncteur = disjoncteurs.setdefault(office_code, Disjoncteur())
+    if not disjoncteur.autoriser():
+        logger.warning("[RESILIENCE] Cabinet %s: disjoncteur ouvert, %s %s refusé", office_code, method, endpoint)
+        raise ServiceIndisponible()
+
+    # Appel d'essai du disjoncteur semi-ouvert: libéré quelle que soit l'issue (annulation comprise)
+    essai = disjoncteur.essai_en_cours
+    echeance = time.monotonic() + (timeout if timeout is not None else DELAIS_PAR_CLASSE[classe])
+    budget_retry.crediter()
+    tentative = 0
+    try:
+        while True:
+            restant = echeance - time.monotonic()
+            args = (method, endpoint, office_code, api_key, params, json_data, allow_404, restant)
+            try:
+                try:
+                    if method == "GET":
+                        result = await asyncio.wait_for(_get_avec_hedge(classe, args), restant)
+                    else:
+                        result = await asyncio.wait_for(_tentative_mesuree(classe, *args), restant)
+                except asyncio.TimeoutError:
+                    # Échéance atteinte (attente du limiteur comprise): tentative et requête de secours annulées
+                    raise ErreurAmontTransitoire(status_code=504, detail="Timeout lors de l'appel à l'API")
+                disjoncteur.succes()
+                return result
+            except HTTPException as e:
+                if not est_erreur_transitoire(e):
+                    if e.status_code < 500:
+                        disjoncteur.succes()  # L'API a répondu: le cabinet n'est pas en panne
+                    raise
+                delai = random.uniform(0, RETRY_DELAI_BASE * (2 ** (tentative + 1)))
+                peut_reessayer = (
+                    method == "GET" and tentative < RETRY_MAX
+                    and time.monotonic() + delai < echeance and budget_retry.prendre()
+                )
+                if not peut_reessayer:
+                    disjoncteur.echec()
+                    if disjoncteur.etat == "ouvert":
+                        logger.warning("[RESILIENCE] Cabinet %s: disjoncteur ouvert pour %.0fs", office_code, DISJONCTEUR_DUREE)
+                    raise
+                tentative += 1
+                logger.info("[RESILIENCE] %s %s: erreur %s, nouvelle tentative %s dans %.0f ms", method, endpoint, e.status_code, tentative, delai * 1000)
+                await asyncio.sleep(delai)
+    finally:
+        if essai:
+            disjoncteur.abandonner_essai()
+
+
+# GET identiques en cours: (office, clé API, endpoint, params, allow_404) -> tâche partagée
+_get_en_vol: dict = {}
+
+
 async def call_rdvdentiste(
     method: str,
     endpoint: str,
@@ -282,10 +2040,58 @@ async def call_rdvdentiste(
     api_key: Optional[str] = None,
     params: dict = None,
     json_data: dict = None,
-    allow_404: bool = False
+    allow_404: bool = False,
+    timeout: Optional[float] = None
+) -> dict:
+    """
+    Appel générique à l'API rdvdentiste (timeout optionnel en secondes pour cet appel).
+
+    Les GET identiques lancés en même temps partagent un seul appel amont
+    (single-flight): le résultat ou l'erreur est renvoyé à tous les appelants.
+    Chaque appel passe par la couche de résilience (_appel_resilient).
+    """
+    if method != "GET":
+        return await _appel_resilient(method, endpoint, office_code, api_key, params, json_data, allow_404, timeout)
+
+    cle = (
+        office_code,
+        cle_api_effective(office_code, api_key),
+        endpoint,
+        tuple(sorted((params or {}).items())),
+        allow_404
+    )
+    tache = _get_en_vol.get(cle)
+    if tache is None:
+        tache = asyncio.ensure_future(
+            _appel_resilient(method, endpoint, office_code, api_key, params, json_data, allow_404, timeout)
+        )
+        _get_en_vol[cle] = tache
+
+        def terminer(t: asyncio.Task):
+            _get_en_vol.pop(cle, None)
+            if not t.cancelled():
+                t.exception()  # Évite "exception never retrieved" si tous les appelants ont abandonné
+
+        tache.add_done_callback(terminer)
+    else:
+        logger.info("[SINGLE_FLIGHT] GET %s déjà en cours, réponse partagée", endpoint)
+
+    # shield: l'annulation d'un appelant n'annule pas l'appel partagé par les autres
+    return await asyncio.shield(tache)
+
+
+async def _requete_rdvdentiste(
+    method: str,
+    endpoint: str,
+    office_code: str,
+    api_key: Optional[str],
+    params: Optional[dict],
+    json_data: Optional[dict],
+    allow_404: bool,
+    timeout: Optional[float]
 ) -> dict:
-    """Appel générique à l'API rdvdentiste"""
-    effective_api_key = api_key or DEFAULT_API_KEY
+    """Exécute la requête HTTP vers rdvdentiste et convertit les erreurs en HTTPException"""
+    effective_api_key = cle_api_effective(office_code, api_key)
 
     headers = {
         "OfficeCode": office_code,
@@ -296,107 +2102,1014 @@ async def call_rdvdentiste(
 
     url = f"{RDVDENTISTE_BASE_URL}{endpoint}"
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
+    client = get_client_http(office_code)
+    extra = {}
+    if timeout is not None:
+        extra["timeout"] = httpx.Timeout(timeout, connect=min(timeout, HTTP_CONNECT_TIMEOUT))
+
+    modele = modele_endpoint(endpoint)
+    statut = "erreur"
+    debut = time.monotonic()
+    METRIQUE_AMONT_EN_COURS.inc()
+    try:
         try:
             if method == "GET":
-                response = await client.get(url, headers=headers, params=params)
+                response = await client.get(url, headers=headers, params=params, **extra)
             elif method == "PUT":
-                response = await client.put(url, headers=headers, params=params, json=json_data)
+                response = await client.put(url, headers=headers, params=params, json=json_data, **extra)
             elif method == "DELETE":
-                response = await client.delete(url, headers=headers, params=params)
+                response = await client.delete(url, headers=headers, params=params, **extra)
             else:
-                response = await client.post(url, headers=headers, params=params, json=json_data)
-
-            # Gérer les cas spéciaux
-            if allow_404 and response.status_code == 404:
-                try:
-                    return response.json()
-                except:
-                    return {"Error": {"code": "notFound", "text": "Not found"}}
-
-            if response.status_code == 400:
-                try:
-                    return response.json()
-                except:
-                    pass
-
-            response.raise_for_status()
-            return response.json()
-
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=e.response.status_code, detail=str(e))
+                response = await client.post(url, headers=headers, params=params, json=json_data, **extra)
+            statut = response.status_code
         except httpx.TimeoutException:
-            raise HTTPException(status_code=504, detail="Timeout lors de l'appel à l'API")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+            statut = "timeout"
+            raise
+        except asyncio.CancelledError:
+            statut = "annule"
+            raise
+        finally:
+            METRIQUE_AMONT_EN_COURS.dec()
+            METRIQUE_AMONT.observer(time.monotonic() - debut, modele, method)
+            METRIQUE_AMONT_STATUTS.inc(modele, method, statut)
+
+        # Gérer les cas spéciaux
+        if allow_404 and response.status_code == 404:
+            try:
+                return json_charger(response.content)
+            except:
+                return {"Error": {"code": "notFound", "text": "Not found"}}
+
+        if response.status_code == 400:
+            try:
+                return json_charger(response.content)
+            except:
+                pass
+
+        response.raise_for_status()
+        return json_charger(response.content)
+
+    except httpx.HTTPStatusError as e:
+        classe_erreur = ErreurAmontTransitoire if e.response.status_code >= 500 else HTTPException
+        raise classe_erreur(status_code=e.response.status_code, detail=str(e))
+    except httpx.TimeoutException:
+        raise ErreurAmontTransitoire(status_code=504, detail="Timeout lors de l'appel à l'API")
+    except httpx.TransportError as e:
+        # Connexion refusée / coupée, erreur de protocole: l'API n'a pas pu répondre
+        raise ErreurAmontTransitoire(status_code=500, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 
 async def trouver_patients_par_telephone(telephone: str, office_code: str, api_key: Optional[str]) -> List[dict]:
     """Recherche tous les patients avec un numéro de téléphone donné"""
     tel_normalise = normaliser_telephone(telephone)
 
-    print(f"[TROUVER_PATIENTS] Recherche avec mobile={tel_normalise}")
+    cle_cache = (office_code, tel_normalise)
+    patients = cache_patients.get(cle_cache)
+    if patients is not None:
+        logger.info("[TROUVER_PATIENTS] mobile=%s: %s patient(s) (cache)", tel_normalise, len(patients))
+        return patients
+
+    logger.info("[TROUVER_PATIENTS] Recherche avec mobile=%s", tel_normalise)
 
     search_result = await call_rdvdentiste(
         "GET", "/patients/find", office_code, api_key,
         {"mobile": tel_normalise}, allow_404=True
     )
 
-    print(f"[TROUVER_PATIENTS] Réponse API brute: {search_result}")
+    logger.debug("[TROUVER_PATIENTS] Réponse API brute: %s", apercu(search_result))
 
     patients = []
     # L'API retourne "People" (pas "Patients") - vérifier les deux au cas où
     people_list = None
     if isinstance(search_result, dict):
         people_list = search_result.get("People") or search_result.get("Patients") or []
-        print(f"[TROUVER_PATIENTS] Liste trouvée: {people_list}")
+        logger.debug("[TROUVER_PATIENTS] Liste trouvée: %s", apercu(people_list))
+
+    if people_list:
+        for patient in people_list:
+            patient_id = patient.get("identifier") or patient.get("id")
+            if patient_id:
+                patients.append({
+                    "id": patient_id,
+                    "nom": patient.get("lastName") or patient.get("family"),
+                    "prenom": patient.get("firstName") or patient.get("given"),
+                    "data": patient
+                })
+
+    cache_patients.set(cle_cache, patients, None if patients else PATIENTS_CACHE_TTL_NEGATIF)
+    return patients
+
+
+async def trouver_rdvs_patient(
+    patient_id: str,
+    office_code: str,
+    api_key: Optional[str],
+    inclure_annules_localement: bool = False
+) -> List[dict]:
+    """Récupère tous les RDV d'un patient (en filtrant ceux qu'on a annulés localement, sauf si demandé)"""
+    result = await call_rdvdentiste("GET", f"/patients/{patient_id}/appointments", office_code, api_key)
+
+    logger.debug("[TROUVER_RDVS] Patient %s - Réponse brute API: %s", patient_id, apercu(result))
+
+    rdvs = []
+    if isinstance(result, list):
+        annules = set()
+        if not inclure_annules_localement:
+            annules = await rdv_annules.annules_parmi([rdv.get("rdvId") or rdv.get("id") for rdv in result])
+        for rdv in result:
+            service_type = rdv.get("service_type", {})
+            rdv_id = rdv.get("rdvId") or rdv.get("id")
+            alternate_id = rdv.get("alternateRdvId")
+            rdv_status = rdv.get("status", "active")
+
+            # Vérifier si ce RDV a été annulé localement
+            if rdv_id in annules:
+                logger.info("[TROUVER_RDVS] RDV %s ignoré (annulé localement)", rdv_id)
+                continue
+
+            logger.debug("[TROUVER_RDVS] RDV trouvé: id=%s, alternate_id=%s, status=%s, raw=%s", rdv_id, alternate_id, rdv_status, apercu(rdv))
+            rdvs.append({
+                "id": rdv_id,
+                "alternate_id": alternate_id,
+                "patient_id": patient_id,
+                "date": rdv.get("date"),
+                "heure": rdv.get("start") or rdv.get("hour"),
+                "type": service_type.get("display") if isinstance(service_type, dict) else rdv.get("type"),
+                "duree_minutes": rdv.get("duration"),
+                "statut": rdv_status
+            })
+
+    return rdvs
+
+
+async def trouver_rdvs_patients(patients: List[dict], office_code: str, api_key: Optional[str]) -> List[dict]:
+    """
+    Récupère en parallèle les RDV de plusieurs patients (même numéro de téléphone).
+
+    Les résultats sont fusionnés dans l'ordre de la liste des patients.
+    Si la récupération échoue pour un patient, ses RDV sont ignorés ;
+    l'erreur n'est propagée que si tous les patients ont échoué.
+    """
+    semaphore = asyncio.Semaphore(max(1, FANOUT_MAX_CONCURRENCE))
+
+    async def recuperer(patient: dict) -> List[dict]:
+        async with semaphore:
+            return await trouver_rdvs_patient(patient["id"], office_code, api_key)
+
+    resultats = await asyncio.gather(*(recuperer(p) for p in patients), return_exceptions=True)
+
+    tous_rdvs = []
+    erreurs = []
+    for patient, resultat in zip(patients, resultats):
+        if isinstance(resultat, BaseException):
+            logger.warning("[TROUVER_RDVS] Échec pour le patient %s: %r", patient['id'], resultat)
+            erreurs.append(resultat)
+            continue
+        tous_rdvs.extend(resultat)
+
+    if erreurs and len(erreurs) == len(patients):
+        raise erreurs[0]
+
+    return tous_rdvs
+
+
+def decouper_periode(date_debut: str, date_fin: str, jours: int) -> List[tuple]:
+    """Découpe [date_debut, date_fin] (bornes incluses) en tranches consécutives de `jours` jours"""
+    debut = date_cls.fromisoformat(date_debut)
+    fin = date_cls.fromisoformat(date_fin)
+    tranches = []
+    while debut <= fin:
+        fin_tranche = min(debut + timedelta(days=max(1, jours) - 1), fin)
+        tranches.append((debut.isoformat(), fin_tranche.isoformat()))
+        debut = fin_tranche + timedelta(days=1)
+    return tranches or [(date_debut, date_fin)]
+
+
+async def _recuperer_tranche(
+    office_code: str, api_key: Optional[str], type_rdv: str, start: str, end: str, new_patient: str
+) -> List[dict]:
+    """Créneaux bruts d'une tranche (depuis le cache si possible)"""
+    praticien = cabinets.pour(office_code).praticien
+    cle_cache = (office_code, praticien, type_rdv, start, end, new_patient)
+    result = cache_disponibilites.get(cle_cache)
+    if result is None:
+        endpoint = f"/schedules/{praticien}/slots/{type_rdv}/"
+        params = {"start": start, "end": end, "newPatient": new_patient}
+        result = await call_rdvdentiste("GET", endpoint, office_code, api_key, params)
+        if not (isinstance(result, dict) and ("Error" in result or "error" in result)):
+            cache_disponibilites.set(cle_cache, result)
+    return result.get("AvailableSlots", []) if isinstance(result, dict) else result
+
+
+async def iterer_tranches_creneaux(
+    office_code: str,
+    api_key: Optional[str],
+    type_rdv: str,
+    date_debut: str,
+    date_fin: str,
+    nouveau_patient: bool,
+    avec_calendrier: bool = True
+):
+    """
+    Produit les créneaux bruts de l'API tranche par tranche, dans l'ordre chronologique
+    (d'un seul bloc depuis le calendrier matérialisé si la période y est couverte).
+
+    Au-delà de DISPONIBILITES_TRANCHE_JOURS jours, la période est découpée en
+    tranches toutes lancées en parallèle (au plus DISPONIBILITES_MAX_CONCURRENCE
+    appels simultanés) ; chaque tranche est produite dès qu'elle et les précédentes
+    sont arrivées. Les doublons (créneau à cheval sur deux tranches) sont retirés.
+    """
+    lu = calendrier.lire(office_code, type_rdv, nouveau_patient, date_debut, date_fin) if avec_calendrier else None
+    if lu is not None:
+        yield lu[0]
+        return
+
+    new_patient = "1" if nouveau_patient else "0"
+    try:
+        tranches = decouper_periode(date_debut, date_fin, DISPONIBILITES_TRANCHE_JOURS)
+    except ValueError:
+        tranches = [(date_debut, date_fin)]  # Dates non ISO: on laisse l'API répondre
+
+    if len(tranches) == 1:
+        yield await _recuperer_tranche(office_code, api_key, type_rdv, date_debut, date_fin, new_patient)
+        return
+
+    semaphore = asyncio.Semaphore(max(1, DISPONIBILITES_MAX_CONCURRENCE))
+
+    async def recuperer(start: str, end: str) -> List[dict]:
+        async with semaphore:
+            return await _recuperer_tranche(office_code, api_key, type_rdv, start, end, new_patient)
+
+    taches = [asyncio.ensure_future(recuperer(start, end)) for start, end in tranches]
+    vus = set()
+    try:
+        for tache in taches:
+            slots_tranche = []
+            for slot in await tache:
+                debut_slot = slot.get("start")
+                if debut_slot in vus:
+                    continue
+                vus.add(debut_slot)
+                slots_tranche.append(slot)
+            slots_tranche.sort(key=lambda slot: slot.get("start") or "")
+            yield slots_tranche
+    finally:
+        # Client déconnecté ou erreur sur une tranche: ne pas laisser tourner les autres
+        for tache in taches:
+            if tache.done() and not tache.cancelled():
+                tache.exception()  # Évite "exception never retrieved" pour les tranches non consommées
+            else:
+                tache.cancel()
+
+
+async def recuperer_creneaux(
+    office_code: str,
+    api_key: Optional[str],
+    type_rdv: str,
+    date_debut: str,
+    date_fin: str,
+    nouveau_patient: bool,
+    avec_calendrier: bool = True
+) -> List[dict]:
+    """Récupère tous les créneaux bruts de l'API sur une période (voir iterer_tranches_creneaux)"""
+    slots = []
+    async for slots_tranche in iterer_tranches_creneaux(
+        office_code, api_key, type_rdv, date_debut, date_fin, nouveau_patient, avec_calendrier
+    ):
+        slots.extend(slots_tranche)
+    return slots
+
+
+def determiner_categorie(type_rdv: str, type_rdv_nom: Optional[str], office_code: Optional[str] = None) -> Optional[str]:
+    """
+    Catégorie d'un type de RDV: d'abord par son code (codes du cabinet, puis codes
+    découverts dans le catalogue du cabinet s'il est en cache), sinon par son nom
+    """
+    config = cabinets.pour(office_code)
+    categorie = config.code_to_categorie.get(type_rdv)
+    if not categorie and office_code:
+        catalogue = _catalogue_en_cache(office_code)
+        if catalogue:
+            categorie = catalogue["codes_categorie"].get(type_rdv)
+    if not categorie and type_rdv_nom:
+        categorie = trouver_categorie_rdv(type_rdv_nom, config)
+    return categorie
+
+
+def parcourir_creneaux(
+    slots: List[dict], categorie: Optional[str], compteurs: dict, config: Optional[ConfigCabinet] = None
+):
+    """
+    Parcourt les créneaux bruts de l'API et produit ceux autorisés pour la catégorie.
+
+    Produit des tuples (créneau formaté, jour de la semaine, minutes depuis minuit).
+    compteurs["filtres"] est incrémenté pour chaque créneau hors plages horaires.
+    """
+    plages = (config or CONFIG_DEFAUT).plages_compilees.get(categorie) if categorie else None
+    for slot in slots:
+        start_time = slot.get("start", "")
+        if start_time:
+            date_part = start_time.split("T")[0]
+            time_part = start_time.split("T")[1][:5]
+            jour = jour_semaine(date_part)
+            minutes = int(time_part[:2]) * 60 + int(time_part[3:5])
+
+            # FILTRAGE STRICT: Appliquer si on a une catégorie (via code ou nom)
+            if plages is not None:
+                debuts, fins = plages[jour]
+                i = bisect_right(debuts, minutes) - 1
+                if i < 0 or minutes > fins[i]:
+                    compteurs["filtres"] += 1
+                    METRIQUE_CRENEAUX_FILTRES.inc(categorie)
+                    continue
+
+            yield {
+                "date": date_part,
+                "heure": time_part.replace(":", ""),
+                "heure_affichage": time_part.replace(":", "h")
+            }, jour, minutes
+
+
+# ============== CACHE DU CATALOGUE (/schedules) ==============
+
+JOURS_SEMAINE = {0: "Lundi", 1: "Mardi", 2: "Mercredi", 3: "Jeudi", 4: "Vendredi", 5: "Samedi", 6: "Dimanche"}
+
+URL_EXT_SERVICE_TYPE_DURATION = "http://interopsante.org/fhir/structuredefinition/schedule/fr-service-type-duration"
+
+# office_code -> {"raw": réponse /schedules, "types_rdv": liste parsée, "charge_le": horodatage monotonic, ...}
+_cache_catalogue: dict = {}
+stats_catalogue = StatistiquesCache("catalogue")
+_rafraichissements_catalogue: dict = {}
+
+
+def parser_types_rdv(result, config: Optional[ConfigCabinet] = None) -> List[dict]:
+    """Extrait les types de RDV (code, nom, durée, catégorie, plages) de la réponse FHIR /schedules"""
+    config = config or CONFIG_DEFAUT
+    types_rdv = []
+    schedules = result.get("Schedules", []) if isinstance(result, dict) else result
+
+    for schedule in schedules:
+        if isinstance(schedule, dict):
+            # Parser la structure FHIR avec extensions
+            extensions = schedule.get("extension", [])
+            for ext in extensions:
+                if ext.get("url") == URL_EXT_SERVICE_TYPE_DURATION:
+                    service_type = None
+                    duration = None
+                    new_patient_only = False
+
+                    for sub_ext in ext.get("extension", []):
+                        if sub_ext.get("url") == "serviceType":
+                            coding = sub_ext.get("valueCodeableConcept", {}).get("coding", [])
+                            if coding:
+                                service_type = coding[0]
+                                # Vérifier eligibility pour nouveaux patients
+                                eligibility = coding[0].get("eligibility", [])
+                                for elig in eligibility:
+                                    if elig.get("code") == "newPatients":
+                                        new_patient_only = elig.get("value", False)
+                        elif sub_ext.get("url") == "duration":
+                            duration = sub_ext.get("valueDuration", {}).get("time", {}).get("value")
+
+                    if service_type:
+                        nom = service_type.get("display")
+                        # Trouver la catégorie et les plages horaires
+                        categorie = trouver_categorie_rdv(nom, config)
+                        plages_formatees = []
+
+                        if categorie:
+                            plages_categorie = config.plages_horaires.get(categorie, {}).get("plages", {})
+                            for jour, horaires in plages_categorie.items():
+                                for debut, fin in horaires:
+                                    plages_formatees.append(f"{JOURS_SEMAINE[jour]}: {debut.replace(':', 'h')}-{fin.replace(':', 'h')}")
+
+                        types_rdv.append({
+                            "code": service_type.get("code"),
+                            "nom": nom,
+                            "duree_minutes": int(duration) if duration else None,
+                            "nouveau_patient_only": new_patient_only,
+                            "categorie": categorie,
+                            "plages_horaires": plages_formatees
+                        })
+
+    return types_rdv
+
+
+def _entree_catalogue(office_code: str, result, charge_le_mur: float) -> dict:
+    types_rdv = parser_types_rdv(result, cabinets.pour(office_code))
+    return {
+        "raw": result,
+        "types_rdv": types_rdv,
+        # Codes du catalogue dont la catégorie a été trouvée par le nom (complète les codes du cabinet)
+        "codes_categorie": {t["code"]: t["categorie"] for t in types_rdv if t["code"] and t["categorie"]},
+        "charge_le": time.monotonic() - max(0.0, time.time() - charge_le_mur),
+        # Horloge murale: comparable entre workers (état partagé)
+        "charge_le_mur": charge_le_mur,
+        # Configuration du cabinet utilisée pour les catégories (recalculées après un rechargement)
+        "generation": cabinets.generation
+    }
+
+
+def _catalogue_en_cache(office_code: str) -> Optional[dict]:
+    """Catalogue en mémoire du cabinet, catégories recalculées si la configuration a changé"""
+    entree = _cache_catalogue.get(office_code)
+    if entree is not None and entree["generation"] != cabinets.generation:
+        entree = _entree_catalogue(office_code, entree["raw"], entree["charge_le_mur"])
+        _cache_catalogue[office_code] = entree
+    return entree
+
+
+async def _charger_catalogue(office_code: str, api_key: Optional[str]) -> dict:
+    """Appelle /schedules et met à jour le cache du cabinet (sauf réponse d'erreur, jamais mise en cache)"""
+    result = await call_rdvdentiste("GET", "/schedules", office_code, api_key)
+    entree = _entree_catalogue(office_code, result, time.time())
+    erreur = extraire_erreur_api(result)
+    if erreur:
+        # Servie à cette requête seulement: la version en cache (même périmée) reste en place
+        logger.warning("[CATALOGUE] Cabinet %s: erreur de l'API /schedules, non mise en cache: %s", office_code, erreur)
+        entree["erreur"] = erreur
+        return entree
+    _cache_catalogue[office_code] = entree
+    if etat_partage.actif:
+        try:
+            await asyncio.to_thread(etat_partage.catalogue_ecrire, office_code, result, entree["charge_le_mur"])
+        except sqlite3.Error as e:
+            logger.warning("[CATALOGUE] Cabinet %s: écriture dans l'état partagé impossible: %s", office_code, e)
+    return entree
+
+
+async def _synchroniser_catalogue(office_code: str, entree: Optional[dict]) -> Optional[dict]:
+    """
+    Reprend le catalogue chargé (ou invalidé) par un autre worker s'il est plus récent que le nôtre.
+    Les versions sont tenues à jour en mémoire par synchro_partage: l'état partagé n'est lu que
+    lorsqu'une version plus récente y est signalée.
+    """
+    version = synchro_partage.versions_catalogue.get(office_code)
+    if version is None or (entree is not None and version <= entree["charge_le_mur"]):
+        return entree
+    try:
+        lu = await asyncio.to_thread(etat_partage.catalogue_lire, office_code)
+    except sqlite3.Error as e:
+        logger.warning("[CATALOGUE] Cabinet %s: lecture de l'état partagé impossible: %s", office_code, e)
+        return entree
+    if lu is None:
+        return entree
+    raw, charge_le_mur = lu
+    if raw is None:
+        _cache_catalogue.pop(office_code, None)
+        return None
+    entree = _entree_catalogue(office_code, raw, charge_le_mur)
+    _cache_catalogue[office_code] = entree
+    return entree
+
+
+async def _rafraichir_catalogue(office_code: str, api_key: Optional[str]):
+    try:
+        entree = await _charger_catalogue(office_code, api_key)
+        if "erreur" not in entree:
+            logger.info("[CATALOGUE] Cabinet %s: catalogue rafraîchi en arrière-plan", office_code)
+    except Exception as e:
+        # On garde la version périmée, nouvel essai à la prochaine requête
+        logger.warning("[CATALOGUE] Cabinet %s: échec du rafraîchissement: %r", office_code, e)
+    finally:
+        _rafraichissements_catalogue.pop(office_code, None)
+
+
+async def obtenir_catalogue(office_code: str, api_key: Optional[str]) -> dict:
+    """
+    Retourne le catalogue /schedules du cabinet (brut + types de RDV parsés).
+
+    - Frais (< SCHEDULES_CACHE_TTL): servi depuis la mémoire
+    - Périmé (< TTL + SCHEDULES_CACHE_STALE): servi depuis la mémoire, rafraîchi en arrière-plan
+    - Absent ou trop ancien: rechargé avant de répondre
+    """
+    entree = _catalogue_en_cache(office_code)
+    if etat_partage.actif:
+        entree = await _synchroniser_catalogue(office_code, entree)
+    if entree is not None:
+        age = time.monotonic() - entree["charge_le"]
+        if age < SCHEDULES_CACHE_TTL:
+            stats_catalogue.noter(True)
+            return entree
+        if age < SCHEDULES_CACHE_TTL + SCHEDULES_CACHE_STALE:
+            if office_code not in _rafraichissements_catalogue:
+                _rafraichissements_catalogue[office_code] = asyncio.create_task(
+                    _rafraichir_catalogue(office_code, api_key)
+                )
+            stats_catalogue.noter(True)
+            return entree
+
+    stats_catalogue.noter(False)
+    return await _charger_catalogue(office_code, api_key)
+
+
+async def invalider_catalogue(office_code: Optional[str] = None) -> int:
+    """Vide le cache du catalogue (un cabinet ou tous). Retourne le nombre d'entrées supprimées"""
+    if etat_partage.actif:
+        await asyncio.to_thread(etat_partage.catalogue_invalider, office_code)
+    if office_code is None:
+        nb = len(_cache_catalogue)
+        _cache_catalogue.clear()
+        return nb
+    return 1 if _cache_catalogue.pop(office_code, None) is not None else 0
+
+
+# ============== PRÉCHAUFFAGE ==============
+
+# Résultat du préchauffage, exposé par /pret
+etat_prechauffage = {"termine": False, "cabinets": {}}
+
+
+async def _prechauffer_cabinet(office_code: str) -> dict:
+    debut = time.monotonic()
+    catalogue = await _charger_catalogue(office_code, None)
+    if "erreur" in catalogue:
+        return {"ok": False, "erreur": catalogue["erreur"], "duree_ms": round((time.monotonic() - debut) * 1000)}
+    return {
+        "ok": True,
+        "types_rdv": len(catalogue["types_rdv"]),
+        "codes_decouverts": sorted(set(catalogue["codes_categorie"]) - set(cabinets.pour(office_code).code_to_categorie)),
+        "duree_ms": round((time.monotonic() - debut) * 1000)
+    }
+
+
+async def prechauffer(cabinets: List[str]):
+    """
+    Charge le catalogue /schedules des cabinets configurés (PRECHAUFFAGE_CABINETS).
+
+    Remplit le cache du catalogue, la table code -> catégorie du cabinet et le cache
+    des catégories par nom, pour que le premier appelant après un redémarrage ne
+    paie pas ces chargements. Un cabinet en échec n'empêche pas le démarrage.
+    """
+    if cabinets:
+        resultats = await asyncio.gather(
+            *(asyncio.wait_for(_prechauffer_cabinet(c), PRECHAUFFAGE_TIMEOUT) for c in cabinets),
+            return_exceptions=True
+        )
+        for office_code, resultat in zip(cabinets, resultats):
+            if isinstance(resultat, BaseException):
+                logger.warning("[PRECHAUFFAGE] Cabinet %s: échec: %r", office_code, resultat)
+                resultat = {"ok": False, "erreur": repr(resultat)}
+            elif not resultat["ok"]:
+                logger.warning("[PRECHAUFFAGE] Cabinet %s: échec: %s", office_code, resultat["erreur"])
+            else:
+                logger.info("[PRECHAUFFAGE] Cabinet %s: %s types de RDV en %s ms", office_code, resultat["types_rdv"], resultat["duree_ms"])
+            etat_prechauffage["cabinets"][office_code] = resultat
+    etat_prechauffage["termine"] = True
+
+
+# ============== CALENDRIER MATÉRIALISÉ DES DISPONIBILITÉS ==============
+
+class CalendrierDisponibilites:
+    """
+    Créneaux bruts par jour pour les cabinets / codes configurés, sur un horizon glissant.
+
+    L'horizon est découpé en segments: les CALENDRIER_JOURS_PROCHES premiers jours
+    (rafraîchis toutes les CALENDRIER_RAFRAICHISSEMENT_PROCHE s), puis une semaine par
+    segment (CALENDRIER_RAFRAICHISSEMENT_LOINTAIN). Une tâche de fond ne rappelle
+    l'API que pour les segments échus: la charge amont ne dépend pas du trafic.
+
+    Un jour touché par une réservation ou une annulation est invalidé: il est servi
+    en direct par l'API jusqu'au rafraîchissement, déclenché immédiatement. Le
+    filtrage par plages horaires est fait à la lecture (quelques centaines de
+    créneaux en mémoire), avec la configuration courante du cabinet.
+
+    Avec un état partagé, un seul worker (détenteur du bail "calendrier") appelle
+    l'API et écrit les jours rafraîchis dans SQLite ; les autres les relisent toutes
+    les ETAT_PARTAGE_SYNCHRO secondes et reçoivent les invalidations via synchro_partage.
+    """
+
+    DELAI_APRES_ECHEC = 30.0
+    DUREE_BAIL = 15.0
+
+    def __init__(self, cabinets_calendrier: List[str], types_rdv: List[str], nouveaux_patients: List[str],
+                 partage: EtatPartage):
+        self.partage = partage
+        self.meneur = not partage.actif
+        self._maj_depuis = 0.0
+        self.cles = [(o, t, n) for o in cabinets_calendrier for t in types_rdv for n in nouveaux_patients]
+        self._cles_suivies = set(self.cles)
+        self.statistiques = StatistiquesCache("calendrier")
+        self._jours: dict = {}  # (office_code, type_rdv, new_patient) -> {date ISO: (créneaux bruts, rafraîchi le)}
+        self._invalide_le: dict = {}  # (office_code, date ISO ou None = tous les jours) -> horodatage de la dernière invalidation
+        self._echecs: dict = {}  # (clé, début du segment) -> horodatage du dernier échec
+        self.appels = 0
+        self._evenement: Optional[asyncio.Event] = None
+        self._tache: Optional[asyncio.Task] = None
+
+    @property
+    def actif(self) -> bool:
+        return bool(self.cles)
+
+    # --- Lecture ---
+
+    def lire(self, office_code: str, type_rdv: str, nouveau_patient: bool, date_debut: str, date_fin: str) -> Optional[tuple]:
+        """(créneaux bruts triés, rafraîchi le) si toute la période est couverte et fraîche, sinon None"""
+        cle = (office_code, type_rdv, "1" if nouveau_patient else "0")
+        if cle not in self._cles_suivies:
+            return None
+        lu = self._lire(self._jours.get(cle), date_debut, date_fin)
+        self.statistiques.noter(lu is not None)
+        return lu
+
+    @staticmethod
+    def _lire(jours: Optional[dict], date_debut: str, date_fin: str) -> Optional[tuple]:
+        if not jours:
+            return None
+        try:
+            jour = date_cls.fromisoformat(date_debut)
+            fin = date_cls.fromisoformat(date_fin)
+        except ValueError:
+            return None
+        if fin < jour:
+            return None
+
+        limite = time.time() - CALENDRIER_FRAICHEUR_MAX
+        slots = []
+        plus_ancien = None
+        while jour <= fin:
+            entree = jours.get(jour.isoformat())
+            if entree is None or entree[1] < limite:
+                return None
+            slots.extend(entree[0])
+            plus_ancien = entree[1] if plus_ancien is None else min(plus_ancien, entree[1])
+            jour += timedelta(days=1)
+        return slots, plus_ancien
+
+    # --- Invalidation ---
+
+    def invalider(self, office_code: str, date: Optional[str], quand: Optional[float] = None):
+        """
+        Réservation / annulation (faite à l'instant quand, par défaut maintenant): le jour
+        (tous si date inconnue) repasse par l'API et est rafraîchi tout de suite
+        """
+        if not self.actif:
+            return
+        # Noté même si le calendrier du cabinet n'est pas encore rempli: un rafraîchissement
+        # en cours (le premier compris) ne doit pas enregistrer ce jour comme frais
+        quand = quand or time.time()
+        self._invalide_le[(office_code, date)] = max(self._invalide_le.get((office_code, date), 0.0), quand)
+        for cle, jours in self._jours.items():
+            if cle[0] != office_code:
+                continue
+            for jour in ([date] if date else list(jours)):
+                # Invalidation reçue d'un autre worker après un rafraîchissement plus récent: rien à faire
+                if jour in jours and jours[jour][1] < quand:
+                    jours[jour] = (jours[jour][0], 0.0)
+        if self._evenement is not None:
+            self._evenement.set()
+
+    # --- Rafraîchissement ---
+
+    def _segments(self) -> List[tuple]:
+        aujourd_hui = date_cls.today()
+        horizon = aujourd_hui + timedelta(days=7 * CALENDRIER_SEMAINES - 1)
+        fin_proche = min(aujourd_hui + timedelta(days=max(1, CALENDRIER_JOURS_PROCHES) - 1), horizon)
+        segments = [(aujourd_hui, fin_proche, CALENDRIER_RAFRAICHISSEMENT_PROCHE)]
+        debut = fin_proche + timedelta(days=1)
+        while debut <= horizon:
+            fin = min(debut + timedelta(days=6), horizon)
+            segments.append((debut, fin, CALENDRIER_RAFRAICHISSEMENT_LOINTAIN))
+            debut = fin + timedelta(days=1)
+        return segments
+
+    def _echeance(self, cle: tuple, debut: date_cls, fin: date_cls, intervalle: float) -> float:
+        """Horodatage auquel le segment doit être rafraîchi (le plus ancien de ses jours + intervalle)"""
+        jours = self._jours.get(cle, {})
+        plus_ancien = None
+        jour = debut
+        while jour <= fin:
+            entree = jours.get(jour.isoformat())
+            rafraichi = entree[1] if entree else 0.0
+            plus_ancien = rafraichi if plus_ancien is None else min(plus_ancien, rafraichi)
+            jour += timedelta(days=1)
+        echeance = plus_ancien + intervalle if plus_ancien else 0.0
+        return max(echeance, self._echecs.get((cle, debut), 0.0) + self.DELAI_APRES_ECHEC)
+
+    async def _rafraichir_segment(self, cle: tuple, debut: date_cls, fin: date_cls):
+        office_code, type_rdv, new_patient = cle
+        demande_le = time.time()
+        endpoint = f"/schedules/{cabinets.pour(office_code).praticien}/slots/{type_rdv}/"
+        params = {"start": debut.isoformat(), "end": fin.isoformat(), "newPatient": new_patient}
+        self.appels += 1
+        result = await call_rdvdentiste("GET", endpoint, office_code, None, params)
+        erreur = extraire_erreur_api(result)
+        if erreur:
+            raise RuntimeError(erreur)
+
+        par_jour = {}
+        jour = debut
+        while jour <= fin:
+            par_jour[jour.isoformat()] = []
+            jour += timedelta(days=1)
+        for slot in (result.get("AvailableSlots", []) if isinstance(result, dict) else result):
+            liste = par_jour.get((slot.get("start") or "")[:10])
+            if liste is not None:
+                liste.append(slot)
+
+        for jour_iso, slots in par_jour.items():
+            slots.sort(key=lambda slot: slot.get("start") or "")
+            self._enregistrer_jour(cle, jour_iso, slots, demande_le)
+        if self.partage.actif:
+            jours = self._jours[cle]
+            try:
+                await asyncio.to_thread(self.partage.calendrier_ecrire, cle, {jour: jours[jour] for jour in par_jour})
+            except sqlite3.Error as e:
+                logger.warning("[CALENDRIER] Écriture dans l'état partagé impossible: %s", e)
+
+    def _enregistrer_jour(self, cle: tuple, jour_iso: str, slots: List[dict], rafraichi: float):
+        # Invalidé pendant l'appel: la réponse peut précéder la réservation, le jour reste à rafraîchir
+        invalide_le = max(self._invalide_le.get((cle[0], jour_iso), 0.0), self._invalide_le.get((cle[0], None), 0.0))
+        self._jours.setdefault(cle, {})[jour_iso] = (slots, 0.0 if invalide_le >= rafraichi else rafraichi)
+
+    async def _suivre_partage(self):
+        """Worker sans le bail: reprend les jours écrits par le worker qui maintient le calendrier"""
+        # Marge: deux écritures concurrentes peuvent être validées dans le désordre de leur horodatage
+        lignes = await asyncio.to_thread(self.partage.calendrier_depuis, self._maj_depuis - 5)
+        for office_code, type_rdv, new_patient, jour_iso, slots, rafraichi, maj_le in lignes:
+            cle = (office_code, type_rdv, new_patient)
+            if cle in self._cles_suivies:
+                self._enregistrer_jour(cle, jour_iso, slots, rafraichi)
+            self._maj_depuis = max(self._maj_depuis, maj_le)
+        self._purger()
+
+    async def _prendre_bail(self) -> bool:
+        """True si ce worker maintient le calendrier (toujours sans état partagé)"""
+        if not self.partage.actif:
+            return True
+        meneur = await asyncio.to_thread(self.partage.bail_prendre, "calendrier", IDENTIFIANT_WORKER, self.DUREE_BAIL)
+        if meneur != self.meneur:
+            logger.info("[CALENDRIER] %s", "Ce worker maintient le calendrier" if meneur else "Calendrier maintenu par un autre worker")
+            self.meneur = meneur
+        return meneur
+
+    def _purger(self):
+        aujourd_hui = date_cls.today().isoformat()
+        for jours in self._jours.values():
+            for jour in [j for j in jours if j < aujourd_hui]:
+                del jours[jour]
+        # Invalidations sans date: utiles seulement aux rafraîchissements en cours
+        limite = time.time() - CALENDRIER_RAFRAICHISSEMENT_LOINTAIN
+        for cle in [c for c, quand in self._invalide_le.items() if (c[1] < aujourd_hui if c[1] else quand < limite)]:
+            del self._invalide_le[cle]
+
+    async def rafraichir(self) -> float:
+        """Rafraîchit les segments échus. Retourne le délai (s) avant la prochaine échéance"""
+        self._purger()
+        maintenant = time.time()
+        dus = []
+        prochaine = CALENDRIER_RAFRAICHISSEMENT_PROCHE
+        for cle in self.cles:
+            for debut, fin, intervalle in self._segments():
+                echeance = self._echeance(cle, debut, fin, intervalle)
+                if echeance <= maintenant:
+                    dus.append((cle, debut, fin))
+                else:
+                    prochaine = min(prochaine, echeance - maintenant)
+
+        semaphore = asyncio.Semaphore(max(1, CALENDRIER_MAX_CONCURRENCE))
+
+        async def rafraichir_segment(cle, debut, fin):
+            async with semaphore:
+                try:
+                    await self._rafraichir_segment(cle, debut, fin)
+                    self._echecs.pop((cle, debut), None)
+                except Exception as e:
+                    self._echecs[(cle, debut)] = time.time()
+                    logger.warning("[CALENDRIER] %s type %s du %s au %s: échec du rafraîchissement: %r", cle[0], cle[1], debut, fin, e)
+
+        if dus:
+            debut_rafraichissement = time.monotonic()
+            await asyncio.gather(*(rafraichir_segment(*du) for du in dus))
+            logger.info("[CALENDRIER] %s segment(s) rafraîchi(s) en %s ms", len(dus), round((time.monotonic() - debut_rafraichissement) * 1000))
+            prochaine = min(prochaine, self.DELAI_APRES_ECHEC)
+        return max(1.0, prochaine)
+
+    async def _boucle(self):
+        while True:
+            try:
+                if await self._prendre_bail():
+                    delai = await self.rafraichir()
+                else:
+                    await self._suivre_partage()
+                    delai = ETAT_PARTAGE_SYNCHRO
+                if self.partage.actif:
+                    delai = min(delai, self.DUREE_BAIL / 3)  # Prolonger le bail avant son expiration
+            except Exception as e:
+                logger.warning("[CALENDRIER] Erreur: %r", e)
+                delai = self.DELAI_APRES_ECHEC
+            try:
+                await asyncio.wait_for(self._evenement.wait(), timeout=delai)
+            except asyncio.TimeoutError:
+                pass
+            self._evenement.clear()
+
+    def demarrer(self):
+        if self.actif and (self._tache is None or self._tache.done()):
+            self._evenement = asyncio.Event()
+            self._tache = asyncio.create_task(self._boucle())
+            logger.info("[CALENDRIER] %s calendrier(s) maintenu(s) sur %s semaine(s)", len(self.cles), CALENDRIER_SEMAINES)
+
+    async def arreter(self):
+        if self._tache is not None:
+            self._tache.cancel()
+            try:
+                await self._tache
+            except asyncio.CancelledError:
+                pass
+            self._tache = None
+            if self.partage.actif and self.meneur:
+                # Un autre worker reprend le calendrier sans attendre l'expiration du bail
+                try:
+                    await asyncio.to_thread(self.partage.bail_liberer, "calendrier", IDENTIFIANT_WORKER)
+                except sqlite3.Error as e:
+                    logger.warning("[CALENDRIER] Libération du bail impossible: %s", e)
+
+    def stats(self) -> dict:
+        limite = time.time() - CALENDRIER_FRAICHEUR_MAX
+        calendriers = {}
+        for cle, jours in self._jours.items():
+            frais = [r for _, r in jours.values() if r >= limite]
+            calendriers[":".join(cle)] = {
+                "jours": len(jours),
+                "jours_servis": len(frais),
+                "creneaux": sum(len(slots) for slots, _ in jours.values()),
+                "plus_ancien": datetime.fromtimestamp(min(frais)).isoformat(timespec="seconds") if frais else None
+            }
+        return {"actif": self.actif, "meneur": self.meneur, "appels_amont": self.appels,
+                **self.statistiques.stats(), "calendriers": calendriers}
+
+
+calendrier = CalendrierDisponibilites(CALENDRIER_CABINETS, CALENDRIER_TYPES, CALENDRIER_NOUVEAU_PATIENT, etat_partage)
+
+
+# ============== RÉCONCILIATION DES ANNULATIONS ==============
+
+def extraire_erreur_api(result) -> Optional[str]:
+    """Retourne le message d'erreur d'une réponse rdvdentiste ("error" / "Error"), sinon None"""
+    error_msg = None
+    if isinstance(result, dict):
+        error_msg = result.get("error") or result.get("Error")
+        if isinstance(error_msg, dict):
+            error_msg = error_msg.get("text") or error_msg.get("message") or str(error_msg)
+    return error_msg
+
 
-    if people_list:
-        for patient in people_list:
-            patient_id = patient.get("identifier") or patient.get("id")
-            if patient_id:
-                patients.append({
-                    "id": patient_id,
-                    "nom": patient.get("lastName") or patient.get("family"),
-                    "prenom": patient.get("firstName") or patient.get("given"),
-                    "data": patient
-                })
+def est_erreur_deja_annule(error_msg) -> bool:
+    error_lower = str(error_msg).lower()
+    return "already cancelled" in error_lower or "déjà annulé" in error_lower or "already canceled" in error_lower
 
-    return patients
+
+def reponse_annulation(rdv: dict) -> dict:
+    """Réponse renvoyée à l'agent vocal une fois l'annulation prise en compte"""
+    return {
+        "success": True,
+        "rdv_id": rdv["id"],
+        "date": rdv["date"],
+        "heure": rdv["heure"],
+        "message": f"Votre rendez-vous du {rdv['date']} à {rdv['heure']} a bien été annulé."
+    }
 
 
-async def trouver_rdvs_patient(patient_id: str, office_code: str, api_key: Optional[str]) -> List[dict]:
-    """Récupère tous les RDV d'un patient (en filtrant ceux qu'on a annulés localement)"""
-    result = await call_rdvdentiste("GET", f"/patients/{patient_id}/appointments", office_code, api_key)
+class ReconciliationAnnulations:
+    """
+    Vérifie en arrière-plan que les annulations acceptées par l'API sont effectives.
 
-    print(f"[TROUVER_RDVS] Patient {patient_id} - Réponse brute API: {result}")
+    Pour chaque annulation: re-lecture des RDV du patient avec un délai croissant
+    (backoff exponentiel avec jitter, délai initial adapté au temps de propagation
+    observé), puis DELETE sur l'endpoint suivant si le RDV est toujours actif.
+    L'état final de chaque annulation est conservé pour consultation
+    (GET /annulations).
 
-    rdvs = []
-    if isinstance(result, list):
-        for rdv in result:
-            service_type = rdv.get("service_type", {})
-            rdv_id = rdv.get("rdvId") or rdv.get("id")
-            alternate_id = rdv.get("alternateRdvId")
-            rdv_status = rdv.get("status", "active")
+    États: en_cours, confirme, deja_annule, non_confirme, interrompu
+    """
 
-            # Vérifier si ce RDV a été annulé localement
-            if est_rdv_annule(rdv_id):
-                print(f"[TROUVER_RDVS] RDV {rdv_id} ignoré (annulé localement)")
+    def __init__(self):
+        self.etats: OrderedDict = OrderedDict()  # rdv_id -> état de l'annulation
+        self._file: Optional[asyncio.Queue] = None
+        self._workers: list = []
+        # Moyenne glissante du temps observé avant confirmation (sert de délai initial)
+        self._delai_propagation = ANNULATION_VERIF_DELAI_MIN
+
+    def enregistrer(self, rdv: dict, etat: str, endpoint: Optional[str], detail: Optional[str] = None) -> dict:
+        maintenant = datetime.now().isoformat()
+        entree = self.etats.get(rdv["id"])
+        if entree is None:
+            entree = {
+                "rdv_id": rdv["id"],
+                "patient_id": rdv.get("patient_id"),
+                "date_rdv": rdv.get("date"),
+                "heure_rdv": rdv.get("heure"),
+                "debut": maintenant,
+                "tentatives": []
+            }
+            self.etats[rdv["id"]] = entree
+        entree.update({"etat": etat, "endpoint": endpoint, "detail": detail, "maj": maintenant})
+        self.etats.move_to_end(rdv["id"])
+        while len(self.etats) > ANNULATION_HISTORIQUE_TAILLE:
+            self.etats.popitem(last=False)
+        return entree
+
+    def soumettre(self, rdv: dict, endpoint: str, endpoints_restants: List[str], office_code: str, api_key: Optional[str]):
+        """Programme la vérification d'une annulation dont le DELETE a été accepté"""
+        self.enregistrer(rdv, "en_cours", endpoint)
+        self.demarrer()
+        self._file.put_nowait((rdv, endpoint, list(endpoints_restants), office_code, api_key))
+
+    def demarrer(self):
+        if self._file is None:
+            self._file = asyncio.Queue()
+        self._workers = [w for w in self._workers if not w.done()]
+        while len(self._workers) < max(1, ANNULATION_WORKERS):
+            self._workers.append(asyncio.create_task(self._boucle()))
+
+    async def arreter(self):
+        for worker in self._workers:
+            worker.cancel()
+        for worker in self._workers:
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
+        self._workers = []
+        if self._file is not None:
+            # Annulations jamais vérifiées: à contrôler manuellement
+            while not self._file.empty():
+                rdv, endpoint, _, _, _ = self._file.get_nowait()
+                self.enregistrer(rdv, "interrompu", endpoint, "Arrêt du service avant vérification")
+            self._file = None
+
+    async def _boucle(self):
+        while True:
+            tache = await self._file.get()
+            try:
+                await self._reconcilier(*tache)
+            except asyncio.CancelledError:
+                self.enregistrer(tache[0], "interrompu", tache[1], "Arrêt du service pendant la vérification")
+                raise
+            except Exception as e:
+                logger.warning("[RECONCILIATION] RDV %s: erreur inattendue: %r", tache[0]["id"], e)
+                self.enregistrer(tache[0], "non_confirme", tache[1], repr(e))
+            finally:
+                self._file.task_done()
+
+    def _noter(self, rdv_id: str, **infos):
+        entree = self.etats.get(rdv_id)
+        if entree is not None:
+            entree["tentatives"].append({"t": datetime.now().isoformat(), **infos})
+
+    async def _rdv_encore_actif(self, rdv: dict, office_code: str, api_key: Optional[str]) -> bool:
+        rdvs = await trouver_rdvs_patient(rdv["patient_id"], office_code, api_key, inclure_annules_localement=True)
+        return any(r.get("id") == rdv["id"] and r.get("statut") == "active" for r in rdvs)
+
+    async def _reconcilier(self, rdv: dict, endpoint: str, endpoints_restants: List[str], office_code: str, api_key: Optional[str]):
+        rdv_id = rdv["id"]
+        debut = time.monotonic()
+
+        while True:
+            delai = min(max(self._delai_propagation, ANNULATION_VERIF_DELAI_MIN), ANNULATION_VERIF_DELAI_MAX)
+            for essai in range(ANNULATION_VERIF_ESSAIS):
+                await asyncio.sleep(delai * random.uniform(0.8, 1.2))
+                try:
+                    actif = await self._rdv_encore_actif(rdv, office_code, api_key)
+                except HTTPException as e:
+                    self._noter(rdv_id, action="verification", endpoint=endpoint, erreur=e.detail)
+                    delai = min(delai * 2, ANNULATION_VERIF_DELAI_MAX)
+                    continue
+
+                self._noter(rdv_id, action="verification", endpoint=endpoint, encore_actif=actif)
+                if not actif:
+                    ecoule = time.monotonic() - debut
+                    self._delai_propagation = 0.8 * self._delai_propagation + 0.2 * ecoule
+                    logger.info("[RECONCILIATION] ✅ RDV %s annulé (confirmé après %.1fs via %s)", rdv_id, ecoule, endpoint)
+                    self.enregistrer(rdv, "confirme", endpoint)
+                    return
+                delai = min(delai * 2, ANNULATION_VERIF_DELAI_MAX)
+
+            # Toujours actif: essayer l'endpoint suivant
+            if not endpoints_restants:
+                logger.warning("[RECONCILIATION] ⚠️ RDV %s toujours actif après tous les endpoints (vérification manuelle recommandée)", rdv_id)
+                self.enregistrer(rdv, "non_confirme", endpoint, "RDV toujours actif côté rdvdentiste")
+                return
+
+            endpoint = endpoints_restants.pop(0)
+            logger.info("[RECONCILIATION] RDV %s toujours actif, DELETE %s", rdv_id, endpoint)
+            try:
+                result = await call_rdvdentiste("DELETE", endpoint, office_code, api_key)
+            except HTTPException as e:
+                self._noter(rdv_id, action="delete", endpoint=endpoint, erreur=e.detail)
                 continue
+            error_msg = extraire_erreur_api(result)
+            self._noter(rdv_id, action="delete", endpoint=endpoint, erreur=error_msg)
+            if error_msg and est_erreur_deja_annule(error_msg):
+                self.enregistrer(rdv, "deja_annule", endpoint)
+                return
+            self.enregistrer(rdv, "en_cours", endpoint)
 
-            print(f"[TROUVER_RDVS] RDV trouvé: id={rdv_id}, alternate_id={alternate_id}, status={rdv_status}, raw={rdv}")
-            rdvs.append({
-                "id": rdv_id,
-                "alternate_id": alternate_id,
-                "patient_id": patient_id,
-                "date": rdv.get("date"),
-                "heure": rdv.get("start") or rdv.get("hour"),
-                "type": service_type.get("display") if isinstance(service_type, dict) else rdv.get("type"),
-                "duree_minutes": rdv.get("duration"),
-                "statut": rdv_status
-            })
 
-    return rdvs
+reconciliation_annulations = ReconciliationAnnulations()
 
 
 # ============== MODÈLES PYDANTIC ==============
@@ -429,6 +3142,18 @@ class DisponibilitesRequest(BaseModel):
     nouveau_patient: Optional[bool] = Field(False, description="Est-ce un nouveau patient ?")
 
 
+# --- Prochains créneaux ---
+class ProchainsCreneauxRequest(BaseModel):
+    type_rdv: str = Field(..., description="Code du type de RDV (ex: 84, 27)")
+    type_rdv_nom: Optional[str] = Field(None, description="Nom du type de RDV - pour filtrer les plages horaires")
+    date_debut: Optional[str] = Field(None, description="Chercher à partir de cette date (par défaut aujourd'hui)")
+    nombre: int = Field(3, ge=1, le=20, description="Nombre de créneaux souhaités")
+    moment: Optional[str] = Field(None, description="'matin' ou 'apres-midi' (optionnel)")
+    exclure_samedi: bool = Field(False, description="Ne pas proposer le samedi")
+    jours_exclus: List[int] = Field(default_factory=list, description="Jours à exclure (0=Lundi ... 6=Dimanche)")
+    nouveau_patient: Optional[bool] = Field(False, description="Est-ce un nouveau patient ?")
+
+
 # --- Créer RDV ---
 class CreerRdvRequest(BaseModel):
     type_rdv: str = Field(..., description="Code du type de RDV")
@@ -444,14 +3169,43 @@ class CreerRdvRequest(BaseModel):
     message: Optional[str] = Field(None, description="Message pour le praticien")
 
 
+# --- Batch ---
+class ActionBatch(BaseModel):
+    id: Optional[str] = Field(None, description="Identifiant pour référencer le résultat (par défaut la position: \"0\", \"1\"...)")
+    action: str = Field(..., description="voir_rdv, annuler_rdv, disponibilites, prochains_creneaux, creer_rdv, rechercher_patient, suggerer_type_rdv, types_rdv")
+    params: dict = Field(default_factory=dict, description="Corps de la requête de l'action; \"${id.chemin}\" reprend un résultat précédent (ex: ${dispo.creneaux.0.heure})")
+    apres: List[str] = Field(default_factory=list, description="Actions précédentes à attendre même sans référence (ex: annuler avant de chercher)")
+
+
+class BatchRequest(BaseModel):
+    actions: List[ActionBatch] = Field(..., description="Actions dans l'ordre; celles qui ne dépendent pas l'une de l'autre sont exécutées en parallèle")
+
+
+app.add_middleware(MiddlewareMetriques)
+
+
 # ============== ENDPOINTS PRINCIPAUX ==============
 
+@app.exception_handler(ServiceIndisponible)
+async def service_indisponible_handler(request, exc: ServiceIndisponible):
+    """Disjoncteur ouvert: réponse immédiate avec un message que l'agent peut lire au patient"""
+    return JSONResponse(status_code=503, content={"success": False, "message": exc.detail})
+
+
 @app.get("/")
 async def root():
     """Health check"""
     return {"status": "ok", "service": "Secrétaire IA Dentiste", "version": "2.0.0"}
 
 
+@app.get("/pret")
+async def readiness():
+    """Readiness: 503 tant que le préchauffage des cabinets n'est pas terminé"""
+    if not etat_prechauffage["termine"]:
+        return JSONResponse(status_code=503, content={"status": "prechauffage", **etat_prechauffage})
+    return {"status": "ok", **etat_prechauffage}
+
+
 # ----- 1. VOIR LES RDV D'UN PATIENT (par téléphone) -----
 
 @app.post("/voir_rdv")
@@ -479,11 +3233,8 @@ async def voir_rdv(
             "message": "Je n'ai trouvé aucun patient avec ce numéro de téléphone dans notre système."
         }
 
-    # Collecter les RDV de tous les patients
-    tous_rdvs = []
-    for patient in patients:
-        rdvs = await trouver_rdvs_patient(patient["id"], office_code, api_key)
-        tous_rdvs.extend(rdvs)
+    # Collecter les RDV de tous les patients (en parallèle)
+    tous_rdvs = await trouver_rdvs_patients(patients, office_code, api_key)
 
     # Filtrer uniquement les RDV actifs/futurs
     rdvs_actifs = [r for r in tous_rdvs if r.get("statut") == "active"]
@@ -537,7 +3288,7 @@ async def annuler_rdv(
 
     # Ignorer date_rdv si c'est une variable non remplacée ou vide
     date_rdv_raw = request.date_rdv
-    if date_rdv_raw and (date_rdv_raw.startswith("<") or date_rdv_raw.startswith("{") or date_rdv_raw == ""):
+    if est_variable_non_remplacee(date_rdv_raw):
         date_rdv_raw = None
     date_cible = convertir_date(date_rdv_raw) if date_rdv_raw else None
 
@@ -550,22 +3301,18 @@ async def annuler_rdv(
             "message": "Votre demande d'annulation a bien été prise en compte."
         }
 
-    # Chercher tous les RDV actifs
-    tous_rdvs_actifs = []
-    for patient in patients:
-        rdvs = await trouver_rdvs_patient(patient["id"], office_code, api_key)
-        for rdv in rdvs:
-            if rdv.get("statut") == "active":
-                tous_rdvs_actifs.append(rdv)
+    # Chercher tous les RDV actifs (en parallèle sur tous les patients)
+    tous_rdvs = await trouver_rdvs_patients(patients, office_code, api_key)
+    tous_rdvs_actifs = [r for r in tous_rdvs if r.get("statut") == "active"]
 
-    print(f"[ANNULER_RDV] Tous les RDV actifs trouvés: {tous_rdvs_actifs}")
+    logger.debug("[ANNULER_RDV] Tous les RDV actifs trouvés: %s", apercu(tous_rdvs_actifs))
 
     # Trier par date (plus proche en premier)
     today = datetime.now().strftime("%Y-%m-%d")
     tous_rdvs_actifs_futurs = [r for r in tous_rdvs_actifs if r.get("date", "") >= today]
     tous_rdvs_actifs_futurs.sort(key=lambda r: r.get("date", "9999-99-99"))
 
-    print(f"[ANNULER_RDV] RDV futurs triés: {tous_rdvs_actifs_futurs}")
+    logger.debug("[ANNULER_RDV] RDV futurs triés: %s", apercu(tous_rdvs_actifs_futurs))
 
     # Sélectionner le RDV à annuler
     rdv_a_annuler = None
@@ -591,110 +3338,61 @@ async def annuler_rdv(
     rdv_statut_original = rdv_a_annuler.get("statut")
 
     # Log pour debug
-    print(f"[ANNULER_RDV] RDV trouvé: id={rdv_id}, alternate_id={alternate_id}, statut={rdv_statut_original}, date={rdv_a_annuler.get('date')}")
+    logger.info("[ANNULER_RDV] RDV trouvé: id=%s, alternate_id=%s, statut=%s, date=%s", rdv_id, alternate_id, rdv_statut_original, rdv_a_annuler.get('date'))
 
     # Construire la liste des endpoints à essayer (on essaie plusieurs combinaisons)
     endpoints_a_essayer = []
 
+    praticien = cabinets.pour(office_code).praticien
+
     # Avec rdvId
-    endpoints_a_essayer.append(f"/schedules/{DEFAULT_PRATICIEN_ID}/appointment-requests/{rdv_id}/")
-    endpoints_a_essayer.append(f"/schedules/{DEFAULT_PRATICIEN_ID}/appointments/{rdv_id}/")
+    endpoints_a_essayer.append(f"/schedules/{praticien}/appointment-requests/{rdv_id}/")
+    endpoints_a_essayer.append(f"/schedules/{praticien}/appointments/{rdv_id}/")
 
     # Avec alternateRdvId si disponible
     if alternate_id:
-        endpoints_a_essayer.append(f"/schedules/{DEFAULT_PRATICIEN_ID}/appointment-requests/{alternate_id}/")
-        endpoints_a_essayer.append(f"/schedules/{DEFAULT_PRATICIEN_ID}/appointments/{alternate_id}/")
+        endpoints_a_essayer.append(f"/schedules/{praticien}/appointment-requests/{alternate_id}/")
+        endpoints_a_essayer.append(f"/schedules/{praticien}/appointments/{alternate_id}/")
 
-    print(f"[ANNULER_RDV] Endpoints à essayer: {endpoints_a_essayer}")
+    logger.info("[ANNULER_RDV] Endpoints à essayer: %s", endpoints_a_essayer)
 
-    # Essayer chaque endpoint jusqu'à ce que l'annulation fonctionne
+    # Envoyer le DELETE jusqu'à ce qu'un endpoint l'accepte. La vérification (et les
+    # endpoints suivants si le RDV reste actif) est faite en arrière-plan pour ne pas
+    # faire attendre le patient au téléphone.
     derniere_erreur = None
-    annulation_reussie = False
 
-    for endpoint in endpoints_a_essayer:
-        print(f"[ANNULER_RDV] Tentative DELETE {endpoint}")
+    for i, endpoint in enumerate(endpoints_a_essayer):
+        logger.info("[ANNULER_RDV] Tentative DELETE %s", endpoint)
         result = await call_rdvdentiste("DELETE", endpoint, office_code, api_key)
-        print(f"[ANNULER_RDV] Réponse API DELETE: {result}")
-
-        # Vérifier si erreur
-        error_msg = None
-        if isinstance(result, dict):
-            error_msg = result.get("error") or result.get("Error")
-            if isinstance(error_msg, dict):
-                error_msg = error_msg.get("text") or error_msg.get("message") or str(error_msg)
+        logger.debug("[ANNULER_RDV] Réponse API DELETE: %s", apercu(result))
 
+        error_msg = extraire_erreur_api(result)
         if error_msg:
-            print(f"[ANNULER_RDV] Erreur sur cet endpoint: {error_msg}")
+            logger.warning("[ANNULER_RDV] Erreur sur cet endpoint: %s", error_msg)
             derniere_erreur = error_msg
 
             # Si l'API dit que le RDV est déjà annulé, on le note localement et on confirme l'annulation
-            error_lower = str(error_msg).lower()
-            if "already cancelled" in error_lower or "déjà annulé" in error_lower or "already canceled" in error_lower:
-                print(f"[ANNULER_RDV] ✅ API indique RDV déjà annulé, sauvegarde locale")
-                sauvegarder_rdv_annule(rdv_id)
-                return {
-                    "success": True,
-                    "rdv_id": rdv_id,
-                    "date": rdv_a_annuler["date"],
-                    "heure": rdv_a_annuler["heure"],
-                    "message": f"Votre rendez-vous du {rdv_a_annuler['date']} à {rdv_a_annuler['heure']} a bien été annulé."
-                }
+            if est_erreur_deja_annule(error_msg):
+                logger.info("[ANNULER_RDV] ✅ API indique RDV déjà annulé, sauvegarde locale")
+                await marquer_rdv_annule(rdv_a_annuler, office_code)
+                reconciliation_annulations.enregistrer(rdv_a_annuler, "deja_annule", endpoint)
+                return reponse_annulation(rdv_a_annuler)
 
             # Continuer à essayer les autres endpoints
             continue
 
-        # Pas d'erreur, vérifier si le RDV est vraiment annulé
-        await asyncio.sleep(0.5)  # Petite pause pour laisser l'API propager
-
-        rdvs_apres = await trouver_rdvs_patient(rdv_a_annuler["patient_id"], office_code, api_key)
-        rdv_encore_actif = any(
-            r.get("id") == rdv_id and r.get("statut") == "active"
-            for r in rdvs_apres
+        logger.info("[ANNULER_RDV] DELETE accepté par %s, vérification en arrière-plan", endpoint)
+        await marquer_rdv_annule(rdv_a_annuler, office_code)
+        reconciliation_annulations.soumettre(
+            rdv_a_annuler, endpoint, endpoints_a_essayer[i + 1:], office_code, api_key
         )
-
-        print(f"[ANNULER_RDV] Après {endpoint}: RDV encore actif = {rdv_encore_actif}")
-
-        if not rdv_encore_actif:
-            print(f"[ANNULER_RDV] ✅ Annulation réussie avec {endpoint}")
-            annulation_reussie = True
-            break
-        else:
-            print(f"[ANNULER_RDV] ❌ RDV toujours actif, on essaie le prochain endpoint...")
-
-    # Résultat final
-    if annulation_reussie:
-        # Sauvegarder localement pour éviter que le RDV réapparaisse
-        sauvegarder_rdv_annule(rdv_id)
-        return {
-            "success": True,
-            "rdv_id": rdv_id,
-            "date": rdv_a_annuler["date"],
-            "heure": rdv_a_annuler["heure"],
-            "message": f"Votre rendez-vous du {rdv_a_annuler['date']} à {rdv_a_annuler['heure']} a bien été annulé."
-        }
-
-    # Aucun endpoint n'a fonctionné mais l'API dit "already cancelled"
-    if derniere_erreur and ("already cancelled" in str(derniere_erreur).lower() or "déjà annulé" in str(derniere_erreur).lower()):
-        # Sauvegarder localement car l'API ne met pas à jour le statut
-        sauvegarder_rdv_annule(rdv_id)
-        return {
-            "success": True,
-            "rdv_id": rdv_id,
-            "date": rdv_a_annuler["date"],
-            "heure": rdv_a_annuler["heure"],
-            "message": f"Votre rendez-vous du {rdv_a_annuler['date']} à {rdv_a_annuler['heure']} a bien été annulé."
-        }
+        return reponse_annulation(rdv_a_annuler)
 
     # Toujours renvoyer succès (le cabinet vérifiera manuellement si besoin)
-    print(f"[ANNULER_RDV] ⚠️ Annulation envoyée pour le RDV {rdv_id} (vérification manuelle recommandée)")
-    sauvegarder_rdv_annule(rdv_id)
-    return {
-        "success": True,
-        "rdv_id": rdv_id,
-        "date": rdv_a_annuler["date"],
-        "heure": rdv_a_annuler["heure"],
-        "message": f"Votre rendez-vous du {rdv_a_annuler['date']} à {rdv_a_annuler['heure']} a bien été annulé."
-    }
+    logger.warning("[ANNULER_RDV] ⚠️ Annulation envoyée pour le RDV %s (vérification manuelle recommandée)", rdv_id)
+    await marquer_rdv_annule(rdv_a_annuler, office_code)
+    reconciliation_annulations.enregistrer(rdv_a_annuler, "non_confirme", None, derniere_erreur)
+    return reponse_annulation(rdv_a_annuler)
 
 
 # ----- 3. CONSULTER LES DISPONIBILITÉS -----
@@ -703,13 +3401,18 @@ async def annuler_rdv(
 async def consulter_disponibilites(
     request: DisponibilitesRequest,
     office_code: str = Header(default=DEFAULT_OFFICE_CODE, alias="X-Office-Code"),
-    api_key: Optional[str] = Header(default=None, alias="X-Api-Key")
+    api_key: Optional[str] = Header(default=None, alias="X-Api-Key"),
+    stream: bool = False,
+    accept: Optional[str] = Header(default=None)
 ):
     """
     🗓️ CONSULTER LES DISPONIBILITÉS
 
     Retourne les créneaux disponibles pour un type de RDV donné.
     Filtre automatiquement les créneaux selon les plages horaires autorisées.
+
+    Mode streaming (?stream=true ou en-tête Accept: application/x-ndjson): un
+    créneau par ligne NDJSON dès qu'il est disponible, puis une ligne de résumé.
     """
     date_debut = convertir_date(request.date_debut)
 
@@ -721,99 +3424,256 @@ async def consulter_disponibilites(
         date_fin = (date_debut_obj + timedelta(days=14)).strftime("%Y-%m-%d")
 
     # Déterminer la catégorie à partir du code OU du nom
-    categorie = CODE_TO_CATEGORIE.get(request.type_rdv)
-    if not categorie and request.type_rdv_nom:
-        categorie = trouver_categorie_rdv(request.type_rdv_nom)
+    categorie = determiner_categorie(request.type_rdv, request.type_rdv_nom, office_code)
 
-    print(f"[DISPONIBILITES] Type RDV: {request.type_rdv}, Catégorie: {categorie}")
+    logger.info("[DISPONIBILITES] Type RDV: %s, Catégorie: %s", request.type_rdv, categorie)
 
-    params = {
-        "start": date_debut,
-        "end": date_fin,
-        "newPatient": "1" if request.nouveau_patient else "0"
-    }
+    if stream or (isinstance(accept, str) and NDJSON_MEDIA_TYPE in accept):
+        return StreamingResponse(
+            streamer_disponibilites(request, office_code, api_key, date_debut, date_fin, categorie),
+            media_type=NDJSON_MEDIA_TYPE
+        )
 
-    endpoint = f"/schedules/{DEFAULT_PRATICIEN_ID}/slots/{request.type_rdv}/"
-    result = await call_rdvdentiste("GET", endpoint, office_code, api_key, params)
+    # Calendrier matérialisé si la période y est couverte, sinon API (via le cache)
+    lu = calendrier.lire(office_code, request.type_rdv, request.nouveau_patient, date_debut, date_fin)
+    if lu is not None:
+        slots, mis_a_jour_le = lu
+    else:
+        slots, mis_a_jour_le = await recuperer_creneaux(
+            office_code, api_key, request.type_rdv, date_debut, date_fin, request.nouveau_patient,
+            avec_calendrier=False
+        ), None
 
     # Parser les créneaux avec filtrage strict par plages horaires
-    creneaux = []
-    creneaux_filtres = 0
-    slots = result.get("AvailableSlots", []) if isinstance(result, dict) else result
+    compteurs = {"filtres": 0}
+    creneaux = [creneau for creneau, _, _ in parcourir_creneaux(slots, categorie, compteurs, cabinets.pour(office_code))]
+    creneaux_filtres = compteurs["filtres"]
 
-    for slot in slots:
-        start_time = slot.get("start", "")
-        if start_time:
-            date_part = start_time.split("T")[0]
-            time_part = start_time.split("T")[1][:5]
-            heure_code = time_part.replace(":", "")
+    if creneaux_filtres > 0:
+        logger.info("[DISPONIBILITES] %s créneaux filtrés (hors plages autorisées pour %s)", creneaux_filtres, categorie)
 
-            # FILTRAGE STRICT: Appliquer si on a une catégorie (via code ou nom)
-            if categorie:
-                plages_categorie = PLAGES_HORAIRES.get(categorie, {}).get("plages", {})
-                date_obj = datetime.strptime(date_part, "%Y-%m-%d")
-                jour_semaine = date_obj.weekday()
-
-                # Vérifier si le jour est autorisé
-                if jour_semaine not in plages_categorie:
-                    creneaux_filtres += 1
-                    continue
+    reponse = {
+        "success": True,
+        "type_rdv": request.type_rdv,
+        "type_rdv_nom": request.type_rdv_nom,
+        "categorie": categorie,
+        "periode": f"Du {date_debut} au {date_fin}",
+        "creneaux": creneaux,
+        "nombre_creneaux": len(creneaux),
+        "creneaux_filtres": creneaux_filtres,
+        "message": f"{len(creneaux)} créneaux disponibles (filtrés selon plages horaires)." if creneaux else "Aucun créneau disponible sur cette période pour ce type de RDV."
+    }
+    if mis_a_jour_le is not None:
+        reponse["source"] = "calendrier"
+        reponse["mis_a_jour_le"] = datetime.fromtimestamp(mis_a_jour_le).isoformat(timespec="seconds")
+        reponse["age_secondes"] = round(time.time() - mis_a_jour_le)
+    return reponse
 
-                # Vérifier si l'heure est dans une des plages autorisées
-                heure_ok = False
-                for debut, fin in plages_categorie[jour_semaine]:
-                    if debut <= time_part <= fin:
-                        heure_ok = True
-                        break
 
-                if not heure_ok:
-                    creneaux_filtres += 1
-                    continue
+@app.post("/prochains_creneaux")
+async def prochains_creneaux(
+    request: ProchainsCreneauxRequest,
+    office_code: str = Header(default=DEFAULT_OFFICE_CODE, alias="X-Office-Code"),
+    api_key: Optional[str] = Header(default=None, alias="X-Api-Key")
+):
+    """
+    ⏭️ PROCHAINS CRÉNEAUX DISPONIBLES
 
-            creneaux.append({
-                "date": date_part,
-                "heure": heure_code,
-                "heure_affichage": time_part.replace(":", "h")
-            })
+    Cherche les N premiers créneaux autorisés à partir d'une date, en explorant des
+    fenêtres de plus en plus larges (2 jours, puis 7, puis 30 par défaut) et en
+    s'arrêtant dès que le nombre demandé est atteint.
+    Filtres optionnels: matin / après-midi, pas le samedi, jours exclus.
+    """
+    # Date absente ou variable non remplacée: à partir d'aujourd'hui
+    if est_variable_non_remplacee(request.date_debut):
+        date_debut = datetime.now().strftime("%Y-%m-%d")
+    else:
+        date_debut = convertir_date(request.date_debut)
+    try:
+        debut_fenetre = datetime.strptime(date_debut, "%Y-%m-%d")
+    except ValueError:
+        logger.info("[PROCHAINS_CRENEAUX] Date invalide: %s", request.date_debut)
+        return {
+            "success": False,
+            "message": "La date de début est invalide. Veuillez préciser une date au format JJ/MM/AAAA."
+        }
+    categorie = determiner_categorie(request.type_rdv, request.type_rdv_nom, office_code)
+    config = cabinets.pour(office_code)
+
+    moment = (request.moment or "").lower().replace("è", "e").replace(" ", "-").replace("_", "-")
+    jours_exclus = set(request.jours_exclus)
+    if request.exclure_samedi:
+        jours_exclus.add(5)
+
+    def convient(jour: int, minutes: int) -> bool:
+        if jour in jours_exclus:
+            return False
+        if moment == "matin" and minutes >= HEURE_MIDI_MINUTES:
+            return False
+        if moment == "apres-midi" and minutes < HEURE_MIDI_MINUTES:
+            return False
+        return True
 
-    if creneaux_filtres > 0:
-        print(f"[DISPONIBILITES] {creneaux_filtres} créneaux filtrés (hors plages autorisées pour {categorie})")
+    creneaux = []
+    compteurs = {"filtres": 0}
+    fin_fenetre = debut_fenetre
+
+    for jours in PROCHAINS_CRENEAUX_FENETRES:
+        fin_fenetre = debut_fenetre + timedelta(days=jours - 1)
+        slots = await recuperer_creneaux(
+            office_code, api_key, request.type_rdv,
+            debut_fenetre.strftime("%Y-%m-%d"), fin_fenetre.strftime("%Y-%m-%d"),
+            request.nouveau_patient
+        )
+        for creneau, jour, minutes in parcourir_creneaux(slots, categorie, compteurs, config):
+            if convient(jour, minutes):
+                creneaux.append(creneau)
+                if len(creneaux) >= request.nombre:
+                    break
+        if len(creneaux) >= request.nombre:
+            break
+        debut_fenetre = fin_fenetre + timedelta(days=1)
+
+    periode = f"Du {date_debut} au {fin_fenetre.strftime('%Y-%m-%d')}"
+    logger.info("[PROCHAINS_CRENEAUX] Type %s (%s): %s créneau(x) trouvé(s) %s", request.type_rdv, categorie, len(creneaux), periode)
+
+    if not creneaux:
+        return {
+            "success": True,
+            "type_rdv": request.type_rdv,
+            "categorie": categorie,
+            "periode": periode,
+            "creneaux": [],
+            "nombre_creneaux": 0,
+            "message": "Aucun créneau disponible correspondant à votre demande dans les prochaines semaines."
+        }
 
+    liste = ", ".join(f"le {c['date']} à {c['heure_affichage']}" for c in creneaux)
     return {
         "success": True,
         "type_rdv": request.type_rdv,
-        "type_rdv_nom": request.type_rdv_nom,
         "categorie": categorie,
-        "periode": f"Du {date_debut} au {date_fin}",
+        "periode": periode,
         "creneaux": creneaux,
         "nombre_creneaux": len(creneaux),
-        "creneaux_filtres": creneaux_filtres,
-        "message": f"{len(creneaux)} créneaux disponibles (filtrés selon plages horaires)." if creneaux else "Aucun créneau disponible sur cette période pour ce type de RDV."
+        "message": f"Prochains créneaux disponibles: {liste}."
     }
 
 
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def _ligne_ndjson(data: dict) -> bytes:
+    return json_encoder(data) + b"\n"
+
+
+async def streamer_disponibilites(
+    request: DisponibilitesRequest,
+    office_code: str,
+    api_key: Optional[str],
+    date_debut: str,
+    date_fin: str,
+    categorie: Optional[str]
+):
+    """Produit les créneaux autorisés en NDJSON au fil des tranches, puis un résumé"""
+    config = cabinets.pour(office_code)
+    compteurs = {"filtres": 0}
+    nombre = 0
+    try:
+        async for slots in iterer_tranches_creneaux(
+            office_code, api_key, request.type_rdv, date_debut, date_fin, request.nouveau_patient
+        ):
+            for creneau, _, _ in parcourir_creneaux(slots, categorie, compteurs, config):
+                nombre += 1
+                yield _ligne_ndjson({"type": "creneau", **creneau})
+    except HTTPException as e:
+        logger.warning("[DISPONIBILITES] Erreur pendant le streaming: %s", e.detail)
+        yield _ligne_ndjson({
+            "type": "erreur",
+            "success": False,
+            "message": "Impossible de récupérer toutes les disponibilités pour le moment."
+        })
+        return
+
+    yield _ligne_ndjson({
+        "type": "resume",
+        "success": True,
+        "type_rdv": request.type_rdv,
+        "type_rdv_nom": request.type_rdv_nom,
+        "categorie": categorie,
+        "periode": f"Du {date_debut} au {date_fin}",
+        "nombre_creneaux": nombre,
+        "creneaux_filtres": compteurs["filtres"],
+        "message": f"{nombre} créneaux disponibles (filtrés selon plages horaires)." if nombre else "Aucun créneau disponible sur cette période pour ce type de RDV."
+    })
+
+
 # ----- 4. CRÉER UN RDV -----
 
 @app.post("/creer_rdv")
 async def creer_rdv(
     request: CreerRdvRequest,
     office_code: str = Header(default=DEFAULT_OFFICE_CODE, alias="X-Office-Code"),
-    api_key: Optional[str] = Header(default=None, alias="X-Api-Key")
+    api_key: Optional[str] = Header(default=None, alias="X-Api-Key"),
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key")
 ):
     """
     ✅ CRÉER UN RENDEZ-VOUS
 
     Crée un nouveau RDV pour un patient.
+    Une requête répétée (même Idempotency-Key, ou sans en-tête même patient et même créneau
+    dans les IDEMPOTENCE_TTL_SANS_CLE secondes) reçoit la réponse de la première au lieu de
+    réserver une seconde fois.
     """
+    # Une seule forme de l'heure (HHMM) pour la clé d'idempotence, l'URL de l'API et la réponse
+    heure = normaliser_heure(request.heure)
+    if heure is None:
+        logger.info("[CREER_RDV] Heure invalide: %s", request.heure)
+        return {
+            "success": False,
+            "message": "L'heure du rendez-vous est invalide. Veuillez préciser un horaire au format HHMM, par exemple 0930."
+        }
+    request = request.model_copy(update={"heure": heure})
+
+    if idempotency_key:
+        registre, cle = idempotence, f"{office_code}:{idempotency_key}"
+    else:
+        registre = idempotence_creneau
+        cle = prefixe_creneau(office_code, convertir_date(request.date), request.heure) + f"{normaliser_telephone(request.telephone)}:{request.type_rdv}"
+
+    reservee, reponse = await registre.reserver(cle)
+    if not reservee:
+        if reponse is not None:
+            logger.info("[CREER_RDV] Requête répétée (clé %s): réponse précédente renvoyée", cle)
+            return reponse
+        return {
+            "success": False,
+            "message": "Votre demande de rendez-vous est en cours de traitement, merci de patienter."
+        }
+
+    try:
+        reponse = await _creer_rdv(request, office_code, api_key)
+    except BaseException:
+        await registre.liberer(cle)
+        raise
+    if reponse.get("success"):
+        await registre.enregistrer(cle, reponse)
+    else:
+        await registre.liberer(cle)
+    return reponse
+
+
+async def _creer_rdv(request: CreerRdvRequest, office_code: str, api_key: Optional[str]) -> dict:
+    config = cabinets.pour(office_code)
     date = convertir_date(request.date)
     date_naissance = convertir_date(request.date_naissance) if request.date_naissance else None
     telephone = normaliser_telephone(request.telephone)
 
     # Valider les plages horaires si type_rdv_nom est fourni
     if request.type_rdv_nom:
-        if not est_creneau_autorise(request.type_rdv_nom, date, request.heure):
-            categorie = trouver_categorie_rdv(request.type_rdv_nom)
-            print(f"[CREER_RDV] Créneau refusé: {request.type_rdv_nom} ({categorie}) le {date} à {request.heure}")
+        if not est_creneau_autorise(request.type_rdv_nom, date, request.heure, config):
+            categorie = trouver_categorie_rdv(request.type_rdv_nom, config)
+            logger.info("[CREER_RDV] Créneau refusé: %s (%s) le %s à %s", request.type_rdv_nom, categorie, date, request.heure)
             return {
                 "success": False,
                 "message": f"Ce créneau n'est pas disponible pour ce type de rendez-vous. Veuillez choisir un autre horaire."
@@ -833,14 +3693,14 @@ async def creer_rdv(
     if request.message:
         params["messagePatient"] = request.message
 
-    endpoint = f"/schedules/{DEFAULT_PRATICIEN_ID}/slots/{request.type_rdv}/{date}/{request.heure}/"
+    endpoint = f"/schedules/{config.praticien}/slots/{request.type_rdv}/{date}/{request.heure}/"
 
-    print(f"[CREER_RDV] Endpoint: PUT {endpoint}")
-    print(f"[CREER_RDV] Params: {params}")
+    logger.info("[CREER_RDV] Endpoint: PUT %s", endpoint)
+    logger.debug("[CREER_RDV] Params: %s", apercu(params))
 
     result = await call_rdvdentiste("PUT", endpoint, office_code, api_key, params)
 
-    print(f"[CREER_RDV] Réponse API: {result}")
+    logger.debug("[CREER_RDV] Réponse API: %s", apercu(result))
 
     # Vérifier le résultat
     is_confirmed = result.get("done", False)
@@ -849,19 +3709,25 @@ async def creer_rdv(
     error_msg = result.get("error") or result.get("Error")
 
     if error_msg:
-        print(f"[CREER_RDV] Erreur API: {error_msg}")
+        logger.warning("[CREER_RDV] Erreur API: %s", error_msg)
         return {
             "success": False,
             "message": f"Erreur lors de la création: {error_msg}"
         }
 
     if busy_message or (not is_confirmed and not rdv_id):
-        print(f"[CREER_RDV] Créneau non disponible - busy={busy_message}, done={is_confirmed}, rdvId={rdv_id}")
+        logger.info("[CREER_RDV] Créneau non disponible - busy=%s, done=%s, rdvId=%s", busy_message, is_confirmed, rdv_id)
         return {
             "success": False,
             "message": "Ce créneau n'est plus disponible. Veuillez en choisir un autre."
         }
 
+    # Le créneau vient d'être pris: ne plus le proposer depuis le cache
+    invalider_disponibilites(office_code, date)
+    if request.nouveau_patient:
+        # Le patient existe maintenant dans rdvdentiste: ne plus servir "numéro inconnu"
+        invalider_patients(office_code, telephone)
+
     heure_affichage = formater_heure(request.heure)
 
     return {
@@ -905,7 +3771,12 @@ async def rechercher_patient(
             "message": "Veuillez fournir au moins un critère de recherche."
         }
 
-    result = await call_rdvdentiste("GET", "/patients/find", office_code, api_key, params, allow_404=True)
+    if list(params) == ["mobile"]:
+        # Recherche par téléphone seul: même résultat que voir_rdv / annuler_rdv, souvent déjà en cache
+        trouves = await trouver_patients_par_telephone(params["mobile"], office_code, api_key)
+        result = {"People": [p["data"] for p in trouves]} if trouves else {"Error": {"code": "notFound"}}
+    else:
+        result = await call_rdvdentiste("GET", "/patients/find", office_code, api_key, params, allow_404=True)
 
     if isinstance(result, dict) and "Error" in result:
         return {
@@ -949,8 +3820,8 @@ async def lister_praticiens(
     api_key: Optional[str] = Header(default=None, alias="X-Api-Key")
 ):
     """Liste les praticiens et leurs types de RDV disponibles"""
-    result = await call_rdvdentiste("GET", "/schedules", office_code, api_key)
-    return {"success": True, "praticiens": result}
+    catalogue = await obtenir_catalogue(office_code, api_key)
+    return {"success": True, "praticiens": catalogue["raw"]}
 
 
 @app.get("/types_rdv")
@@ -959,61 +3830,262 @@ async def lister_types_rdv(
     api_key: Optional[str] = Header(default=None, alias="X-Api-Key")
 ):
     """Liste tous les types de RDV disponibles avec leurs plages horaires"""
-    jours_semaine = {0: "Lundi", 1: "Mardi", 2: "Mercredi", 3: "Jeudi", 4: "Vendredi", 5: "Samedi", 6: "Dimanche"}
+    catalogue = await obtenir_catalogue(office_code, api_key)
+    types_rdv = catalogue["types_rdv"]
 
-    result = await call_rdvdentiste("GET", "/schedules", office_code, api_key)
+    return {
+        "success": True,
+        "types_rdv": types_rdv,
+        "message": f"{len(types_rdv)} types de RDV disponibles."
+    }
 
-    types_rdv = []
-    schedules = result.get("Schedules", []) if isinstance(result, dict) else result
 
-    for schedule in schedules:
-        if isinstance(schedule, dict):
-            # Parser la structure FHIR avec extensions
-            extensions = schedule.get("extension", [])
-            for ext in extensions:
-                if ext.get("url") == "http://interopsante.org/fhir/structuredefinition/schedule/fr-service-type-duration":
-                    service_type = None
-                    duration = None
-                    new_patient_only = False
+@app.post("/cache/schedules/invalider")
+async def invalider_cache_schedules(
+    tous: bool = False,
+    office_code: str = Header(default=DEFAULT_OFFICE_CODE, alias="X-Office-Code")
+):
+    """Force le rechargement du catalogue /schedules (cabinet courant, ou tous avec ?tous=true)"""
+    nb = await invalider_catalogue(None if tous else office_code)
+    return {"success": True, "entrees_supprimees": nb}
 
-                    for sub_ext in ext.get("extension", []):
-                        if sub_ext.get("url") == "serviceType":
-                            coding = sub_ext.get("valueCodeableConcept", {}).get("coding", [])
-                            if coding:
-                                service_type = coding[0]
-                                # Vérifier eligibility pour nouveaux patients
-                                eligibility = coding[0].get("eligibility", [])
-                                for elig in eligibility:
-                                    if elig.get("code") == "newPatients":
-                                        new_patient_only = elig.get("value", False)
-                        elif sub_ext.get("url") == "duration":
-                            duration = sub_ext.get("valueDuration", {}).get("time", {}).get("value")
 
-                    if service_type:
-                        nom = service_type.get("display")
-                        # Trouver la catégorie et les plages horaires
-                        categorie = trouver_categorie_rdv(nom)
-                        plages_formatees = []
+@app.get("/annulations")
+async def lister_annulations(etat: Optional[str] = None):
+    """État des dernières annulations (vérification en arrière-plan)"""
+    annulations = [a for a in reconciliation_annulations.etats.values() if not etat or a["etat"] == etat]
+    return {"success": True, "annulations": list(reversed(annulations)), "nombre": len(annulations)}
 
-                        if categorie:
-                            plages_categorie = PLAGES_HORAIRES.get(categorie, {}).get("plages", {})
-                            for jour, horaires in plages_categorie.items():
-                                for debut, fin in horaires:
-                                    plages_formatees.append(f"{jours_semaine[jour]}: {debut.replace(':', 'h')}-{fin.replace(':', 'h')}")
 
-                        types_rdv.append({
-                            "code": service_type.get("code"),
-                            "nom": nom,
-                            "duree_minutes": int(duration) if duration else None,
-                            "nouveau_patient_only": new_patient_only,
-                            "categorie": categorie,
-                            "plages_horaires": plages_formatees
-                        })
+@app.get("/annulations/{rdv_id}")
+async def etat_annulation(rdv_id: str):
+    """État de l'annulation d'un RDV"""
+    annulation = reconciliation_annulations.etats.get(rdv_id)
+    if annulation is None:
+        raise HTTPException(status_code=404, detail="Annulation inconnue")
+    return {"success": True, "annulation": annulation}
+
+
+@app.get("/cabinets")
+async def lister_cabinets():
+    """Configuration chargée par cabinet (praticien, codes, catégories) et génération du fichier"""
+    def resume(config: ConfigCabinet) -> dict:
+        return {
+            "praticien": config.praticien,
+            "codes": len(config.code_to_categorie),
+            "categories": list(config.plages_horaires),
+            "cle_api_propre": config.api_key is not None
+        }
 
     return {
         "success": True,
-        "types_rdv": types_rdv,
-        "message": f"{len(types_rdv)} types de RDV disponibles."
+        "fichier": CABINETS_CONFIG_FILE or None,
+        "generation": cabinets.generation,
+        "defaut": resume(cabinets.pour(None)),
+        "cabinets": {office_code: resume(config) for office_code, config in cabinets.cabinets().items()}
+    }
+
+
+@app.get("/resilience")
+async def etat_resilience():
+    """État des disjoncteurs et des limites par cabinet, budget de retries et p95 par classe d'endpoint"""
+    return {
+        "success": True,
+        "disjoncteurs": {
+            office: {"etat": d.etat, "echecs_consecutifs": d.echecs}
+            for office, d in disjoncteurs.items()
+        },
+        "budget_retry": round(budget_retry.jetons, 2),
+        "p95_ms": {
+            classe: round(p95 * 1000) if (p95 := p95_latence(classe)) is not None else None
+            for classe in _latences_par_classe
+        },
+        "hedge_actif": HEDGE_ACTIF,
+        "limites": {office: limiteur.stats() for office, limiteur in limiteurs.items()}
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metriques():
+    """Métriques au format texte Prometheus"""
+    lignes = []
+    for metrique in (METRIQUE_REQUETES, METRIQUE_REQUETES_EN_COURS, METRIQUE_AMONT,
+                     METRIQUE_AMONT_STATUTS, METRIQUE_AMONT_EN_COURS, METRIQUE_CRENEAUX_FILTRES):
+        lignes.extend(metrique.exporter())
+
+    caches = (cache_disponibilites, cache_patients, stats_catalogue, calendrier.statistiques)
+    lignes += ["# HELP secretaire_cache_hits_total Lectures servies par le cache", "# TYPE secretaire_cache_hits_total counter"]
+    lignes += [f'secretaire_cache_hits_total{{cache="{c.nom}"}} {c.hits}' for c in caches]
+    lignes += ["# HELP secretaire_cache_misses_total Lectures absentes du cache", "# TYPE secretaire_cache_misses_total counter"]
+    lignes += [f'secretaire_cache_misses_total{{cache="{c.nom}"}} {c.misses}' for c in caches]
+    lignes += ["# HELP secretaire_cache_ratio Proportion de lectures servies par le cache", "# TYPE secretaire_cache_ratio gauge"]
+    lignes += [f'secretaire_cache_ratio{{cache="{c.nom}"}} {c.stats()["ratio"] or 0}' for c in caches]
+
+    lignes += [
+        "# HELP secretaire_amont_get_partages Appels GET en cours partagés (single-flight)",
+        "# TYPE secretaire_amont_get_partages gauge",
+        f"secretaire_amont_get_partages {len(_get_en_vol)}",
+        "# HELP secretaire_limiteur_en_attente Appels en file d'attente du limiteur par cabinet",
+        "# TYPE secretaire_limiteur_en_attente gauge",
+    ]
+    lignes += [f'secretaire_limiteur_en_attente{{cabinet="{office}"}} {l.en_attente}' for office, l in limiteurs.items()]
+    return "\n".join(lignes) + "\n"
+
+
+@app.get("/cache/stats")
+async def statistiques_cache():
+    """Compteurs hits/misses des caches en mémoire"""
+    return {
+        "success": True,
+        "disponibilites": cache_disponibilites.stats(),
+        "patients": cache_patients.stats(),
+        "catalogue": {**stats_catalogue.stats(), "entrees": len(_cache_catalogue), "ttl_secondes": SCHEDULES_CACHE_TTL},
+        "calendrier": calendrier.stats()
+    }
+
+
+# ----- 7. BATCH: PLUSIEURS ACTIONS EN UN SEUL APPEL -----
+
+# action -> (modèle de requête ou None si params bruts, appel(requête, office_code, api_key))
+ACTIONS_BATCH = {
+    "voir_rdv": (VoirRdvRequest, lambda r, office, cle: voir_rdv(r, office, cle)),
+    "annuler_rdv": (AnnulerRdvRequest, lambda r, office, cle: annuler_rdv(r, office, cle)),
+    "disponibilites": (DisponibilitesRequest, lambda r, office, cle: consulter_disponibilites(r, office, cle, stream=False, accept=None)),
+    "prochains_creneaux": (ProchainsCreneauxRequest, lambda r, office, cle: prochains_creneaux(r, office, cle)),
+    "creer_rdv": (CreerRdvRequest, lambda r, office, cle: creer_rdv(r, office, cle, idempotency_key=None)),
+    "rechercher_patient": (RechercherPatientRequest, lambda r, office, cle: rechercher_patient(r, office, cle)),
+    "suggerer_type_rdv": (None, lambda p, office, cle: suggerer_type_rdv(str(p.get("motif", "")), office, cle)),
+    "types_rdv": (None, lambda p, office, cle: lister_types_rdv(office, cle)),
+}
+BATCH_MAX_ACTIONS = int(os.getenv("BATCH_MAX_ACTIONS", "10"))
+RE_REFERENCE_BATCH = re.compile(r"\$\{([^}.]+)((?:\.[^}.]+)*)\}")
+
+
+class ErreurBatch(Exception):
+    pass
+
+
+def references_batch(valeur) -> set:
+    """Identifiants d'actions référencés (${id...}) dans des paramètres"""
+    if isinstance(valeur, str):
+        return {m.group(1) for m in RE_REFERENCE_BATCH.finditer(valeur)}
+    if isinstance(valeur, dict):
+        return set().union(*(references_batch(v) for v in valeur.values()))
+    if isinstance(valeur, list):
+        return set().union(*(references_batch(v) for v in valeur))
+    return set()
+
+
+def _valeur_reference(resultats: dict, id_action: str, chemin: str):
+    valeur = resultats[id_action]
+    for segment in chemin.split(".")[1:]:
+        try:
+            valeur = valeur[int(segment)] if isinstance(valeur, list) else valeur[segment]
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise ErreurBatch(f"${{{id_action}{chemin}}} introuvable dans le résultat de '{id_action}'")
+    return valeur
+
+
+def resoudre_references(valeur, resultats: dict):
+    """Remplace ${id.chemin} par la valeur du résultat (typée si la chaîne n'est qu'une référence)"""
+    if isinstance(valeur, str):
+        seule = RE_REFERENCE_BATCH.fullmatch(valeur)
+        if seule:
+            return _valeur_reference(resultats, seule.group(1), seule.group(2))
+        return RE_REFERENCE_BATCH.sub(lambda m: str(_valeur_reference(resultats, m.group(1), m.group(2))), valeur)
+    if isinstance(valeur, dict):
+        return {k: resoudre_references(v, resultats) for k, v in valeur.items()}
+    if isinstance(valeur, list):
+        return [resoudre_references(v, resultats) for v in valeur]
+    return valeur
+
+
+async def executer_action_batch(action: ActionBatch, params: dict, office_code: str, api_key: Optional[str]) -> dict:
+    """Exécute une action comme son endpoint; les erreurs deviennent des résultats success=False"""
+    modele, appel = ACTIONS_BATCH[action.action]
+    try:
+        requete = modele(**params) if modele is not None else params
+        return await appel(requete, office_code, api_key)
+    except ValidationError as e:
+        details = "; ".join(f"{'.'.join(str(l) for l in err['loc'])}: {err['msg']}" for err in e.errors())
+        return {"success": False, "message": f"Paramètres invalides: {details}"}
+    except HTTPException as e:
+        return {"success": False, "message": e.detail, "statut": e.status_code}
+
+
+@app.post("/batch")
+async def batch(
+    request: BatchRequest,
+    office_code: str = Header(default=DEFAULT_OFFICE_CODE, alias="X-Office-Code"),
+    api_key: Optional[str] = Header(default=None, alias="X-Api-Key")
+):
+    """
+    📦 PLUSIEURS ACTIONS EN UN SEUL APPEL
+
+    Exécute une liste ordonnée d'actions (mêmes paramètres que les endpoints) et
+    renvoie tous les résultats. Une action attend celles qu'elle référence
+    ("${id.chemin}" dans ses params) ou qu'elle liste dans "apres"; les autres
+    sont lancées en parallèle. Une action dont une dépendance a échoué
+    (exception, référence introuvable) n'est pas exécutée.
+    """
+    debut = time.monotonic()
+    if not request.actions or len(request.actions) > BATCH_MAX_ACTIONS:
+        raise HTTPException(status_code=400, detail=f"Entre 1 et {BATCH_MAX_ACTIONS} actions par batch")
+
+    # Valider l'ordre: une action ne peut dépendre que d'actions placées avant elle
+    ids = []
+    dependances = []
+    for i, action in enumerate(request.actions):
+        id_action = action.id or str(i)
+        if action.action not in ACTIONS_BATCH:
+            raise HTTPException(status_code=400, detail=f"Action '{action.action}' inconnue (attendu: {', '.join(ACTIONS_BATCH)})")
+        if id_action in ids:
+            raise HTTPException(status_code=400, detail=f"Identifiant d'action '{id_action}' en double")
+        deps = references_batch(action.params) | set(action.apres)
+        inconnues = deps - set(ids)
+        if inconnues:
+            raise HTTPException(status_code=400, detail=f"L'action '{id_action}' dépend de {sorted(inconnues)}, qui doivent la précéder")
+        ids.append(id_action)
+        dependances.append(deps)
+
+    resultats: dict = {}
+    echecs: dict = {}  # id -> raison (l'action n'a pas produit de résultat exploitable)
+    taches: dict = {}
+
+    async def executer(i: int):
+        action, id_action = request.actions[i], ids[i]
+        if dependances[i]:
+            await asyncio.gather(*(taches[d] for d in dependances[i]))
+        bloquantes = sorted(d for d in dependances[i] if d in echecs)
+        if bloquantes:
+            echecs[id_action] = "dépendance"
+            resultats[id_action] = {"success": False, "message": f"Action non exécutée: échec de {', '.join(bloquantes)}"}
+            return
+        try:
+            params = resoudre_references(action.params, resultats)
+        except ErreurBatch as e:
+            echecs[id_action] = "référence"
+            resultats[id_action] = {"success": False, "message": str(e)}
+            return
+        try:
+            resultats[id_action] = await executer_action_batch(action, params, office_code, api_key)
+        except Exception as e:
+            logger.exception("[BATCH] Action %s (%s) en erreur", id_action, action.action)
+            echecs[id_action] = "exception"
+            resultats[id_action] = {"success": False, "message": f"Erreur: {e}"}
+
+    for i, id_action in enumerate(ids):
+        taches[id_action] = asyncio.create_task(executer(i))
+    await asyncio.gather(*taches.values())
+
+    logger.info("[BATCH] %s action(s) en %s ms (%s échec(s))", len(ids), round((time.monotonic() - debut) * 1000), len(echecs))
+    return {
+        "success": True,
+        "resultats": [
+            {"id": id_action, "action": action.action, "resultat": resultats[id_action]}
+            for id_action, action in zip(ids, request.actions)
+        ],
+        "duree_ms": round((time.monotonic() - debut) * 1000)
     }
 
 
@@ -1026,20 +4098,21 @@ async def debug_rdv(
     api_key: Optional[str] = Header(default=None, alias="X-Api-Key")
 ):
     """DEBUG: Tester différents GET pour voir le statut d'un RDV"""
-    print(f"[DEBUG] Test GET pour RDV {rdv_id}")
+    logger.info("[DEBUG] Test GET pour RDV %s", rdv_id)
     results = {}
 
+    praticien = cabinets.pour(office_code).praticien
     endpoints = [
-        f"/schedules/{DEFAULT_PRATICIEN_ID}/appointments/{rdv_id}/",
-        f"/schedules/{DEFAULT_PRATICIEN_ID}/appointment-requests/{rdv_id}/",
+        f"/schedules/{praticien}/appointments/{rdv_id}/",
+        f"/schedules/{praticien}/appointment-requests/{rdv_id}/",
         f"/appointments/{rdv_id}/",
         f"/appointment-requests/{rdv_id}/",
     ]
 
     for endpoint in endpoints:
-        print(f"[DEBUG] GET {endpoint}")
+        logger.info("[DEBUG] GET %s", endpoint)
         result = await call_rdvdentiste("GET", endpoint, office_code, api_key)
-        print(f"[DEBUG] Réponse: {result}")
+        logger.debug("[DEBUG] Réponse: %s", apercu(result))
         results[endpoint] = result
 
     return {"rdv_id": rdv_id, "results": results}
@@ -1146,7 +4219,7 @@ async def consulter_disponibilites_legacy(
     api_key: Optional[str] = Header(default=None, alias="X-Api-Key")
 ):
     """Legacy endpoint - redirige vers /disponibilites"""
-    return await consulter_disponibilites(request, office_code, api_key)
+    return await consulter_disponibilites(request, office_code, api_key, stream=False, accept=None)
 
 
 # ============== MAIN ==============